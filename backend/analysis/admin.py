@@ -1,3 +1,32 @@
 from django.contrib import admin
+from .models import PageFingerprint, PipelineCheckpoint, PipelineRun, PipelineStageMetric
 
-# Register your models here.
+
+@admin.register(PipelineCheckpoint)
+class PipelineCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('analysis', 'stage', 'updated_at')
+    list_filter = ('stage',)
+    search_fields = ('analysis__uid',)
+    ordering = ('-updated_at',)
+
+
+class PipelineStageMetricInline(admin.TabularInline):
+    model = PipelineStageMetric
+    extra = 0
+    readonly_fields = ('stage', 'duration_ms', 'calls', 'retries', 'prompt_tokens', 'output_tokens', 'total_tokens', 'provider')
+
+
+@admin.register(PipelineRun)
+class PipelineRunAdmin(admin.ModelAdmin):
+    list_display = ('analysis', 'started_at', 'succeeded', 'total_ms', 'page_count', 'pages_dropped', 'pages_reused', 'retries', 'deferred_stage', 'retry_delay_ms', 'key_switches', 'hedges', 'hedge_wins', 'provider_failovers', 'total_tokens')
+    list_filter = ('succeeded', 'extraction_cache_hit', 'verification_skipped', 'text_layer_used', 'started_at')
+    search_fields = ('analysis__uid',)
+    ordering = ('-started_at',)
+    inlines = [PipelineStageMetricInline]
+
+
+@admin.register(PageFingerprint)
+class PageFingerprintAdmin(admin.ModelAdmin):
+    list_display = ('user', 'analysis', 'digest', 'created_at')
+    search_fields = ('digest', 'analysis__uid', 'user__email')
+    ordering = ('-created_at',)
@@ -0,0 +1,403 @@
+import asyncio
+import json
+import time
+
+import redis
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from core.models import MedicalAnalysis
+from core.schemas import (
+    AIResultSchema, InterpretationShardSchema, InterpretationSummarySchema, VerificationPatchSchema,
+)
+from core.services import apply_pipeline_result, build_patient_context
+from .checkpoints import AnalysisCheckpoints
+from .clients import client_pool
+from .claims import get_analysis_claim
+from .errors import CircuitOpenError, counted_retries, task_park, task_retry
+from .metrics import save_pipeline_metrics
+from .fingerprints import PageFingerprints
+from .sharding import merge_shards
+from .hedging import latency_tracker
+from .services import AnalysisPipeline
+from .prompts import EXTRACTOR_SYSTEM_PROMPT
+
+
+class AsyncAnalysisPipeline(AnalysisPipeline):
+    """
+    Тот же пайплайн, но вызовы модели — через client.aio, а паузы — через asyncio.sleep.
+    Пока один анализ ждет Gemini, event loop обслуживает остальные.
+    Растеризация и сжатие (CPU) уходят в поток через asyncio.to_thread.
+    """
+
+    async def _call_gemini_with_fallback(self, *args, **kwargs):
+        return await self._arun(self._call_plan(*args, **kwargs))
+
+    async def _call_structured(self, *args, **kwargs):
+        return await self._arun(self._structured_plan(*args, **kwargs))
+
+    async def _arun(self, plan):
+        """Исполняет план вызова (см. AnalysisPipeline._call_plan) на event loop"""
+        outcome, error = None, None
+        while True:
+            try:
+                step = plan.throw(error) if error is not None else plan.send(outcome)
+            except StopIteration as stop:
+                return stop.value
+            outcome, error = None, None
+            try:
+                outcome = await self._aexecute(step)
+            except Exception as e:
+                error = e
+
+    async def _aexecute(self, step):
+        kind, *args = step
+        if kind == 'sleep':
+            await asyncio.sleep(args[0])
+            return None
+        if kind == 'blocking':
+            # Пул ключей и breaker ходят в Redis синхронно — не блокируем event loop
+            fn, *fn_args = args
+            return await asyncio.to_thread(fn, *fn_args)
+        if kind == 'generate':
+            key_idx, contents, config, stage, model, timeout = args
+            # wait_for отменяет зависший запрос, даже если HTTP-таймаут не сработал
+            return await asyncio.wait_for(self._agenerate(key_idx, contents, config, stage, model), timeout)
+        if kind == 'provider':
+            provider, prompt, schema, mime_type, image_parts, timeout = args
+            return await asyncio.wait_for(provider.agenerate(prompt, schema, mime_type, image_parts, timeout), timeout)
+        raise ValueError(f"Неизвестный шаг плана вызова: {kind}")
+
+    async def _agenerate(self, key_idx, contents, config, stage, model=None):
+        """Async-версия _generate: дубль — отдельная задача, проигравшая отменяется"""
+        model = model or self.model_name
+        started = time.monotonic()
+        hedge_after = self._hedge_after(stage)
+
+        def call(idx):
+            return asyncio.ensure_future(
+                self.backend.agenerate(self._get_client(idx), model, contents, config, stage)
+            )
+
+        primary = call(key_idx)
+        tasks = {primary: key_idx}
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait([primary], timeout=hedge_after)
+                if not done:
+                    hedge_idx = await asyncio.to_thread(self._acquire_hedge_key, key_idx)
+                    if hedge_idx is not None:
+                        self.metrics.add('hedges')
+                        print(f"🏇 {stage}: нет ответа {hedge_after:.1f}s (p{self.hedge_percentile}), дубль на API KEY #{hedge_idx + 1}")
+                        tasks[call(hedge_idx)] = hedge_idx
+
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is not primary:
+                        self.metrics.add('hedge_wins')
+                    latency_tracker.record(stage, time.monotonic() - started)
+                    return task.result(), tasks[task]
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run_pipeline(self, file_path: str, patient_context: str = None, checkpoints=None, fingerprints=None) -> dict:
+        """
+        Как AnalysisPipeline.run_pipeline: с checkpoints пайплайн продолжает с последнего
+        завершенного этапа, а ошибки пробрасывает — воркер решает, вернуть ли анализ в очередь.
+        """
+        self.fingerprints = fingerprints
+        self.deadline = time.monotonic() + self.pipeline_budget if self.pipeline_budget else None
+        succeeded = False
+        try:
+            raw_data = await self._load_checkpoint(checkpoints, 'extract')
+            if raw_data is None:
+                print(f"--- Stage 1: Extraction ({self.model_name}, async) ---")
+                with self.metrics.stage('extract'):
+                    raw_data = await self._step_extract(file_path)
+                await self._save_checkpoint(checkpoints, 'extract', raw_data)
+            else:
+                print("--- Stage 1: Extraction — восстановлено из чекпоинта ---")
+
+            interpreted_data = await self._load_checkpoint(checkpoints, 'interpret')
+            if interpreted_data is None:
+                print(f"--- Stage 2: Interpretation ({self.model_name}, async) ---")
+                with self.metrics.stage('interpret'):
+                    interpreted_data = self._local_statuses(await self._step_interpret(raw_data, patient_context))
+                await self._save_checkpoint(checkpoints, 'interpret', interpreted_data)
+            else:
+                print("--- Stage 2: Interpretation — восстановлено из чекпоинта ---")
+
+            print(f"--- Stage 3: Verification ({self.model_name}, async) ---")
+            with self.metrics.stage('verify'):
+                final_data = await self._step_verify(raw_data, interpreted_data)
+
+            succeeded = True
+            return self._finalize_result(final_data)
+        except CircuitOpenError:
+            # Прокси лежит — это не провал анализа: воркер его паркует (см. process_analysis_async)
+            raise
+        except Exception as e:
+            print(f"Pipeline failed: {e}")
+            if checkpoints:
+                raise
+            return None
+        finally:
+            self._finish_metrics(succeeded)
+
+    async def _load_checkpoint(self, checkpoints, stage: str):
+        return await sync_to_async(checkpoints.load)(stage) if checkpoints else None
+
+    async def _save_checkpoint(self, checkpoints, stage: str, data):
+        if checkpoints:
+            await sync_to_async(checkpoints.save)(stage, data)
+
+    async def _step_extract(self, file_path: str):
+        digest, cached = await asyncio.to_thread(self._lookup_extraction_cache, file_path)
+        if cached is not None:
+            return cached
+
+        text = await asyncio.to_thread(self._read_text_layer, file_path)
+        if text is not None:
+            raw_data = await self._extract_text(text)
+            await asyncio.to_thread(self._store_extraction, digest, raw_data)
+            return raw_data
+
+        # Страницы уже сжаты в JPEG/WebP, так что держать их списком недорого
+        self.page_hashes, self.reused_pages = [], []
+        image_parts = await asyncio.to_thread(self._get_image_content, file_path)
+        if self.extract_mode == 'per_page' and len(image_parts) > 1:
+            semaphore = asyncio.Semaphore(max(1, self.extract_workers))
+
+            async def extract_page(part):
+                async with semaphore:
+                    return await self._extract_images([part])
+
+            new_pages = list(await asyncio.gather(*(extract_page(part) for part in image_parts)))
+        else:
+            new_pages = [await self._extract_images(image_parts)] if image_parts else []
+        self._report_upload_stats()
+        await asyncio.to_thread(self._remember_pages, new_pages)
+        raw_data = self._combine_pages(new_pages)
+
+        await asyncio.to_thread(self._store_extraction, digest, raw_data)
+        return raw_data
+
+    async def _extract_text(self, text: str):
+        return await self._call_structured(prompt=self._build_text_extract_prompt(text), stage='extract')
+
+    async def _extract_images(self, image_parts):
+        return await self._call_structured(prompt=EXTRACTOR_SYSTEM_PROMPT, image_parts=image_parts, stage='extract')
+
+    async def _step_interpret(self, raw_data: dict, patient_context: str = None):
+        shards = self._interpret_shards(raw_data)
+        if shards:
+            return await self._interpret_sharded(raw_data, patient_context, shards)
+        prompt = self._build_interpret_prompt(raw_data, patient_context)
+        return await self._call_structured(prompt=prompt, schema=AIResultSchema, stage='interpret')
+
+    async def _interpret_sharded(self, raw_data: dict, patient_context, shards):
+        semaphore = asyncio.Semaphore(max(1, self.interpret_workers))
+
+        async def interpret_shard(categories, rows):
+            async with semaphore:
+                prompt = self._build_shard_prompt(raw_data, patient_context, categories, rows)
+                return await self._call_structured(prompt=prompt, schema=InterpretationShardSchema, stage='interpret')
+
+        merged = merge_shards(await asyncio.gather(*(interpret_shard(*shard) for shard in shards)))
+        prompt = self._build_summary_prompt(merged, patient_context)
+        summary = await self._call_structured(prompt=prompt, schema=InterpretationSummarySchema, stage='interpret')
+        return self._merge_interpretation(merged, summary)
+
+    async def _step_verify(self, raw_data: dict, interpreted_data):
+        issues = self._local_verification(raw_data, interpreted_data)
+        if issues is None:
+            return interpreted_data
+        prompt = self._build_verify_prompt(raw_data, interpreted_data, issues)
+        patch = await self._call_structured(prompt=prompt, schema=VerificationPatchSchema, stage='verify')
+        return self._apply_verification(raw_data, interpreted_data, patch)
+
+
+# ==========================================
+# ОЧЕРЕДЬ И ВОРКЕР
+# ==========================================
+
+# Отложенные анализы (ретраи) ждут в sorted set, score — когда вернуть их в очередь.
+# В отличие от таймера в памяти, они переживают рестарт воркера
+_RELEASE_DUE_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, item in ipairs(items) do
+    redis.call('ZREM', KEYS[1], item)
+    redis.call('RPUSH', KEYS[2], item)
+end
+return #items
+"""
+
+
+def _delayed_queue() -> str:
+    return f"{settings.ANALYSIS_ASYNC_QUEUE}:delayed"
+
+
+def push_to_async_queue(analysis_uid, retry_counts=None, countdown=0, park_token=None):
+    """Аналог process_analysis_task.delay / apply_async(countdown=...) для asyncio-воркера"""
+    conn = redis.Redis.from_url(settings.ANALYSIS_ASYNC_QUEUE_URL)
+    item = {'uid': str(analysis_uid), 'retry_counts': retry_counts or {}}
+    if park_token:
+        item['park_token'] = park_token
+    payload = json.dumps(item)
+    if countdown:
+        conn.zadd(_delayed_queue(), {payload: time.time() + countdown})
+    else:
+        conn.rpush(settings.ANALYSIS_ASYNC_QUEUE, payload)
+
+
+def _parse_queue_item(raw):
+    """Элемент очереди -> (uid, счетчики ретраев, park_token). В старых элементах лежит просто uid"""
+    text = raw.decode() if isinstance(raw, bytes) else raw
+    try:
+        item = json.loads(text)
+    except ValueError:
+        return text, {}, None
+    if not isinstance(item, dict):
+        return text, {}, None
+    return item.get('uid'), item.get('retry_counts') or {}, item.get('park_token')
+
+
+def _start_analysis(analysis_uid):
+    close_old_connections()
+    analysis = MedicalAnalysis.objects.select_related('patient', 'user').filter(uid=analysis_uid).first()
+    if not analysis:
+        return None, None
+    if analysis.status in (MedicalAnalysis.Status.COMPLETED, MedicalAnalysis.Status.FAILED):
+        # Устаревший элемент очереди: анализ уже довел другой прогон
+        print(f"⏭️ Анализ {analysis_uid} уже {analysis.status}, пропускаем")
+        return None, None
+    if analysis.status != MedicalAnalysis.Status.PROCESSING:
+        analysis.status = MedicalAnalysis.Status.PROCESSING
+        analysis.save(update_fields=['status'])
+    return analysis, build_patient_context(analysis)
+
+
+def _save_metrics(analysis, pipeline):
+    try:
+        save_pipeline_metrics(analysis, pipeline.metrics)
+    except Exception as e:
+        print(f"⚠️ Error saving pipeline metrics: {e}")
+
+
+def _finish_analysis(analysis, result, pipeline):
+    from core.tasks import trigger_next_analysis
+
+    _save_metrics(analysis, pipeline)
+    try:
+        completed = apply_pipeline_result(analysis, result)
+        # Готов или попытки исчерпаны — чекпоинты больше не нужны
+        AnalysisCheckpoints(analysis).clear()
+        print(f"{'✅' if completed else '❌'} Async pipeline finished for {analysis.uid}")
+    finally:
+        # Цепочка пользователя продолжается в любом случае
+        trigger_next_analysis(analysis)
+
+
+def _park_analysis(analysis, pipeline):
+    from core.tasks import park_analysis
+
+    _save_metrics(analysis, pipeline)
+    park_analysis(analysis)
+
+
+async def process_analysis_async(analysis_uid, retry_counts=None, park_token=None):
+    print(f"🔄 Async pipeline started for Analysis ID: {analysis_uid}")
+    # Один прогон на анализ, как у Celery-задачи (см. AnalysisClaim)
+    claim = get_analysis_claim(analysis_uid)
+    if not await asyncio.to_thread(claim.acquire, park_token):
+        print(f"⏭️ Анализ {analysis_uid} уже в работе или ждет своей отложенной задачи, пропускаем")
+        return
+    try:
+        await _process_analysis_async(analysis_uid, retry_counts, claim)
+    finally:
+        await asyncio.to_thread(claim.release)
+
+
+async def _process_analysis_async(analysis_uid, retry_counts, claim):
+    analysis, patient_context = await sync_to_async(_start_analysis)(analysis_uid)
+    if analysis is None:
+        print(f"⚠️ Анализ {analysis_uid} не найден или уже обработан, пропускаем")
+        return
+
+    result = None
+    pipeline = AsyncAnalysisPipeline()
+    try:
+        # Этапы сохраняются в чекпоинты: анализ, вернувшийся в очередь, продолжит с упавшего этапа
+        result = await pipeline.run_pipeline(
+            analysis.file.path, patient_context,
+            checkpoints=AnalysisCheckpoints(analysis), fingerprints=PageFingerprints(analysis),
+        )
+    except CircuitOpenError as exc:
+        # Прокси лежит: анализ ждет в PENDING и возвращается в очередь, когда breaker можно проверить.
+        # Отложенная очередь в Redis переживет рестарт воркера; число парковок ограничено
+        counts, countdown = task_park(exc, retry_counts)
+        if countdown is not None:
+            print(f"🅿️ {exc}. Анализ {analysis_uid} вернется в очередь через {countdown}s")
+            await sync_to_async(_park_analysis)(analysis, pipeline)
+            park_token = await asyncio.to_thread(claim.park, countdown)
+            await asyncio.to_thread(push_to_async_queue, analysis_uid, counts, countdown, park_token)
+            return
+        print(f"❌ {exc}. Анализ {analysis_uid} припаркован {counts[exc.error_class] - 1} раз, сдаемся")
+    except Exception as exc:
+        # Как у Celery-задачи: временные сбои — обратно в очередь с паузой, в пределах лимита класса.
+        # Попытка для backoff — по сбоям, без парковок и ожиданий ключа
+        error_class, counts, countdown = task_retry(exc, retry_counts, counted_retries(retry_counts))
+        if countdown is not None:
+            print(f"⏳ [{error_class}] {exc}. Анализ {analysis_uid} вернется в очередь через {countdown}s "
+                  f"({error_class} {counts[error_class]})")
+            await sync_to_async(_save_metrics)(analysis, pipeline)
+            await asyncio.to_thread(push_to_async_queue, analysis_uid, counts, countdown)
+            return
+        print(f"❌ Error in async pipeline [{error_class}]: {exc}")
+    await sync_to_async(_finish_analysis)(analysis, result, pipeline)
+
+
+async def run_async_worker(concurrency: int = None):
+    """
+    Разбирает очередь анализов на одном event loop.
+    Одновременно в работе не больше concurrency анализов.
+    """
+    concurrency = concurrency or settings.ANALYSIS_ASYNC_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+    conn = aioredis.Redis.from_url(settings.ANALYSIS_ASYNC_QUEUE_URL)
+    release_due = conn.register_script(_RELEASE_DUE_SCRIPT)
+    running = set()
+
+    async def worker_slot(raw_item):
+        try:
+            await process_analysis_async(*_parse_queue_item(raw_item))
+        finally:
+            semaphore.release()
+
+    print(f"🚀 Async worker: очередь {settings.ANALYSIS_ASYNC_QUEUE}, параллельно до {concurrency} анализов")
+    try:
+        while True:
+            await semaphore.acquire()
+            # Отложенные анализы, чей срок подошел, — в общую очередь (атомарно, без дублей между воркерами)
+            await release_due(keys=[_delayed_queue(), settings.ANALYSIS_ASYNC_QUEUE], args=[time.time(), 100])
+            item = await conn.blpop([settings.ANALYSIS_ASYNC_QUEUE], timeout=5)
+            if not item:
+                semaphore.release()
+                continue
+            task = asyncio.create_task(worker_slot(item[1]))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        await conn.aclose()
+        print(f"🔌 Gemini client pool: {client_pool.stats()}")
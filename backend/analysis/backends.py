@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from django.conf import settings
+
+
+def _part_bytes(part) -> bytes:
+    """Байты одного элемента contents для ключа записи: текст, inline-картинка или PIL"""
+    if isinstance(part, str):
+        return part.encode()
+    inline = getattr(part, 'inline_data', None)
+    if inline is not None and getattr(inline, 'data', None):
+        return inline.data
+    if hasattr(part, 'tobytes'):
+        return part.tobytes()
+    return str(part).encode()
+
+
+def request_key(stage: str, model: str, contents, config) -> str:
+    """Стабильный ключ запроса: этап + модель + содержимое + схема ответа"""
+    h = hashlib.sha256(f"{stage}|{model}".encode())
+    for part in contents:
+        h.update(hashlib.sha256(_part_bytes(part)).digest())
+    schema = getattr(config, 'response_schema', None)
+    h.update(getattr(schema, '__name__', str(schema)).encode())
+    return h.hexdigest()
+
+
+class LiveBackend:
+    """Обычный вызов Gemini через genai.Client"""
+    name = 'live'
+
+    def generate(self, client, model, contents, config, stage=None):
+        return client.models.generate_content(model=model, contents=contents, config=config)
+
+    async def agenerate(self, client, model, contents, config, stage=None):
+        return await client.aio.models.generate_content(model=model, contents=contents, config=config)
+
+
+class RecordingBackend(LiveBackend):
+    """Live + сохраняет пары запрос/ответ в JSON-файлы для последующего replay"""
+    name = 'record'
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _save(self, model, contents, config, stage, response):
+        usage = getattr(response, 'usage_metadata', None)
+        key = request_key(stage, model, contents, config)
+        record = {
+            'stage': stage,
+            'model': model,
+            'key': key,
+            'text': response.text,
+            'usage': {
+                'prompt_token_count': getattr(usage, 'prompt_token_count', None),
+                'candidates_token_count': getattr(usage, 'candidates_token_count', None),
+                'total_token_count': getattr(usage, 'total_token_count', None),
+            },
+        }
+        path = self.directory / f"{stage or 'other'}_{key[:16]}.json"
+        path.write_text(json.dumps(record, ensure_ascii=False), encoding='utf-8')
+
+    def generate(self, client, model, contents, config, stage=None):
+        response = super().generate(client, model, contents, config, stage)
+        self._save(model, contents, config, stage, response)
+        return response
+
+    async def agenerate(self, client, model, contents, config, stage=None):
+        response = await super().agenerate(client, model, contents, config, stage)
+        await asyncio.to_thread(self._save, model, contents, config, stage, response)
+        return response
+
+
+class ReplayBackend:
+    """
+    Отдает записанные ответы без сети: для нагрузочных тестов и профилирования.
+    Точное совпадение ищется по ключу запроса; если его нет — берется любая запись
+    того же этапа (по кругу), чтобы гонять синтетические анализы на любых файлах.
+    Умеет добавлять задержку и случайные 429 / 5xx.
+    """
+    name = 'replay'
+
+    def __init__(self, directory, latency=0.0, jitter=0.0, rate_429=0.0, rate_5xx=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._by_key = {}
+        self._by_stage = {}
+        self._cursor = {}
+        for path in sorted(Path(directory).glob('*.json')):
+            record = json.loads(path.read_text(encoding='utf-8'))
+            self._by_key[record['key']] = record
+            self._by_stage.setdefault(record.get('stage'), []).append(record)
+        print(f"📼 Replay backend: {len(self._by_key)} записей из {directory}")
+
+    def _pick(self, model, contents, config, stage):
+        record = self._by_key.get(request_key(stage, model, contents, config))
+        if record:
+            return record
+        with self._lock:
+            records = self._by_stage.get(stage)
+            if not records:
+                raise Exception(f"Replay: нет записей для этапа {stage!r}")
+            idx = self._cursor.get(stage, 0)
+            self._cursor[stage] = idx + 1
+            return records[idx % len(records)]
+
+    def _delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _maybe_fail(self):
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.rate_429:
+            raise Exception("429 RESOURCE_EXHAUSTED (replay: injected quota error)")
+        if roll < self.rate_429 + self.rate_5xx:
+            raise Exception("503 UNAVAILABLE (replay: injected server error)")
+
+    def _response(self, record, config):
+        schema = getattr(config, 'response_schema', None)
+        try:
+            parsed = schema.model_validate_json(record['text']) if schema else None
+        except ValueError:
+            # Как и SDK: кривой JSON -> parsed=None, текст остается для локальной починки
+            parsed = None
+        return SimpleNamespace(
+            text=record['text'],
+            parsed=parsed,
+            usage_metadata=SimpleNamespace(**record.get('usage', {})),
+        )
+
+    def generate(self, client, model, contents, config, stage=None):
+        time.sleep(self._delay())
+        self._maybe_fail()
+        return self._response(self._pick(model, contents, config, stage), config)
+
+    async def agenerate(self, client, model, contents, config, stage=None):
+        await asyncio.sleep(self._delay())
+        self._maybe_fail()
+        return self._response(self._pick(model, contents, config, stage), config)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_llm_backend():
+    """Бэкенд модели на процесс: ANALYSIS_LLM_BACKEND = live | record | replay"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            mode = getattr(settings, 'ANALYSIS_LLM_BACKEND', 'live')
+            directory = settings.ANALYSIS_LLM_RECORDINGS_DIR
+            if mode == 'record':
+                _backend = RecordingBackend(directory)
+            elif mode == 'replay':
+                _backend = ReplayBackend(
+                    directory,
+                    latency=settings.ANALYSIS_REPLAY_LATENCY,
+                    jitter=settings.ANALYSIS_REPLAY_JITTER,
+                    rate_429=settings.ANALYSIS_REPLAY_429_RATE,
+                    rate_5xx=settings.ANALYSIS_REPLAY_5XX_RATE,
+                )
+            else:
+                _backend = LiveBackend()
+        return _backend
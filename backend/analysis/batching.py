@@ -0,0 +1,71 @@
+import os
+from pathlib import Path
+
+from django.conf import settings
+
+from core.models import MedicalAnalysis
+
+from .checkpoints import AnalysisCheckpoints
+
+
+def _is_small_photo(analysis) -> bool:
+    """В пакет берем только одиночные фото (не PDF) не больше ANALYSIS_BATCH_MAX_FILE_MB"""
+    max_bytes = getattr(settings, 'ANALYSIS_BATCH_MAX_FILE_MB', 3) * 1024 * 1024
+    try:
+        path = analysis.file.path
+        return Path(path).suffix.lower() != '.pdf' and os.path.getsize(path) <= max_bytes
+    except (OSError, ValueError):
+        return False
+
+
+def batch_candidates(analysis) -> list:
+    """
+    Анализ + ожидающие анализы того же пользователя, которые можно извлечь одним запросом:
+    маленькие фото без готового чекпоинта извлечения, не больше ANALYSIS_BATCH_MAX_DOCS.
+    """
+    max_docs = getattr(settings, 'ANALYSIS_BATCH_MAX_DOCS', 5)
+    if not analysis.user_id or max_docs < 2 or not _is_small_photo(analysis):
+        return [analysis]
+
+    pending = MedicalAnalysis.objects.filter(
+        user_id=analysis.user_id,
+        status=MedicalAnalysis.Status.PENDING,
+    ).exclude(uid=analysis.uid).exclude(
+        checkpoints__stage='extract'
+    ).order_by('created_at')[:max_docs * 2]
+
+    batch = [analysis]
+    for candidate in pending:
+        if len(batch) >= max_docs:
+            break
+        if _is_small_photo(candidate):
+            batch.append(candidate)
+    return batch
+
+
+def prefetch_batch_extraction(pipeline, analysis, checkpoints) -> bool:
+    """
+    Пакетный режим: извлекает анализ вместе с соседями по очереди пользователя одним запросом
+    и раскладывает результаты в чекпоинты 'extract' каждого. Когда до соседа дойдет очередь,
+    его пайплайн начнет сразу с интерпретации. При неудаче ничего не пишет — каждый анализ
+    извлекается своим запросом, как обычно.
+    """
+    if not getattr(settings, 'ANALYSIS_BATCH_EXTRACT', False):
+        return False
+    if checkpoints.load('extract') is not None:
+        return False
+
+    batch = batch_candidates(analysis)
+    if len(batch) < 2:
+        return False
+
+    print(f"📦 Пакетное извлечение: {[str(a.uid) for a in batch]}")
+    with pipeline.metrics.stage('extract'):
+        documents = pipeline.extract_batch([a.file.path for a in batch])
+    if documents is None:
+        return False
+
+    checkpoints.save('extract', documents[0])
+    for sibling, raw_data in zip(batch[1:], documents[1:]):
+        AnalysisCheckpoints(sibling).save('extract', raw_data)
+    return True
@@ -0,0 +1,149 @@
+import hashlib
+import threading
+import uuid
+
+import redis
+from django.conf import settings
+
+
+# Удаляет ключ пробы, только если в нем токен этого вызова (чужую пробу не трогаем)
+_RELEASE_PROBE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class CircuitBreaker:
+    """
+    Общий для всех воркеров circuit breaker на endpoint модели (состояние в Redis, как у KeyPool).
+
+    closed — вызовы идут; ошибки прокси (5xx, таймауты, сеть) считаются в окне window секунд.
+    open — после threshold ошибок в окне: open_seconds вызовов нет, задачи паркуются.
+    half-open — после open пропускается один пробный вызов (allow выдает ему токен): успех
+    именно этого вызова закрывает breaker, ошибка прокси снова открывает, прочие ошибки (429, 400)
+    освобождают пробу для следующего вызова. Результаты остальных вызовов на состояние
+    half-open не влияют. Если Redis недоступен — breaker не мешает вызовам.
+    """
+    PREFIX = 'analysis:breaker:'
+    # Сколько ждать, пока чужой пробный вызов в half-open не закончится
+    PROBE_WAIT = 5
+
+    def __init__(self, endpoint: str, redis_url: str, threshold: int = 5, window: int = 60,
+                 open_seconds: int = 60, probe_timeout: int = 120):
+        self.endpoint = endpoint
+        self.endpoint_id = hashlib.sha256(endpoint.encode()).hexdigest()[:12]
+        self.threshold = threshold
+        self.window = window
+        self.open_seconds = open_seconds
+        self.probe_timeout = probe_timeout
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=1, socket_connect_timeout=1)
+
+    def _key(self, name: str) -> str:
+        return f'{self.PREFIX}{self.endpoint_id}:{name}'
+
+    def allow(self):
+        """
+        (пауза, токен пробы). Пауза 0 — можно звать модель, иначе через сколько секунд breaker
+        стоит проверить снова. Токен есть только у пробного вызова в half-open — его нужно
+        передать в record_success / record_failure / release_probe
+        """
+        try:
+            open_ms = self.redis.pttl(self._key('open'))
+            if open_ms and open_ms > 0:
+                return open_ms / 1000, None
+            if not self.redis.exists(self._key('half_open')):
+                return 0, None
+            # half-open: пробный вызов делает только один воркер
+            probe = uuid.uuid4().hex
+            if self.redis.set(self._key('probe'), probe, nx=True, ex=self.probe_timeout):
+                print(f"🩺 Breaker {self.endpoint}: пробный вызов")
+                return 0, probe
+            return self.PROBE_WAIT, None
+        except redis.RedisError as e:
+            print(f"⚠️ Breaker: Redis недоступен ({e}), вызовы не ограничиваем")
+            return 0, None
+
+    def _end_probe(self, probe) -> bool:
+        """True — проба этого вызова еще была за ним (и теперь снята)"""
+        return bool(probe) and bool(self.redis.eval(_RELEASE_PROBE_SCRIPT, 1, self._key('probe'), probe))
+
+    def record_success(self, probe=None):
+        """Закрывает breaker только успех пробного вызова; обычные успехи счетчик ошибок не сбрасывают"""
+        try:
+            if self._end_probe(probe):
+                self.redis.delete(self._key('half_open'), self._key('failures'))
+                print(f"✅ Breaker {self.endpoint}: закрыт")
+        except redis.RedisError:
+            pass
+
+    def record_failure(self, probe=None):
+        try:
+            if probe is not None:
+                if self._end_probe(probe):
+                    self._trip('пробный вызов не прошел')
+                return
+            if self.redis.exists(self._key('half_open')):
+                # Открыт или ждет пробы: ошибки вызовов, начатых до открытия, не считаем
+                return
+            failures = self.redis.incr(self._key('failures'))
+            if failures == 1:
+                # Окно отсчитывается от первой ошибки
+                self.redis.expire(self._key('failures'), self.window)
+            if failures >= self.threshold:
+                self._trip(f"{failures} ошибок за {self.window}s")
+        except redis.RedisError:
+            pass
+
+    def release_probe(self, probe=None):
+        """Проба кончилась ошибкой, которую breaker не считает (прокси ответил): слот — следующему вызову"""
+        try:
+            self._end_probe(probe)
+        except redis.RedisError:
+            pass
+
+    def _trip(self, reason: str):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self._key('open'), 1, ex=self.open_seconds)
+        # half_open живет дольше open: после паузы ждем пробного вызова
+        pipe.set(self._key('half_open'), 1, ex=self.open_seconds * 10)
+        pipe.delete(self._key('failures'), self._key('probe'))
+        pipe.execute()
+        print(f"🔌 Breaker {self.endpoint}: открыт на {self.open_seconds}s ({reason})")
+
+    def stats(self) -> dict:
+        try:
+            return {
+                'open_s': max(0, (self.redis.pttl(self._key('open')) or 0) / 1000),
+                'half_open': bool(self.redis.exists(self._key('half_open'))),
+                'failures': int(self.redis.get(self._key('failures')) or 0),
+            }
+        except redis.RedisError as e:
+            return {'error': str(e)}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint: str):
+    """
+    Breaker на endpoint в процессе; None — выключен (ANALYSIS_BREAKER=False).
+    В replay выключен всегда: искусственные 5xx не должны открывать breaker боевых воркеров
+    """
+    if not getattr(settings, 'ANALYSIS_BREAKER', True):
+        return None
+    if getattr(settings, 'ANALYSIS_LLM_BACKEND', 'live') == 'replay':
+        return None
+    endpoint = endpoint or 'default'
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(
+                endpoint,
+                redis_url=settings.GEMINI_KEY_POOL_URL,
+                threshold=getattr(settings, 'ANALYSIS_BREAKER_THRESHOLD', 5),
+                window=getattr(settings, 'ANALYSIS_BREAKER_WINDOW', 60),
+                open_seconds=getattr(settings, 'ANALYSIS_BREAKER_OPEN_SECONDS', 60),
+            )
+        return _breakers[endpoint]
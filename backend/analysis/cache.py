@@ -0,0 +1,140 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+
+
+def file_digest(file_path: str) -> str:
+    """SHA-256 содержимого файла. Читаем кусками, чтобы не держать весь файл в памяти"""
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Кэш результатов Stage 1 (OCR) по SHA-256 загруженного файла.
+
+    Два уровня:
+    - L1: LRU в памяти процесса (max_entries + TTL);
+    - L2: Redis (если задан redis_url) — общий для всех воркеров, как KeyPool и breaker.
+      Без него повторная загрузка под Celery prefork почти всегда попадает в другой процесс и промахивается.
+    Если Redis недоступен — работаем только с L1.
+    """
+    KEY_PREFIX = 'analysis:extract:'
+
+    def __init__(self, max_entries: int = 256, ttl: int = None, redis_url: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl or None  # 0 / None — записи не протухают
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=1, socket_connect_timeout=1) if redis_url else None
+        self._data = OrderedDict()  # digest -> (expires_at, data)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, digest: str):
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._data.get(digest)
+            if entry is not None:
+                expires_at, data = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(digest)
+                    self.hits += 1
+                    return copy.deepcopy(data)
+                # Протухла — выкидываем
+                del self._data[digest]
+
+        data = self._get_shared(digest)
+        if data is not None:
+            self._store_local(digest, data)
+            with self._lock:
+                self.shared_hits += 1
+            return copy.deepcopy(data)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, digest: str, data: dict):
+        if not self.enabled or not data:
+            return
+        self._store_local(digest, copy.deepcopy(data))
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(self.KEY_PREFIX + digest, json.dumps(data, ensure_ascii=False), ex=self.ttl)
+        except (redis.RedisError, TypeError, ValueError) as e:
+            print(f"⚠️ Extraction cache: не удалось записать в Redis ({e})")
+
+    def _get_shared(self, digest: str):
+        if self.redis is None:
+            return None
+        try:
+            raw = self.redis.get(self.KEY_PREFIX + digest)
+            return json.loads(raw) if raw else None
+        except (redis.RedisError, ValueError) as e:
+            print(f"⚠️ Extraction cache: Redis недоступен ({e}), только локальный кэш")
+            return None
+
+    def _store_local(self, digest: str, data: dict):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[digest] = (expires_at, data)
+            self._data.move_to_end(digest)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'entries': len(self._data),
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.shared_hits) / lookups, 3) if lookups else 0.0,
+            }
+
+
+_extraction_cache = None
+
+
+def get_extraction_cache() -> ExtractionCache:
+    """Один кэш на процесс воркера (создается лениво, когда settings уже загружены)"""
+    global _extraction_cache
+    if _extraction_cache is None:
+        shared = getattr(settings, 'ANALYSIS_EXTRACT_CACHE_SHARED', True)
+        _extraction_cache = ExtractionCache(
+            max_entries=getattr(settings, 'ANALYSIS_EXTRACT_CACHE_SIZE', 256),
+            ttl=getattr(settings, 'ANALYSIS_EXTRACT_CACHE_TTL', None),
+            redis_url=getattr(settings, 'ANALYSIS_EXTRACT_CACHE_URL', settings.GEMINI_KEY_POOL_URL) if shared else None,
+        )
+    return _extraction_cache
+
+
+def reset_extraction_cache():
+    """Забывает кэш процесса: следующий get_extraction_cache() создаст его по текущим settings"""
+    global _extraction_cache
+    _extraction_cache = None
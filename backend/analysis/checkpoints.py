@@ -0,0 +1,23 @@
+from .models import PipelineCheckpoint
+
+
+class AnalysisCheckpoints:
+    """Хранилище результатов этапов для одного анализа (передается в run_pipeline)"""
+
+    def __init__(self, analysis):
+        self.analysis = analysis
+
+    def load(self, stage: str):
+        return PipelineCheckpoint.objects.filter(
+            analysis=self.analysis, stage=stage
+        ).values_list('data', flat=True).first()
+
+    def save(self, stage: str, data):
+        if hasattr(data, 'model_dump'):
+            data = data.model_dump()
+        PipelineCheckpoint.objects.update_or_create(
+            analysis=self.analysis, stage=stage, defaults={'data': data}
+        )
+
+    def clear(self):
+        PipelineCheckpoint.objects.filter(analysis=self.analysis).delete()
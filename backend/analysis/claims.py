@@ -0,0 +1,86 @@
+import threading
+import uuid
+
+import redis
+from django.conf import settings
+
+# Удаляет ключ, только если в нем наш токен (чужой захват не трогаем)
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class AnalysisClaim:
+    """
+    Кто сейчас отвечает за анализ (состояние в Redis пула ключей, как у CircuitBreaker).
+
+    run — идет прогон: вторая задача того же анализа не стартует, пока первая не отпустит захват.
+    parked — анализ припаркован (breaker открыт) и за ним уже запланирована задача с park_token:
+    остальные постановки в очередь (trigger_next_analysis, загрузка) его не запускают.
+    Если Redis недоступен — не мешаем, как и breaker.
+    """
+    PREFIX = 'analysis:claim:'
+    # Сколько ждать отложенную задачу сверх ее countdown, прежде чем считать парковку потерянной
+    PARK_GRACE = 300
+
+    def __init__(self, analysis_uid, client, run_ttl: int = 900):
+        self.analysis_uid = str(analysis_uid)
+        self.redis = client
+        self.run_ttl = run_ttl
+        self.token = uuid.uuid4().hex
+
+    def _key(self, name: str) -> str:
+        return f'{self.PREFIX}{self.analysis_uid}:{name}'
+
+    def acquire(self, park_token: str = None) -> bool:
+        """
+        True — задача может вести анализ. False — он уже в работе или ждет своей отложенной
+        задачи (а эта задача — не она)
+        """
+        try:
+            parked = self.redis.get(self._key('parked'))
+            if parked is not None and parked.decode() != park_token:
+                return False
+            if not self.redis.set(self._key('run'), self.token, nx=True, ex=self.run_ttl):
+                return False
+            if parked is not None:
+                self.redis.delete(self._key('parked'))
+            return True
+        except redis.RedisError as e:
+            print(f"⚠️ AnalysisClaim: Redis недоступен ({e}), дубли задач не отсекаем")
+            return True
+
+    def release(self):
+        """Отпускает прогон (только свой). Перед self.retry / парковкой и в конце задачи"""
+        try:
+            self.redis.eval(_RELEASE_SCRIPT, 1, self._key('run'), self.token)
+        except redis.RedisError:
+            pass
+
+    def park(self, countdown: float) -> str:
+        """Паркует анализ до отложенной задачи; ее park_token нужно передать в задачу"""
+        park_token = uuid.uuid4().hex
+        try:
+            self.redis.set(self._key('parked'), park_token, ex=int(countdown) + self.PARK_GRACE)
+        except redis.RedisError:
+            pass
+        self.release()
+        return park_token
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_analysis_claim(analysis_uid) -> AnalysisClaim:
+    """Захват анализа; Redis-соединение одно на процесс"""
+    url = settings.GEMINI_KEY_POOL_URL
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+    # Прогон не дольше бюджета пайплайна; захват переживает его с запасом, а не навсегда
+    budget = getattr(settings, 'ANALYSIS_PIPELINE_BUDGET', 0) or 3600
+    return AnalysisClaim(analysis_uid, _clients[url], run_ttl=budget + AnalysisClaim.PARK_GRACE)
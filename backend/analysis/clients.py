@@ -0,0 +1,47 @@
+import threading
+
+from google import genai
+
+
+class ClientPool:
+    """
+    Пул genai.Client на процесс: один клиент на пару (API key, base_url).
+    Клиент держит свой HTTP-пул соединений, поэтому все этапы пайплайна и все задачи
+    в этом воркере переиспользуют уже открытые TLS-соединения до прокси.
+    """
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def get(self, api_key: str, base_url: str = None) -> genai.Client:
+        pool_key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(pool_key)
+            if client is not None:
+                self.reused += 1
+                return client
+
+            http_options = {'base_url': base_url} if base_url else None
+            client = genai.Client(api_key=api_key, http_options=http_options)
+            self._clients[pool_key] = client
+            self.created += 1
+            return client
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.created + self.reused
+            return {
+                'clients': len(self._clients),
+                'created': self.created,
+                'reused': self.reused,
+                'reuse_rate': round(self.reused / total, 3) if total else 0.0,
+            }
+
+
+client_pool = ClientPool()
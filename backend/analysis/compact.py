@@ -0,0 +1,96 @@
+import json
+
+from .verification import _as_dict, _match_rows
+
+# Компактный формат между этапами: показатели — таблицей с ID строк,
+# без raw_text экстрактора и без reasoning интерпретатора.
+RAW_COLUMNS = ('name', 'value', 'unit', 'ref_range')
+# Верификатор возвращает только правки, поэтому comment / description / recommendations ему не нужны
+INTERPRETED_COLUMNS = ('name', 'value', 'unit', 'ref_range', 'status', 'category')
+CAUSE_COLUMNS = ('severity', 'title')
+
+
+def _cell(value) -> str:
+    if value is None:
+        return ''
+    # "|" и переносы строк ломают таблицу
+    return ' '.join(str(value).replace('|', '/').split())
+
+
+def indicator_table(rows, columns, prefix: str, extra=None) -> str:
+    """
+    Показатели одной таблицей: шапка + строка на показатель с ID (r1, r2 ... / i1, i2 ...).
+    extra — дополнительная колонка в начале строки: (название, список значений).
+    """
+    header = ['id'] + ([extra[0]] if extra else []) + list(columns)
+    lines = ['|'.join(header)]
+    for idx, row in enumerate(rows or []):
+        cells = [f"{prefix}{idx + 1}"]
+        if extra:
+            cells.append(_cell(extra[1][idx]))
+        cells.extend(_cell(row.get(column)) for column in columns)
+        lines.append('|'.join(cells))
+    return '\n'.join(lines)
+
+
+def _metadata(data: dict, sections) -> str:
+    parts = []
+    for section in sections:
+        value = data.get(section)
+        if value:
+            parts.append(f"{section}: {json.dumps(value, ensure_ascii=False, separators=(',', ':'))}")
+    return '\n'.join(parts)
+
+
+def compact_extraction(raw_data: dict) -> str:
+    """RAW-извлечение для интерпретатора/верификатора: метаданные + таблица показателей"""
+    raw_data = raw_data or {}
+    parts = [
+        _metadata(raw_data, ('patient_info', 'lab_metadata')),
+        "ПОКАЗАТЕЛИ:",
+        indicator_table(raw_data.get('indicators'), RAW_COLUMNS, 'r'),
+    ]
+    return '\n'.join(part for part in parts if part)
+
+
+def compact_interpretation(raw_data: dict, interpreted_data) -> str:
+    """
+    Заключение для верификатора: таблица показателей со ссылкой на строку исходника (src),
+    таблица причин и summary. reasoning, комментарии и рекомендации не передаются.
+    """
+    raw_rows = (raw_data or {}).get('indicators') or []
+    result = _as_dict(interpreted_data)
+    rows = result.get('indicators') or []
+
+    raw_ids = {id(raw): f"r{idx + 1}" for idx, raw in enumerate(raw_rows)}
+    pairs, _, _ = _match_rows(raw_rows, rows)
+    src_by_row = {id(row): raw_ids[id(raw)] for raw, row in pairs}
+    sources = [src_by_row.get(id(row), '-') for row in rows]
+
+    parts = [
+        _metadata(result, ('summary',)),
+        "ПОКАЗАТЕЛИ:",
+        indicator_table(rows, INTERPRETED_COLUMNS, 'i', extra=('src', sources)),
+        "ПРИЧИНЫ:",
+        indicator_table(result.get('causes'), CAUSE_COLUMNS, 'c'),
+    ]
+    return '\n'.join(part for part in parts if part)
+
+
+def legacy_extraction(raw_data: dict) -> str:
+    """Старый формат (полный RAW JSON) — только для сравнения размера промпта"""
+    return json.dumps(raw_data, ensure_ascii=False)
+
+
+def legacy_interpretation(interpreted_data) -> str:
+    if hasattr(interpreted_data, 'model_dump_json'):
+        return interpreted_data.model_dump_json()
+    return json.dumps(interpreted_data, ensure_ascii=False)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка токенов без обращения к API (~4 байта UTF-8 на токен).
+    Годится для сравнения двух форматов между собой, а не для биллинга.
+    """
+    return (len(text.encode('utf-8')) + 3) // 4
@@ -0,0 +1,154 @@
+import random
+import re
+
+from django.conf import settings
+
+# Классы ошибок вызова модели (см. classify_error).
+# Ретраить имеет смысл только временные; 400 / auth / 404 повторами не лечатся
+RETRYABLE_CLASSES = {'rate_limit', 'server', 'timeout', 'network', 'deadline', 'other', 'key_wait'}
+# Паузы не из-за сбоя: ожидание свободного ключа пула (свой бюджет RPM/TPM, cooldown) и парковка.
+# Они не считаются попытками в общем лимите ретраев и в backoff
+WAIT_CLASSES = {'key_wait', 'circuit_open'}
+# Ошибки, которые говорят о состоянии самого прокси — их считает circuit breaker
+BREAKER_CLASSES = {'server', 'timeout', 'network'}
+
+_STATUS_RE = re.compile(r'^\s*(\d{3})\b')
+
+
+def _status_code(error):
+    """HTTP-статус из исключения SDK (genai: code, openai/anthropic: status_code) или из текста '503 UNAVAILABLE'"""
+    for value in (getattr(error, 'code', None), getattr(error, 'status_code', None),
+                  getattr(getattr(error, 'response', None), 'status_code', None)):
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    match = _STATUS_RE.match(str(error))
+    return int(match.group(1)) if match else None
+
+
+def classify_error(error) -> str:
+    """
+    Класс ошибки: rate_limit, server, timeout, network, deadline — временные;
+    bad_request (400, схема), auth (401/403, ключ), not_found — нет; other — прочее (кривой ответ и т.п.)
+    """
+    if isinstance(error, (LLMCallError, TransientLLMError)):
+        return error.error_class
+    if isinstance(error, PipelineDeadlineExceeded):
+        return 'deadline'
+    if isinstance(error, TimeoutError):
+        return 'timeout'
+    code = _status_code(error)
+    text = str(error).lower()
+    name = type(error).__name__
+    if code == 429 or 'exhausted' in text or 'quota' in text or 'rate limit' in text:
+        return 'rate_limit'
+    if code in (401, 403) or 'api key not valid' in text or 'permission_denied' in text or 'unauthenticated' in text:
+        return 'auth'
+    if code == 408 or 'Timeout' in name or 'timed out' in text or 'deadline_exceeded' in text:
+        return 'timeout'
+    if (code and code >= 500) or 'unavailable' in text or 'bad gateway' in text:
+        return 'server'
+    if code == 404:
+        return 'not_found'
+    if (code and 400 <= code < 500) or 'invalid_argument' in text:
+        return 'bad_request'
+    if isinstance(error, ConnectionError) or 'Connect' in name or 'Protocol' in name or 'connection' in text:
+        return 'network'
+    return 'other'
+
+
+class LLMCallError(Exception):
+    """
+    Вызов модели не удался: неретраибельная ошибка (сразу, без повторов) или исчерпан
+    лимит попыток ее класса (ANALYSIS_CALL_RETRY_LIMITS). error_class решает, ретраить ли задачу.
+    """
+
+    def __init__(self, stage: str, error_class: str, cause=None):
+        self.stage = stage or 'other'
+        self.error_class = error_class
+        self.cause = cause
+        super().__init__(f"{self.stage}: вызов модели не удался [{error_class}]: {cause}")
+
+    @property
+    def retryable(self) -> bool:
+        return self.error_class in RETRYABLE_CLASSES
+
+
+class TransientLLMError(Exception):
+    """
+    Временный сбой вызова модели (все ключи в cooldown, 5xx прокси), который выгоднее
+    переждать вне воркера: задача перепланируется через Celery с countdown, а не спит в time.sleep.
+    """
+
+    def __init__(self, stage: str, delay: float, cause=None):
+        self.stage = stage or 'other'
+        self.delay = delay
+        self.cause = cause
+        # Без причины — ждем свободный ключ пула (cooldown / свой бюджет RPM-TPM), это не 429 прокси
+        self.error_class = classify_error(cause) if cause is not None else 'key_wait'
+        # Заполняется задачей при перепланировании (см. retry_countdown)
+        self.countdown = None
+        super().__init__(f"{self.stage}: временный сбой модели, повтор не раньше чем через {delay:.0f}s ({cause})")
+
+
+class CircuitOpenError(TransientLLMError):
+    """
+    Circuit breaker прокси открыт: прокси массово отвечает 5xx / таймаутами.
+    Задача не ретраится, а паркуется в PENDING до закрытия breaker (см. core.tasks)
+    """
+
+    def __init__(self, stage: str, delay: float):
+        super().__init__(stage, delay, 'circuit breaker открыт')
+        self.error_class = 'circuit_open'
+
+
+class PipelineDeadlineExceeded(Exception):
+    """Исчерпан общий бюджет времени прогона (ANALYSIS_PIPELINE_BUDGET): новые вызовы модели не начинаем"""
+
+
+def retry_countdown(stage: str, min_delay: float, attempt: int) -> float:
+    """
+    Пауза перед ретраем задачи: экспоненциальный backoff от базовой задержки этапа
+    (ANALYSIS_RETRY_BASE_DELAY) + случайный jitter, чтобы ретраи разных анализов не совпадали.
+    Не меньше min_delay — времени, которое назвал сам сбой (cooldown ключа).
+    """
+    base = getattr(settings, 'ANALYSIS_RETRY_BASE_DELAY', {}).get(stage, 5)
+    backoff = min(base * 2 ** attempt, getattr(settings, 'ANALYSIS_RETRY_MAX_DELAY', 300))
+    return round(max(min_delay, backoff) + random.uniform(0, backoff / 2), 1)
+
+
+def counted_retries(retry_counts) -> int:
+    """Сколько было ретраев из-за сбоев — без ожиданий ключа и парковок (WAIT_CLASSES)"""
+    return sum(n for error_class, n in (retry_counts or {}).items() if error_class not in WAIT_CLASSES)
+
+
+def task_retry(error, retry_counts, attempt: int):
+    """
+    Ретраить ли задачу анализа (Celery или asyncio-воркер) после ошибки: лимит — по классу ошибки
+    (ANALYSIS_TASK_RETRY_LIMITS), 400 / auth не ретраятся совсем. attempt — сколько ретраев уже было.
+    Возвращает (класс, счетчики ретраев по классам с учетом этой ошибки, countdown);
+    countdown None — ретраить не нужно, анализ проваливается.
+    """
+    error_class = classify_error(error)
+    counts = dict(retry_counts or {})
+    counts[error_class] = counts.get(error_class, 0) + 1
+    limits = getattr(settings, 'ANALYSIS_TASK_RETRY_LIMITS', {})
+    limit = limits.get(error_class, 2) if error_class in RETRYABLE_CLASSES else 0
+    if counts[error_class] > limit:
+        return error_class, counts, None
+    if isinstance(error, TransientLLMError):
+        # Пауза, которую назвал сам сбой (cooldown ключа), + backoff этапа
+        return error_class, counts, retry_countdown(error.stage, error.delay, attempt)
+    return error_class, counts, 5 * (2 ** (counts[error_class] - 1))
+
+
+def task_park(error, retry_counts):
+    """
+    Парковка анализа при открытом breaker (CircuitOpenError): попытки классов не тратятся,
+    но число парковок ограничено ANALYSIS_MAX_PARKS — прокси может лежать часами.
+    Возвращает (счетчики с учетом этой парковки, countdown); countdown None — анализ проваливается.
+    """
+    counts = dict(retry_counts or {})
+    counts[error.error_class] = counts.get(error.error_class, 0) + 1
+    if counts[error.error_class] > getattr(settings, 'ANALYSIS_MAX_PARKS', 30):
+        return counts, None
+    return counts, error.countdown or retry_countdown(error.stage, error.delay, 0)
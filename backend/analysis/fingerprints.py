@@ -0,0 +1,47 @@
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import PageFingerprint
+
+
+class PageFingerprints:
+    """
+    Отпечатки страниц из прошлых загрузок владельца анализа (передается в run_pipeline,
+    как AnalysisCheckpoints). Совпадение — только побайтно та же страница (imaging.page_digest).
+    Анонимные анализы не дедуплицируются.
+    """
+
+    def __init__(self, analysis):
+        self.analysis = analysis
+        self.days = getattr(settings, 'ANALYSIS_PAGE_DEDUP_DAYS', 30)
+
+    @property
+    def enabled(self) -> bool:
+        return self.analysis.user_id is not None
+
+    def find(self, digest: str):
+        """Извлечение той же страницы из прошлой загрузки или None"""
+        if not self.enabled:
+            return None
+        since = timezone.now() - datetime.timedelta(days=self.days)
+        return (
+            PageFingerprint.objects.filter(user_id=self.analysis.user_id, digest=digest, created_at__gte=since)
+            .exclude(analysis=self.analysis)
+            .order_by('-created_at')
+            .values_list('extraction', flat=True)
+            .first()
+        )
+
+    def save(self, pages):
+        """pages — список (digest, извлечение страницы)"""
+        if not self.enabled or not pages:
+            return
+        # Ретрай Celery мог уже сохранить страницы этого анализа — перезаписываем
+        PageFingerprint.objects.filter(analysis=self.analysis).delete()
+        PageFingerprint.objects.bulk_create([
+            PageFingerprint(user_id=self.analysis.user_id, analysis=self.analysis, digest=digest, extraction=extraction)
+            for digest, extraction in pages
+            if isinstance(extraction, dict)
+        ])
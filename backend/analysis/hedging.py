@@ -0,0 +1,57 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .metrics import percentile
+
+
+class LatencyTracker:
+    """
+    Скользящее окно длительностей успешных вызовов модели по этапам (на процесс).
+    По нему решаем, когда вызов "завис" достаточно, чтобы отправить дубль (hedge).
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(stage or 'other', deque(maxlen=self.window)).append(seconds)
+
+    def hedge_delay(self, stage: str, q: float, min_samples: int):
+        """Через сколько секунд слать дубль: q-й перцентиль этапа, None — пока мало данных"""
+        with self._lock:
+            samples = list(self._samples.get(stage or 'other', ()))
+        if len(samples) < min_samples:
+            return None
+        return percentile(samples, q)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                stage: {'count': len(samples), 'p50_s': round(percentile(list(samples), 50), 2),
+                        'p95_s': round(percentile(list(samples), 95), 2)}
+                for stage, samples in self._samples.items()
+            }
+
+
+latency_tracker = LatencyTracker()
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def get_hedge_pool() -> ThreadPoolExecutor:
+    """Потоки для основного вызова и его дубля (sync-пайплайн), общие на процесс"""
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'ANALYSIS_HEDGE_THREADS', 16),
+                thread_name_prefix='llm-hedge',
+            )
+        return _hedge_pool
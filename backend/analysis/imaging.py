@@ -0,0 +1,141 @@
+import hashlib
+import io
+import re
+
+import PIL.Image
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+IMAGE_MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+
+# A4 в пунктах — если pdfinfo не отдал размер страницы
+DEFAULT_PAGE_SIZE_PTS = (595.0, 842.0)
+
+
+def _page_size_pts(info: dict):
+    """Разбирает 'Page size: 595.276 x 841.89 pts (A4)' из pdfinfo"""
+    match = re.search(r'([\d.]+)\s*x\s*([\d.]+)', str(info.get('Page size', '')))
+    if not match:
+        return DEFAULT_PAGE_SIZE_PTS
+    return float(match.group(1)), float(match.group(2))
+
+
+def _render_params(page_pts, dpi: int, max_side: int = None):
+    """
+    Возвращает (kwargs для convert_from_path, (ширина, высота) в пикселях).
+    Если страница при заданном DPI длиннее max_side — просим poppler сразу
+    отрисовать ее в max_side по длинной стороне (-scale-to), без лишних пикселей.
+    """
+    width = page_pts[0] / 72 * dpi
+    height = page_pts[1] / 72 * dpi
+    long_side = max(width, height)
+    if max_side and long_side > max_side:
+        scale = max_side / long_side
+        return {'size': max_side}, (int(width * scale), int(height * scale))
+    return {'dpi': dpi}, (int(width), int(height))
+
+
+def iter_pdf_pages(file_path: str, dpi: int = 200, max_side: int = None, grayscale: bool = False,
+                   memory_budget_mb: int = 128, thread_count: int = 1):
+    """
+    Генератор страниц PDF. Растеризуем пачками через first_page/last_page так,
+    чтобы несжатые пиксели одной пачки укладывались в memory_budget_mb.
+    Пиковая память не зависит от количества страниц в документе.
+    """
+    info = pdfinfo_from_path(file_path)
+    total_pages = int(info.get('Pages', 0) or 0)
+    if not total_pages:
+        return
+
+    render_kwargs, (width, height) = _render_params(_page_size_pts(info), dpi, max_side)
+    page_bytes = max(1, width * height * (1 if grayscale else 3))
+    chunk = max(1, int(memory_budget_mb * 1024 * 1024 // page_bytes))
+
+    for first_page in range(1, total_pages + 1, chunk):
+        last_page = min(total_pages, first_page + chunk - 1)
+        images = convert_from_path(
+            file_path,
+            first_page=first_page,
+            last_page=last_page,
+            grayscale=grayscale,
+            thread_count=max(1, min(thread_count, last_page - first_page + 1)),
+            **render_kwargs
+        )
+        while images:
+            # Отдаем страницу и сразу забываем ссылку на нее
+            yield images.pop(0)
+
+
+def load_photo(file_path: str, max_side: int = None, grayscale: bool = False):
+    """Фото с телефона: те же ограничения по размеру и цвету, что и у страниц PDF"""
+    image = PIL.Image.open(file_path)
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side))
+    if grayscale and image.mode != 'L':
+        image = image.convert('L')
+    return image
+
+
+def page_ink(image, sample_side: int = 1024, margin: float = 0.03) -> float:
+    """
+    Доля "чернил" на странице — пикселей заметно темнее фона — по уменьшенной ч/б копии.
+    Копия крупная, чтобы штрихи мелкого текста не размывались в серый; поля (margin с каждой
+    стороны) не считаем — у сканов там тени и края листа.
+    """
+    sample = image.convert('L') if image.mode != 'L' else image.copy()
+    sample.thumbnail((sample_side, sample_side))
+    dx, dy = int(sample.width * margin), int(sample.height * margin)
+    sample = sample.crop((dx, dy, sample.width - dx, sample.height - dy))
+    histogram = sample.histogram()
+    total = sum(histogram) or 1
+
+    # Фон — яркость, светлее которой 10% пикселей (у сканов фон серый, а не 255)
+    cumulative, background = 0, 255
+    for level in range(255, -1, -1):
+        cumulative += histogram[level]
+        if cumulative >= total * 0.1:
+            background = level
+            break
+    return sum(histogram[:max(0, background - 64)]) / total
+
+
+def is_blank_page(image, min_ink: float = 0.0001) -> bool:
+    """
+    Пустой лист / оборот скана: темных пикселей меньше min_ink. Порог — несколько символов:
+    даже одна строка результата дает на порядок больше, так что такие страницы не отбрасываются.
+    """
+    return page_ink(image) < min_ink
+
+
+def page_digest(image) -> str:
+    """
+    SHA-256 пикселей страницы (с размером и режимом). Совпадает только у побайтно одинаковых
+    страниц — например, того же PDF, загруженного повторно или в другой подборке. Перцептивный
+    хэш тут не годится: бланки одной лаборатории с разными значениями для него неразличимы.
+    """
+    h = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def compress_image(image, max_side: int = None, grayscale: bool = False, fmt: str = 'JPEG', quality: int = 80):
+    """
+    Готовит страницу к отправке в модель: уменьшает до max_side по длинной стороне,
+    переводит в ч/б и кодирует в JPEG/WebP с заданным качеством.
+    Возвращает (bytes, mime_type, pixel_bytes) — pixel_bytes это объем несжатых пикселей на входе.
+    """
+    fmt = fmt.upper()
+    pixel_bytes = image.width * image.height * len(image.getbands())
+
+    if max_side and max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side))
+    if grayscale:
+        if image.mode != 'L':
+            image = image.convert('L')
+    elif image.mode not in ('RGB', 'L'):
+        # JPEG не умеет альфу и палитру
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=quality, optimize=True)
+    return buffer.getvalue(), IMAGE_MIME_TYPES.get(fmt, 'application/octet-stream'), pixel_bytes
@@ -0,0 +1,201 @@
+import datetime
+import hashlib
+import re
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+import redis
+from django.conf import settings
+
+# Дневные квоты Gemini сбрасываются в полночь по тихоокеанскому времени
+QUOTA_RESET_TZ = ZoneInfo('America/Los_Angeles')
+
+
+def parse_retry_after(error) -> int:
+    """Достает из 429-ответа Gemini, через сколько секунд можно повторить (retryDelay: '37s')"""
+    err_str = str(error)
+    match = re.search(r"retry_?delay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", err_str, re.IGNORECASE)
+    if match:
+        return int(float(match.group(1))) + 1
+    if 'perday' in err_str.lower().replace(' ', '').replace('_', ''):
+        # Дневная квота — ключ отдыхает до полуночи по PT
+        now = datetime.datetime.now(QUOTA_RESET_TZ)
+        midnight = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return int((midnight - now).total_seconds()) + 1
+    return None
+
+
+class KeyPool:
+    """
+    Общий для всех воркеров планировщик API-ключей (состояние в Redis, там же где брокер Celery).
+
+    По каждому ключу в минутных бакетах считаются запросы, токены и 429-е,
+    плюс отдельный флаг cooldown до сброса квоты. На каждый вызов выдается
+    самый "здоровый" ключ: не в cooldown, с запасом по RPM/TPM (0 — без лимита) и с наименьшей долей 429.
+    Если Redis недоступен — деградируем до локального учета cooldown в процессе.
+    """
+    PREFIX = 'analysis:keys:'
+    BUCKET_TTL = 180
+
+    def __init__(self, api_keys, redis_url: str, rpm: int = 0, tpm: int = 0, cooldown: int = 60,
+                 prefix: str = None):
+        self.api_keys = list(api_keys)
+        # В Redis храним не сами ключи, а короткий хэш
+        self.key_ids = [hashlib.sha256(k.encode()).hexdigest()[:12] for k in self.api_keys]
+        self.rpm = rpm
+        self.tpm = tpm
+        self.cooldown = cooldown
+        self.prefix = prefix or self.PREFIX
+        self.redis = redis.Redis.from_url(redis_url, socket_timeout=1, socket_connect_timeout=1)
+        self._local_cooldowns = {}
+        self._lock = threading.Lock()
+
+    def _key(self, idx: int, name: str, bucket: int = None) -> str:
+        suffix = f':{bucket}' if bucket is not None else ''
+        return f'{self.prefix}{self.key_ids[idx]}:{name}{suffix}'
+
+    def acquire(self, exclude=()):
+        """
+        Возвращает (idx ключа, пауза в секундах). Пауза > 0 значит, что здоровых ключей нет
+        и выдан ключ, который освободится раньше остальных.
+        exclude — ключи, которые выдавать нельзя (ключ основного запроса при hedging). Тогда без
+        здорового ключа запрос в бюджете не резервируется, а если выбирать не из чего — (None, None).
+        """
+        candidates = [idx for idx in range(len(self.api_keys)) if idx not in exclude]
+        if not candidates:
+            return None, None
+        now = time.time()
+        minute = int(now // 60)
+        try:
+            return self._acquire_shared(now, minute, candidates, reserve_waiting=not exclude)
+        except redis.RedisError as e:
+            print(f"⚠️ KeyPool: Redis недоступен ({e}), работаем по локальным cooldown")
+            return self._acquire_local(now, candidates)
+
+    def _acquire_shared(self, now: float, minute: int, candidates, reserve_waiting: bool = True):
+        pipe = self.redis.pipeline(transaction=False)
+        for idx in candidates:
+            pipe.pttl(self._key(idx, 'cooldown'))
+            pipe.get(self._key(idx, 'req', minute))
+            pipe.get(self._key(idx, 'tok', minute))
+            pipe.get(self._key(idx, 'req', minute - 1))
+            pipe.get(self._key(idx, '429', minute))
+            pipe.get(self._key(idx, '429', minute - 1))
+        raw = pipe.execute()
+
+        best_idx, best_score = None, None
+        soonest_idx, soonest_wait = candidates[0], None
+        next_minute_wait = 60 - (now % 60)
+        for pos, idx in enumerate(candidates):
+            cooldown_ms, req, tok, prev_req, r429, prev_r429 = raw[pos * 6:(pos + 1) * 6]
+            req, tok = int(req or 0), int(tok or 0)
+            recent_req = req + int(prev_req or 0)
+            recent_429 = int(r429 or 0) + int(prev_r429 or 0)
+
+            wait = None
+            if cooldown_ms and cooldown_ms > 0:
+                wait = cooldown_ms / 1000
+            elif (self.rpm and req >= self.rpm) or (self.tpm and tok >= self.tpm):
+                wait = next_minute_wait
+
+            if wait is not None:
+                if soonest_wait is None or wait < soonest_wait:
+                    soonest_idx, soonest_wait = idx, wait
+                continue
+
+            # Без бюджета (0) нагрузку меряем запросами за минуту — ключи чередуются
+            load = max(req / self.rpm if self.rpm else req, tok / self.tpm if self.tpm else 0)
+            error_rate = recent_429 / (recent_req + recent_429) if recent_req + recent_429 else 0.0
+            score = load + 2 * error_rate
+            if best_score is None or score < best_score:
+                best_idx, best_score = idx, score
+
+        idx, wait = (best_idx, 0) if best_idx is not None else (soonest_idx, soonest_wait)
+        if wait and not reserve_waiting:
+            return idx, wait
+        # Резервируем запрос в бюджете ключа
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.incr(self._key(idx, 'req', minute))
+        pipe.expire(self._key(idx, 'req', minute), self.BUCKET_TTL)
+        pipe.execute()
+        return idx, wait
+
+    def _acquire_local(self, now: float, candidates):
+        with self._lock:
+            soonest_idx, soonest_until = candidates[0], None
+            for idx in candidates:
+                until = self._local_cooldowns.get(idx, 0)
+                if until <= now:
+                    return idx, 0
+                if soonest_until is None or until < soonest_until:
+                    soonest_idx, soonest_until = idx, until
+            return soonest_idx, soonest_until - now
+
+    def report_success(self, idx: int, tokens: int = 0):
+        if not tokens:
+            return
+        minute = int(time.time() // 60)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.incrby(self._key(idx, 'tok', minute), tokens)
+            pipe.expire(self._key(idx, 'tok', minute), self.BUCKET_TTL)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def report_rate_limited(self, idx: int, retry_after: int = None):
+        """Ключ получил 429: отправляем в cooldown до сброса квоты и учитываем в доле ошибок"""
+        cooldown = retry_after or self.cooldown
+        minute = int(time.time() // 60)
+        with self._lock:
+            self._local_cooldowns[idx] = time.time() + cooldown
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.set(self._key(idx, 'cooldown'), 1, ex=cooldown)
+            pipe.incr(self._key(idx, '429', minute))
+            pipe.expire(self._key(idx, '429', minute), self.BUCKET_TTL)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+        print(f"🧊 API KEY #{idx + 1} в cooldown на {cooldown}s")
+
+    def stats(self) -> dict:
+        """Текущее состояние ключей (для админки/отладки)"""
+        minute = int(time.time() // 60)
+        result = {}
+        try:
+            for idx, key_id in enumerate(self.key_ids):
+                result[f'#{idx + 1} ({key_id})'] = {
+                    'cooldown_s': max(0, (self.redis.pttl(self._key(idx, 'cooldown')) or 0) / 1000),
+                    'requests_this_minute': int(self.redis.get(self._key(idx, 'req', minute)) or 0),
+                    'tokens_this_minute': int(self.redis.get(self._key(idx, 'tok', minute)) or 0),
+                    '429_this_minute': int(self.redis.get(self._key(idx, '429', minute)) or 0),
+                }
+        except redis.RedisError as e:
+            return {'error': str(e)}
+        return result
+
+
+_key_pools = {}
+_key_pools_lock = threading.Lock()
+
+
+def get_key_pool(api_keys) -> KeyPool:
+    """
+    Один KeyPool на набор ключей в процессе (Redis-соединения переиспользуются).
+    В replay свое пространство в Redis: искусственные 429 не отправляют настоящие ключи в cooldown
+    """
+    prefix = f'{KeyPool.PREFIX}replay:' if settings.ANALYSIS_LLM_BACKEND == 'replay' else KeyPool.PREFIX
+    pool_id = (prefix, *api_keys)
+    with _key_pools_lock:
+        if pool_id not in _key_pools:
+            _key_pools[pool_id] = KeyPool(
+                api_keys,
+                redis_url=settings.GEMINI_KEY_POOL_URL,
+                rpm=settings.GEMINI_KEY_RPM,
+                tpm=settings.GEMINI_KEY_TPM,
+                cooldown=settings.GEMINI_KEY_COOLDOWN,
+                prefix=prefix,
+            )
+        return _key_pools[pool_id]
@@ -0,0 +1,108 @@
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test.utils import override_settings
+
+from analysis.cache import reset_extraction_cache
+from analysis.metrics import percentile
+from analysis.models import PipelineStageMetric
+from core.models import MedicalAnalysis
+from core.tasks import process_analysis_task
+
+
+class Command(BaseCommand):
+    help = (
+        "Прогоняет N синтетических анализов через process_analysis_task (локально, без брокера) "
+        "и печатает пропускную способность и латентность этапов. "
+        "Рассчитан на ANALYSIS_LLM_BACKEND=replay, чтобы не тратить квоту Gemini."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="PDF или фото, которое будет загружено N раз")
+        parser.add_argument('--count', type=int, default=20, help="Сколько анализов прогнать")
+        parser.add_argument('--concurrency', type=int, default=4, help="Сколько задач выполнять параллельно")
+        parser.add_argument('--keep', action='store_true', help="Не удалять созданные анализы и метрики")
+        parser.add_argument('--allow-live', action='store_true', help="Разрешить прогон на живом Gemini")
+        parser.add_argument('--with-cache', action='store_true',
+                            help="Не выключать кэш извлечения и дедупликацию страниц (все анализы, кроме первого, попадут в кэш)")
+
+    def handle(self, *args, **options):
+        if settings.ANALYSIS_LLM_BACKEND == 'live' and not options['allow_live']:
+            raise CommandError("ANALYSIS_LLM_BACKEND=live: бенчмарк потратит реальную квоту. "
+                               "Используйте replay или передайте --allow-live")
+
+        source = Path(options['file'])
+        if not source.exists():
+            raise CommandError(f"Файл не найден: {source}")
+
+        # Один файл в MEDIA_ROOT на все синтетические анализы
+        relative = Path('benchmark') / f"{uuid.uuid4().hex}{source.suffix.lower()}"
+        target = Path(settings.MEDIA_ROOT) / relative
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source, target)
+
+        analyses = [
+            MedicalAnalysis.objects.create(file=str(relative), status=MedicalAnalysis.Status.PENDING)
+            for _ in range(options['count'])
+        ]
+        self.stdout.write(f"🏁 {len(analyses)} анализов, параллельно {options['concurrency']}, "
+                          f"бэкенд {settings.ANALYSIS_LLM_BACKEND}, compact IR {settings.ANALYSIS_COMPACT_IR}, "
+                          f"кэш извлечения {'включен' if options['with_cache'] else 'выключен'}")
+
+        def run(analysis_uid):
+            try:
+                process_analysis_task.apply(args=[analysis_uid])
+            finally:
+                close_old_connections()
+
+        # Все анализы — один и тот же файл: с кэшем извлечения и дедупликацией страниц
+        # каждый прогон после первого пропускал бы OCR, и латентность extract ничего бы не значила
+        overrides = {} if options['with_cache'] else {'ANALYSIS_EXTRACT_CACHE_SIZE': 0, 'ANALYSIS_PAGE_DEDUP': False}
+        started = time.monotonic()
+        with override_settings(**overrides):
+            reset_extraction_cache()
+            try:
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                    list(pool.map(run, [a.uid for a in analyses]))
+            finally:
+                reset_extraction_cache()
+        elapsed = time.monotonic() - started
+
+        try:
+            self._report(analyses, elapsed)
+        finally:
+            if not options['keep']:
+                MedicalAnalysis.objects.filter(pk__in=[a.pk for a in analyses]).delete()
+                target.unlink(missing_ok=True)
+
+    def _report(self, analyses, elapsed):
+        ids = [a.pk for a in analyses]
+        statuses = {}
+        for status in MedicalAnalysis.objects.filter(pk__in=ids).values_list('status', flat=True):
+            statuses[status] = statuses.get(status, 0) + 1
+
+        self.stdout.write(f"\n⏱️ {elapsed:.1f}s, {len(analyses) / elapsed:.2f} анализов/с, статусы: {statuses}")
+
+        by_stage = {}
+        for stage, duration, retries, prompt_tokens in PipelineStageMetric.objects.filter(
+            run__analysis_id__in=ids
+        ).values_list('stage', 'duration_ms', 'retries', 'prompt_tokens'):
+            by_stage.setdefault(stage, {'durations': [], 'retries': 0, 'prompt_tokens': []})
+            by_stage[stage]['durations'].append(duration)
+            by_stage[stage]['retries'] += retries
+            by_stage[stage]['prompt_tokens'].append(prompt_tokens)
+
+        self.stdout.write(f"{'stage':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'retries':>9}{'p50 prompt tok':>16}")
+        for stage, data in sorted(by_stage.items()):
+            durations = data['durations']
+            self.stdout.write(
+                f"{stage:<12}{len(durations):>7}{percentile(durations, 50):>10}"
+                f"{percentile(durations, 95):>10}{max(durations):>10}{data['retries']:>9}"
+                f"{percentile(data['prompt_tokens'], 50):>16}"
+            )
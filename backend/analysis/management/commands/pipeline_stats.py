@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from analysis.metrics import stage_latency_percentiles
+
+
+class Command(BaseCommand):
+    help = "p50/p95 длительности этапов пайплайна по дням"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help="За сколько последних дней")
+
+    def handle(self, *args, **options):
+        rows = stage_latency_percentiles(options['days'])
+        if not rows:
+            self.stdout.write("Нет данных")
+            return
+
+        self.stdout.write(f"{'day':<12}{'stage':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'retries':>9}{'tokens':>12}")
+        for row in rows:
+            self.stdout.write(
+                f"{str(row['day']):<12}{row['stage']:<12}{row['count']:>7}{row['p50_ms']:>10}"
+                f"{row['p95_ms']:>10}{row['retries']:>9}{row['tokens']:>12}"
+            )
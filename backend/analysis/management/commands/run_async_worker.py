@@ -0,0 +1,22 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from analysis.async_pipeline import run_async_worker
+
+
+class Command(BaseCommand):
+    help = "Запускает asyncio-воркер, который обрабатывает анализы параллельно на одном event loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.ANALYSIS_ASYNC_CONCURRENCY,
+            help="Сколько анализов обрабатывать одновременно"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            asyncio.run(run_async_worker(options['concurrency']))
+        except KeyboardInterrupt:
+            self.stdout.write("Воркер остановлен")
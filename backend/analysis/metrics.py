@@ -0,0 +1,155 @@
+import datetime
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import PipelineRun, PipelineStageMetric
+
+
+class PipelineMetrics:
+    """
+    Метрики одного прогона пайплайна: время этапов, вызовы модели, ретраи, токены.
+    Потокобезопасно — страницы могут извлекаться параллельно.
+    """
+    RUN_COUNTERS = ('page_count', 'pages_dropped', 'pages_reused', 'bytes_uploaded', 'key_switches', 'output_repairs', 'hedges', 'hedge_wins', 'provider_failovers', 'interpret_shards')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.total_ms = None
+        self.stages = {}
+        self.counters = {name: 0 for name in self.RUN_COUNTERS}
+        self.flags = {
+            'succeeded': False, 'extraction_cache_hit': False,
+            'verification_skipped': False, 'text_layer_used': False,
+        }
+        # Прогон прерван временным сбоем и перепланирован: этап и пауза до ретрая задачи
+        self.deferral = {'deferred_stage': '', 'retry_delay_ms': 0}
+        # Ретраи вызовов модели по классам ошибок
+        self.retry_classes = {}
+        # Оценка размера данных в промпте: этап -> (полный JSON, компактная таблица), в токенах
+        self.prompt_sizes = {}
+        self._lock = threading.Lock()
+
+    def _stage(self, name: str) -> dict:
+        return self.stages.setdefault(name, {
+            'duration_ms': 0, 'calls': 0, 'retries': 0,
+            'prompt_tokens': 0, 'output_tokens': 0, 'total_tokens': 0, 'provider': '',
+        })
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - started)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            self._stage(name)['duration_ms'] += int(seconds * 1000)
+
+    def record_call(self, name: str, response, provider: str = None):
+        usage = getattr(response, 'usage_metadata', None)
+        with self._lock:
+            stage = self._stage(name or 'other')
+            stage['calls'] += 1
+            if provider:
+                stage['provider'] = provider
+            if usage is not None:
+                stage['prompt_tokens'] += getattr(usage, 'prompt_token_count', None) or 0
+                stage['output_tokens'] += getattr(usage, 'candidates_token_count', None) or 0
+                stage['total_tokens'] += getattr(usage, 'total_token_count', None) or 0
+
+    def record_retry(self, name: str, error_class: str = None):
+        with self._lock:
+            self._stage(name or 'other')['retries'] += 1
+            if error_class:
+                self.retry_classes[error_class] = self.retry_classes.get(error_class, 0) + 1
+
+    def record_prompt_size(self, name: str, legacy_tokens: int, compact_tokens: int):
+        with self._lock:
+            # Этап из нескольких вызовов (части интерпретации) — суммируем
+            legacy, compact = self.prompt_sizes.get(name, (0, 0))
+            self.prompt_sizes[name] = (legacy + legacy_tokens, compact + compact_tokens)
+
+    def defer(self, stage: str, seconds: float):
+        self.deferral = {'deferred_stage': stage, 'retry_delay_ms': int(seconds * 1000)}
+
+    def add(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def finish(self, succeeded: bool):
+        self.flags['succeeded'] = succeeded
+        self.total_ms = int((time.monotonic() - self.started) * 1000)
+
+    def summary(self) -> str:
+        parts = [f"{name}: {s['duration_ms']}ms/{s['total_tokens']}tok" for name, s in self.stages.items()]
+        sizes = [f"{name} ~{legacy}->{compact}tok" for name, (legacy, compact) in self.prompt_sizes.items()]
+        return f"total {self.total_ms}ms | " + ", ".join(parts) + (f" | данные: {', '.join(sizes)}" if sizes else "")
+
+
+def percentile(values, q: float):
+    """Перцентиль по nearest-rank (q от 0 до 100)"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def save_pipeline_metrics(analysis, metrics: PipelineMetrics) -> PipelineRun:
+    """Пишет метрики прогона в PipelineRun + по строке PipelineStageMetric на этап"""
+    stages = metrics.stages
+    with transaction.atomic():
+        run = PipelineRun.objects.create(
+            analysis=analysis,
+            total_ms=metrics.total_ms,
+            rasterize_ms=stages.get('rasterize', {}).get('duration_ms', 0),
+            retries=sum(s['retries'] for s in stages.values()),
+            retries_by_class=metrics.retry_classes,
+            prompt_tokens=sum(s['prompt_tokens'] for s in stages.values()),
+            output_tokens=sum(s['output_tokens'] for s in stages.values()),
+            total_tokens=sum(s['total_tokens'] for s in stages.values()),
+            **metrics.counters,
+            **metrics.flags,
+            **metrics.deferral,
+        )
+        PipelineStageMetric.objects.bulk_create([
+            PipelineStageMetric(run=run, stage=name, **values)
+            for name, values in stages.items()
+        ])
+    return run
+
+
+def stage_latency_percentiles(days: int = 7):
+    """
+    p50/p95 длительности каждого этапа по дням за последние days дней.
+    Перцентили считает Postgres (percentile_cont), в Python приходит уже агрегат.
+    """
+    since = timezone.now() - datetime.timedelta(days=days)
+    table = PipelineStageMetric._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT DATE(created_at) AS day, stage, COUNT(*),
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY duration_ms),
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY duration_ms),
+                   SUM(retries), SUM(total_tokens)
+            FROM {table}
+            WHERE created_at >= %s
+            GROUP BY day, stage
+            ORDER BY day, stage
+        """, [since])
+        rows = cursor.fetchall()
+    return [
+        {
+            'day': day, 'stage': stage, 'count': count,
+            'p50_ms': int(p50 or 0), 'p95_ms': int(p95 or 0),
+            'retries': retries or 0, 'tokens': tokens or 0,
+        }
+        for day, stage, count, p50, p95, retries, tokens in rows
+    ]
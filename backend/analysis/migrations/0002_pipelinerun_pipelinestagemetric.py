@@ -0,0 +1,53 @@
+# Generated by Django 6.0.2 on 2026-10-18 10:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0001_initial'),
+        ('core', '0003_analysisindicator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('succeeded', models.BooleanField(default=False)),
+                ('total_ms', models.IntegerField(blank=True, null=True)),
+                ('page_count', models.IntegerField(default=0)),
+                ('rasterize_ms', models.IntegerField(default=0)),
+                ('bytes_uploaded', models.BigIntegerField(default=0)),
+                ('retries', models.IntegerField(default=0)),
+                ('key_switches', models.IntegerField(default=0)),
+                ('prompt_tokens', models.IntegerField(default=0)),
+                ('output_tokens', models.IntegerField(default=0)),
+                ('total_tokens', models.IntegerField(default=0)),
+                ('extraction_cache_hit', models.BooleanField(default=False)),
+                ('verification_skipped', models.BooleanField(default=False)),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pipeline_runs', to='core.medicalanalysis')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PipelineStageMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=20)),
+                ('duration_ms', models.IntegerField(default=0)),
+                ('calls', models.IntegerField(default=0)),
+                ('retries', models.IntegerField(default=0)),
+                ('prompt_tokens', models.IntegerField(default=0)),
+                ('output_tokens', models.IntegerField(default=0)),
+                ('total_tokens', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='analysis.pipelinerun')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stage', 'created_at'], name='pipeline_stage_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0003_pipelinerun_text_layer_used'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelinerun',
+            name='pages_dropped',
+            field=models.IntegerField(default=0),
+        ),
+    ]
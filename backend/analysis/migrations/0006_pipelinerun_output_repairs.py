@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0005_pagefingerprint_pipelinerun_pages_reused'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelinerun',
+            name='output_repairs',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0.2 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0007_pipelinerun_deferred_stage_retry_delay_ms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelinerun',
+            name='hedges',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pipelinerun',
+            name='hedge_wins',
+            field=models.IntegerField(default=0),
+        ),
+    ]
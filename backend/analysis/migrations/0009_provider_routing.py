@@ -0,0 +1,23 @@
+# Generated by Django 6.0.2 on 2026-10-18 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0008_pipelinerun_hedges'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelinerun',
+            name='provider_failovers',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pipelinestagemetric',
+            name='provider',
+            field=models.CharField(blank=True, default='', max_length=80),
+        ),
+    ]
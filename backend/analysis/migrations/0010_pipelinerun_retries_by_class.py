@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0009_provider_routing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelinerun',
+            name='retries_by_class',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0010_pipelinerun_retries_by_class'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipelinerun',
+            name='interpret_shards',
+            field=models.IntegerField(default=0),
+        ),
+    ]
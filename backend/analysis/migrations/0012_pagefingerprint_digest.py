@@ -0,0 +1,33 @@
+# Generated by Django 6.0.2 on 2026-10-18 23:00
+
+from django.db import migrations, models
+
+
+def drop_perceptual_fingerprints(apps, schema_editor):
+    """Старые отпечатки — перцептивные хэши, с SHA-256 страниц они не сравнимы"""
+    apps.get_model('analysis', 'PageFingerprint').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0011_pipelinerun_interpret_shards'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_perceptual_fingerprints, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='pagefingerprint',
+            name='phash',
+        ),
+        migrations.AddField(
+            model_name='pagefingerprint',
+            name='digest',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='pagefingerprint',
+            index=models.Index(fields=['user', 'digest'], name='page_fingerprint_digest_idx'),
+        ),
+    ]
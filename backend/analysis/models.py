@@ -1,3 +1,123 @@
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class PipelineCheckpoint(models.Model):
+    """
+    Результат завершенного этапа пайплайна.
+    Ретрай Celery продолжает с последнего сохраненного этапа, а не с OCR.
+    """
+    class Stage(models.TextChoices):
+        EXTRACT = 'extract', 'Извлечение'
+        INTERPRET = 'interpret', 'Интерпретация'
+
+    analysis = models.ForeignKey('core.MedicalAnalysis', on_delete=models.CASCADE, related_name='checkpoints')
+    stage = models.CharField(max_length=20, choices=Stage.choices)
+    data = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['analysis', 'stage'], name='unique_pipeline_checkpoint'),
+        ]
+
+    def __str__(self):
+        return f"{self.analysis.uid}: {self.stage}"
+
+
+class PipelineRun(models.Model):
+    """
+    Метрики одной попытки обработки анализа (ретрай Celery = новая строка).
+    Нужны, чтобы понять, где теряется время: OCR, интерпретация или ретраи прокси.
+    """
+    analysis = models.ForeignKey('core.MedicalAnalysis', on_delete=models.CASCADE, related_name='pipeline_runs')
+    started_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    succeeded = models.BooleanField(default=False)
+    total_ms = models.IntegerField(null=True, blank=True)
+
+    # Растеризация и отправка картинок
+    page_count = models.IntegerField(default=0)
+    # Страницы, извлечение которых взяли из прошлых загрузок пользователя (PageFingerprint)
+    pages_reused = models.IntegerField(default=0)
+    # Пустые / служебные страницы, которые фильтр не отправил в модель
+    pages_dropped = models.IntegerField(default=0)
+    rasterize_ms = models.IntegerField(default=0)
+    bytes_uploaded = models.BigIntegerField(default=0)
+
+    # Ретраи вызовов модели внутри пайплайна и переключения API-ключей
+    retries = models.IntegerField(default=0)
+    # Те же ретраи по классам ошибок: {'server': 2, 'rate_limit': 1} (см. analysis.errors.classify_error)
+    retries_by_class = models.JSONField(default=dict, blank=True)
+    key_switches = models.IntegerField(default=0)
+    # Прогон прерван временным сбоем модели и задача перепланирована Celery:
+    # на каком этапе и через сколько назначен ретрай
+    deferred_stage = models.CharField(max_length=20, blank=True, default='')
+    retry_delay_ms = models.IntegerField(default=0)
+    # Дубли зависших вызовов (hedging) и сколько раз дубль ответил первым
+    hedges = models.IntegerField(default=0)
+    hedge_wins = models.IntegerField(default=0)
+    # Попытки, ушедшие к другому провайдеру (квота / ошибки / задержка текущего)
+    provider_failovers = models.IntegerField(default=0)
+    # Большая панель интерпретирована по частям: сколько частей (0 — одним вызовом)
+    interpret_shards = models.IntegerField(default=0)
+    # Ответы модели, починенные локально (обрыв, мусор вокруг JSON, типы) вместо повторного вызова
+    output_repairs = models.IntegerField(default=0)
+
+    # usage_metadata от Gemini, сумма по всем этапам
+    prompt_tokens = models.IntegerField(default=0)
+    output_tokens = models.IntegerField(default=0)
+    total_tokens = models.IntegerField(default=0)
+
+    extraction_cache_hit = models.BooleanField(default=False)
+    # Цифровой PDF: извлечение по текстовому слою, без растеризации
+    text_layer_used = models.BooleanField(default=False)
+    verification_skipped = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"Run {self.analysis.uid} ({self.total_ms} ms)"
+
+
+class PipelineStageMetric(models.Model):
+    """Одна строка = один этап прогона (extract / rasterize / interpret / verify)"""
+    run = models.ForeignKey(PipelineRun, on_delete=models.CASCADE, related_name='stages')
+    stage = models.CharField(max_length=20)
+    duration_ms = models.IntegerField(default=0)
+    calls = models.IntegerField(default=0)
+    retries = models.IntegerField(default=0)
+    prompt_tokens = models.IntegerField(default=0)
+    output_tokens = models.IntegerField(default=0)
+    total_tokens = models.IntegerField(default=0)
+    # Провайдер и модель, ответившие на этапе ('gemini:gemini-2.5-flash')
+    provider = models.CharField(max_length=80, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Ускоряет агрегаты вида "p95 этапа interpret по дням"
+        indexes = [
+            models.Index(fields=['stage', 'created_at'], name='pipeline_stage_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.stage}: {self.duration_ms} ms"
+
+
+class PageFingerprint(models.Model):
+    """
+    SHA-256 пикселей страницы и ее извлечение.
+    Та же страница в следующей загрузке пользователя (повторный PDF, пересекающиеся подборки)
+    повторно в модель не отправляется — берем извлечение отсюда.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='page_fingerprints')
+    analysis = models.ForeignKey('core.MedicalAnalysis', on_delete=models.CASCADE, related_name='page_fingerprints')
+    digest = models.CharField(max_length=64)
+    extraction = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='page_fingerprint_user_idx'),
+            models.Index(fields=['user', 'digest'], name='page_fingerprint_digest_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.digest[:12]}"
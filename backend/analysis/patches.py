@@ -0,0 +1,122 @@
+import copy
+
+from pydantic import ValidationError
+
+from core.schemas import CauseSchema, IndicatorSchema, SummarySchema
+from .ranges import status_for
+from .slugs import category_for, resolve_slug
+from .verification import ALLOWED_SEVERITIES, ALLOWED_STATUSES, _as_dict
+
+INDICATOR_FIELDS = {'name', 'value', 'unit', 'ref_range', 'status', 'category', 'comment'}
+CAUSE_FIELDS = {'title', 'description', 'severity'}
+SUMMARY_FIELDS = {'is_critical', 'general_comment'}
+# Обязательные поля схем: null в них сломал бы AIResultSchema всего заключения
+REQUIRED_FIELDS = {'name', 'value', 'title', 'description', 'general_comment'}
+DEFAULT_CATEGORY = "Общие показатели"
+
+
+def _row_index(row_id: str, prefix: str, size: int):
+    """'i3' -> 2, если префикс совпадает и строка существует"""
+    row_id = (row_id or '').strip().lower()
+    if not row_id.startswith(prefix) or not row_id[len(prefix):].isdigit():
+        return None
+    idx = int(row_id[len(prefix):]) - 1
+    return idx if 0 <= idx < size else None
+
+
+def _check_value(field: str, value):
+    """Значение правки в типе поля; ValueError — правку не применяем"""
+    if field in REQUIRED_FIELDS and value is None:
+        raise ValueError(f"{field} не может быть null")
+    if field == 'status' and value not in ALLOWED_STATUSES:
+        raise ValueError(f"недопустимый статус {value!r}")
+    if field == 'severity' and value not in ALLOWED_SEVERITIES:
+        raise ValueError(f"недопустимый severity {value!r}")
+    if field == 'is_critical':
+        text = str(value).strip().lower()
+        if text not in ('true', 'false'):
+            raise ValueError(f"is_critical должен быть true/false, а не {value!r}")
+        return text == 'true'
+    return value
+
+
+def _patched(row, field: str, value, schema) -> dict:
+    """Строка с правкой, проверенная схемой; ValueError — правка ломает строку, не применяем"""
+    patched = dict(row or {})
+    patched[field] = _check_value(field, value)
+    return _validated(patched, schema)
+
+
+def _validated(row: dict, schema) -> dict:
+    try:
+        schema.model_validate(row)
+    except ValidationError as e:
+        raise ValueError(f"строка не проходит {schema.__name__}: {e.errors()[0].get('msg')}") from None
+    return row
+
+
+def _row_from_source(raw: dict) -> dict:
+    """Показатель, который интерпретатор пропустил: переносим из исходника, статус считаем по референсу"""
+    value = raw.get('value')
+    return {
+        'name': raw.get('name'),
+        'value': str(value) if value is not None else None,
+        'unit': raw.get('unit'),
+        'ref_range': raw.get('ref_range'),
+        'status': status_for(raw.get('value'), raw.get('ref_range')) or 'normal',
+        'comment': None,
+        'category': category_for(resolve_slug(raw.get('name'), raw.get('unit'))) or DEFAULT_CATEGORY,
+    }
+
+
+def apply_corrections(raw_data: dict, interpreted_data, corrections) -> tuple:
+    """
+    Применяет правки верификатора к заключению интерпретатора.
+    ID строк — те же, что в компактной таблице (analysis.compact): iN, rN, cN, summary.
+    Возвращает (исправленный dict, список примененных, список отклоненных правок).
+    """
+    result = copy.deepcopy(_as_dict(interpreted_data))
+    rows = result.setdefault('indicators', [])
+    causes = result.setdefault('causes', [])
+    raw_rows = (raw_data or {}).get('indicators') or []
+    applied, rejected = [], []
+    removed, added = set(), []
+
+    for correction in corrections or []:
+        item = _as_dict(correction)
+        row_id, field, value = item.get('row_id'), (item.get('field') or '').strip(), item.get('value')
+        label = f"{row_id}.{field}={value!r}"
+        try:
+            if (row_id or '').strip().lower() == 'summary':
+                if field not in SUMMARY_FIELDS:
+                    raise ValueError(f"неизвестное поле summary {field!r}")
+                summary = result.get('summary') or {'is_critical': False, 'general_comment': ''}
+                result['summary'] = _patched(summary, field, value, SummarySchema)
+            elif field == 'add':
+                idx = _row_index(row_id, 'r', len(raw_rows))
+                if idx is None:
+                    raise ValueError("нет такой строки исходника")
+                added.append(_validated(_row_from_source(raw_rows[idx]), IndicatorSchema))
+            elif field == 'remove':
+                idx = _row_index(row_id, 'i', len(rows))
+                if idx is None:
+                    raise ValueError("нет такой строки заключения")
+                removed.add(idx)
+            elif (idx := _row_index(row_id, 'i', len(rows))) is not None:
+                if field not in INDICATOR_FIELDS:
+                    raise ValueError(f"неизвестное поле показателя {field!r}")
+                rows[idx] = _patched(rows[idx], field, value, IndicatorSchema)
+            elif (idx := _row_index(row_id, 'c', len(causes))) is not None:
+                if field not in CAUSE_FIELDS:
+                    raise ValueError(f"неизвестное поле причины {field!r}")
+                causes[idx] = _patched(causes[idx], field, value, CauseSchema)
+            else:
+                raise ValueError("нет такой строки")
+        except ValueError as e:
+            rejected.append(f"{label}: {e}")
+            continue
+        applied.append(label)
+
+    # Удаляем после всех правок, чтобы ID строк не съезжали
+    result['indicators'] = [row for idx, row in enumerate(rows) if idx not in removed] + added
+    return result, applied, rejected
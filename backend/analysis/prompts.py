@@ -30,44 +30,25 @@ EXTRACTOR_SYSTEM_PROMPT = """
 3. Убедись, что ключи JSON строго совпадают с шаблоном.
 """
 
-# ==========================================
-# СПРАВОЧНИК SLUG (Для интерпретатора)
-# ==========================================
+# Цифровой PDF: вместо картинок экстрактор получает текстовый слой
+EXTRACTOR_TEXT_LAYER_NOTE = """
+ИСТОЧНИК — не изображение, а текстовый слой PDF (pdftotext -layout).
+Колонки таблиц выровнены пробелами, страницы разделены строкой "=== СТРАНИЦА N ===".
+Извлеки данные по тем же правилам и верни JSON той же структуры.
+"""
 
-INDICATOR_REFERENCE_LIST = """
---- ОБЩИЙ АНАЛИЗ КРОВИ (CBC) ---
-Гемоглобин (HGB, Hb) -> hemoglobin
-Эритроциты (RBC) -> rbc
-Лейкоциты (WBC) -> wbc
-Тромбоциты (PLT) -> plt
-Гематокрит (HCT) -> hct
-Средний объем эритроцита (MCV) -> mcv
-Среднее содерж. гемоглобина (MCH) -> mch
-Средняя конц. гемоглобина (MCHC) -> mchc
-СОЭ (ESR, Скорость оседания) -> esr
-Лимфоциты (LYM) -> lym_percent (если %) или lym_abs (если абс.)
-Нейтрофилы (NEUT) -> neut_percent (если %) или neut_abs (если абс.)
-Моноциты (MONO) -> mono_percent / mono_abs
-
---- БИОХИМИЯ ---
-Ферритин -> ferritin
-Железо сывороточное -> iron_serum
-Глюкоза (Сахар) -> glucose
-Общий белок -> protein_total
-Билирубин общий -> bilirubin_total
-АЛТ (ALT) -> alt
-АСТ (AST) -> ast
-Холестерин общий -> cholesterol_total
-Креатинин -> creatinine
-Мочевина -> urea
-
---- ЩИТОВИДНАЯ ЖЕЛЕЗА ---
-ТТГ (TSH) -> tsh
-Т4 свободный (FT4) -> ft4
-Т3 свободный (FT3) -> ft3
-АТ-ТПО (Anti-TPO) -> anti_tpo
-
-(Используй этот список для заполнения поля 'slug'. Если показателя нет в списке, ставь null)
+# Несколько фото разных анализов одним запросом: каждый документ после своего разделителя
+EXTRACTOR_BATCH_NOTE = """
+ВНИМАНИЕ: тебе передано несколько РАЗНЫХ документов ({count} шт.). Каждое изображение идет после
+строки "=== ДОКУМЕНТ N ===". Не смешивай показатели разных документов.
+Верни JSON вида:
+{{
+  "documents": [
+    {{ "document": 1, "patient_info": {{ ... }}, "indicators": [ ... ] }},
+    {{ "document": 2, "patient_info": {{ ... }}, "indicators": [ ... ] }}
+  ]
+}}
+Ровно по одному элементу на каждый документ, в том же порядке. patient_info и indicators — как в СТРУКТУРЕ JSON выше.
 """
 
 # ==========================================
@@ -87,8 +68,8 @@ INTERPRETER_EXAMPLES = """
     "general_comment": "В целом показатели удовлетворительные. Наблюдается отличная динамика снижения уровня сахара в крови."
   },
   "indicators": [
-    { "name": "Гемоглобин", "slug": "hemoglobin", "value": "145", "unit": "g/L", "ref_range": "130-160", "status": "normal", "comment": "В пределах нормы.", "category": "Общий анализ крови" },
-    { "name": "Глюкоза", "slug": "glucose", "value": "5.9", "unit": "mmol/L", "ref_range": "3.3-5.5", "status": "high", "comment": "Повышен. Однако в сравнении с прошлым результатом (6.8) — отличная положительная динамика.", "category": "Углеводный обмен" }
+    { "name": "Гемоглобин", "slug": null, "value": "145", "unit": "g/L", "ref_range": "130-160", "status": "normal", "comment": "В пределах нормы.", "category": "Общий анализ крови" },
+    { "name": "Глюкоза", "slug": null, "value": "5.9", "unit": "mmol/L", "ref_range": "3.3-5.5", "status": "high", "comment": "Повышен. Однако в сравнении с прошлым результатом (6.8) — отличная положительная динамика.", "category": "Углеводный обмен" }
   ],
   "causes": [
     { "title": "Остаточные явления инсулинорезистентности", "description": "Показатель еще не пришел в идеальную норму, но тренд позитивный.", "severity": "yellow" },
@@ -112,8 +93,8 @@ INTERPRETER_EXAMPLES = """
     "general_comment": "Показатели отражают повышенную потребность организма в железе на фоне беременности. Требуется коррекция."
   },
   "indicators": [
-    { "name": "Гемоглобин", "slug": "hemoglobin", "value": "108", "unit": "g/L", "ref_range": "120-140", "status": "low", "comment": "Пограничное значение (норма для беременности от 105-110).", "category": "Общий анализ крови" },
-    { "name": "Ферритин", "slug": "ferritin", "value": "10", "unit": "ug/L", "ref_range": "20-120", "status": "low", "comment": "Снижен. Указывает на дефицит запасов железа.", "category": "Железо и кроветворение" }
+    { "name": "Гемоглобин", "slug": null, "value": "108", "unit": "g/L", "ref_range": "120-140", "status": "low", "comment": "Пограничное значение (норма для беременности от 105-110).", "category": "Общий анализ крови" },
+    { "name": "Ферритин", "slug": null, "value": "10", "unit": "ug/L", "ref_range": "20-120", "status": "low", "comment": "Снижен. Указывает на дефицит запасов железа.", "category": "Железо и кроветворение" }
   ],
   "causes": [
     { "title": "Расход железа при беременности", "description": "Плод активно потребляет железо матери, что часто приводит к истощению депо (ферритина).", "severity": "yellow" }
@@ -130,7 +111,7 @@ INTERPRETER_SYSTEM_PROMPT = f"""
 Спокойный, профессиональный, доказательный, без лишнего запугивания. 
 КРИТИЧЕСКИ ВАЖНО: Пиши строго обезличенно, в третьем лице или используй инфинитивы. Категорически ЗАПРЕЩАЕТСЯ обращаться к пациенту или пользователю напрямую (не используй слова "Вы", "Ваш", "Вам", "У вас"). Выдавай сухое медицинское и экспертное заключение.
 
-{INDICATOR_REFERENCE_LIST}
+Поле 'slug' не заполняй (ставь null) — система проставит его сама по названию показателя.
 
 {INTERPRETER_EXAMPLES}
 
@@ -153,18 +134,65 @@ INTERPRETER_SYSTEM_PROMPT = f"""
 Спокойный, профессиональный, доказательный, без лишнего запугивания (снижай тревожность пациента). Обращайся на "Вы".
 """
 
+# Большая панель по частям: сначала показатели каждой части, потом общий вывод по всей таблице
+INTERPRETER_SHARD_NOTE = """
+ВНИМАНИЕ: тебе передана ЧАСТЬ большой панели — показатели групп: {categories} ({count} шт.).
+Верни только "reasoning" (кратко, по этой части), "patient_info" и "indicators" — по одному на каждую строку таблицы.
+summary, causes и recommendations НЕ заполняй: общий вывод по всей панели делается отдельным шагом.
+"""
+
+INTERPRETER_SUMMARY_PROMPT = """
+Ты — врач-интерпретатор. Показатели большой панели анализов уже оценены по частям, ниже — итоговая таблица
+(status и comment проставлены). Сформулируй общий вывод по всей панели целиком, учитывая связи между группами показателей.
+
+Верни JSON:
+{
+  "reasoning": "Краткий ход мысли: ключевые отклонения и их связь",
+  "summary": { "is_critical": false, "general_comment": "Общее заключение" },
+  "causes": [ { "title": "...", "description": "...", "severity": "green | yellow | red" } ],
+  "recommendations": [ { "type": "lifestyle | checkup | visit", "text": "..." } ]
+}
+
+severity: "green" — безопасные факторы, "yellow" — требуют внимания, "red" — критические, нужен срочный визит к врачу.
+Если в контексте есть история анализов — отрази динамику в general_comment.
+
+ТОН ОБЩЕНИЯ:
+Спокойный, профессиональный, доказательный, без лишнего запугивания. Пиши строго обезличенно, в третьем лице
+или инфинитивами; не обращайся к пациенту напрямую ("Вы", "Ваш", "У вас").
+"""
+
 # ==========================================
 # 3. VERIFIER (Проверка форматов)
 # ==========================================
 
 VERIFIER_SYSTEM_PROMPT = """
-Ты — строгий валидатор JSON. 
-Тебе на вход подают сырые данные из документа и результат работы ИИ-интерпретатора.
+Ты — строгий валидатор медицинского заключения.
+Тебе на вход подают таблицу исходных данных из документа (строки r1, r2 ...) и заключение
+ИИ-интерпретатора: показатели (строки i1, i2 ..., колонка src — строка исходника), причины (c1, c2 ...) и summary.
+Если таблиц нет и данные переданы JSON-ом, ID — это порядковые номера: i1 — первый элемент indicators, r1 — первый показатель исходника, c1 — первая причина.
+
 Твоя задача — проверить, что:
-1. ИИ не выдумал цифры, которых нет в исходнике.
-2. Все статусы расставлены логично (high, low, normal).
-3. JSON строго соответствует схеме AIResultSchema (особенно поля category и severity).
+1. ИИ не выдумал цифры, которых нет в исходнике, и не потерял показатели.
+2. Значения, единицы и референсы совпадают с исходником.
+3. Все статусы расставлены логично (high, low, normal), у каждого показателя есть category,
+   severity причин — только green, yellow или red.
+
+НЕ ПЕРЕПИСЫВАЙ заключение целиком. Верни только правки:
+{
+  "ok": true/false,
+  "corrections": [
+    { "row_id": "i3", "field": "status", "value": "high" },
+    { "row_id": "i5", "field": "remove", "value": null },
+    { "row_id": "r7", "field": "add", "value": null },
+    { "row_id": "c1", "field": "severity", "value": "yellow" },
+    { "row_id": "summary", "field": "is_critical", "value": "false" }
+  ]
+}
 
-Если есть ошибки — исправь их и верни финальный, идеальный JSON.
+ПРАВИЛА:
+- Поля показателя: name, value, unit, ref_range, status, category, comment.
+- Поля причины: title, description, severity. Поля summary: is_critical, general_comment.
+- "remove" — удалить выдуманный показатель iN, "add" — добавить пропущенный показатель исходника rN.
+- Если ошибок нет — {"ok": true, "corrections": []}.
 Никакого текста, только валидный JSON.
-"""
\ No newline at end of file
+"""
@@ -0,0 +1,334 @@
+import base64
+import json
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import anthropic
+import openai
+from django.conf import settings
+
+from .imaging import compress_image
+from .keys import parse_retry_after
+
+# Маршрутизация этапов между провайдерами (Gemini / OpenAI / Anthropic).
+# Gemini идет через пул ключей и бэкенды (record/replay) как раньше; остальные провайдеры
+# вызываются своими SDK, а ответ приводится к виду ответа genai (text / parsed / usage_metadata),
+# поэтому починка JSON, метрики и разбор по схеме работают без изменений.
+
+
+def parse_route(entry: str):
+    """'openai:gpt-4.1-mini' -> ('openai', 'gpt-4.1-mini'); без модели — модель провайдера по умолчанию"""
+    name, _, model = entry.partition(':')
+    return name.strip().lower(), model.strip() or None
+
+
+def _media(part):
+    """Элемент contents -> ('text', str) или ('image', mime, base64)"""
+    if isinstance(part, str):
+        return 'text', part
+    inline = getattr(part, 'inline_data', None)
+    if inline is not None and getattr(inline, 'data', None):
+        return 'image', inline.mime_type, base64.b64encode(inline.data).decode()
+    if hasattr(part, 'tobytes'):
+        # PIL-картинка (сжатие перед отправкой выключено) — другим SDK нужны байты
+        data, mime_type, _ = compress_image(part)
+        return 'image', mime_type, base64.b64encode(data).decode()
+    return 'text', str(part)
+
+
+def _json_instruction(schema, mime_type) -> str:
+    """У OpenAI/Anthropic нет response_schema в формате genai: схему передаем в промпте"""
+    if schema is not None:
+        return "\n\nОтвет — только JSON по схеме:\n" + json.dumps(schema.model_json_schema(), ensure_ascii=False)
+    if mime_type == "application/json":
+        return "\n\nОтвет — только JSON."
+    return ""
+
+
+def _response(text, schema, prompt_tokens, output_tokens):
+    """Ответ в форме genai: parsed заполняем как SDK Gemini (кривой JSON -> None)"""
+    try:
+        parsed = schema.model_validate_json(text) if schema and text else None
+    except ValueError:
+        parsed = None
+    return SimpleNamespace(
+        text=text,
+        parsed=parsed,
+        usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=(prompt_tokens or 0) + (output_tokens or 0),
+        ),
+    )
+
+
+class Provider:
+    name = None
+    default_model = None
+
+    def __init__(self, model=None):
+        self.model = model or self.default_model
+
+    @property
+    def label(self) -> str:
+        return f"{self.name}:{self.model}"
+
+    def available(self) -> bool:
+        return True
+
+
+class GeminiProvider(Provider):
+    """Маркер: сам вызов делает пайплайн через пул ключей (см. _call_gemini_with_fallback)"""
+    name = 'gemini'
+    default_model = 'gemini-2.5-flash'
+
+
+class OpenAIProvider(Provider):
+    name = 'openai'
+    default_model = 'gpt-4.1-mini'
+    _clients = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model=None):
+        super().__init__(model)
+        self.api_key = getattr(settings, 'OPENAI_API_KEY', '')
+        self.base_url = getattr(settings, 'OPENAI_BASE_URL', None) or None
+
+    def available(self) -> bool:
+        return bool(self.api_key)
+
+    def _client(self, is_async: bool):
+        # Ретраи делает пайплайн (с переключением провайдера), встроенные в SDK выключены
+        pool_key = (is_async, self.api_key, self.base_url)
+        with self._lock:
+            if pool_key not in self._clients:
+                client_cls = openai.AsyncOpenAI if is_async else openai.OpenAI
+                self._clients[pool_key] = client_cls(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+            return self._clients[pool_key]
+
+    def _request(self, prompt, schema, mime_type, image_parts, timeout):
+        content = []
+        for part in list(image_parts or []) + [prompt + _json_instruction(schema, mime_type)]:
+            media = _media(part)
+            if media[0] == 'text':
+                content.append({'type': 'text', 'text': media[1]})
+            else:
+                content.append({'type': 'image_url', 'image_url': {'url': f"data:{media[1]};base64,{media[2]}"}})
+        kwargs = {
+            'model': self.model,
+            'messages': [{'role': 'user', 'content': content}],
+            'temperature': 0.2,
+            'timeout': timeout,
+        }
+        if schema is not None or mime_type == "application/json":
+            kwargs['response_format'] = {'type': 'json_object'}
+        return kwargs
+
+    def _parse(self, completion, schema):
+        usage = getattr(completion, 'usage', None)
+        text = completion.choices[0].message.content or ''
+        return _response(text, schema, getattr(usage, 'prompt_tokens', None), getattr(usage, 'completion_tokens', None))
+
+    def generate(self, prompt, schema=None, mime_type="application/json", image_parts=None, timeout=None):
+        completion = self._client(False).chat.completions.create(**self._request(prompt, schema, mime_type, image_parts, timeout))
+        return self._parse(completion, schema)
+
+    async def agenerate(self, prompt, schema=None, mime_type="application/json", image_parts=None, timeout=None):
+        completion = await self._client(True).chat.completions.create(**self._request(prompt, schema, mime_type, image_parts, timeout))
+        return self._parse(completion, schema)
+
+
+class AnthropicProvider(Provider):
+    name = 'anthropic'
+    default_model = 'claude-sonnet-4-5'
+    _clients = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model=None):
+        super().__init__(model)
+        self.api_key = getattr(settings, 'ANTHROPIC_API_KEY', '')
+        self.base_url = getattr(settings, 'ANTHROPIC_BASE_URL', None) or None
+        self.max_tokens = getattr(settings, 'ANALYSIS_ANTHROPIC_MAX_TOKENS', 16000)
+
+    def available(self) -> bool:
+        return bool(self.api_key)
+
+    def _client(self, is_async: bool):
+        pool_key = (is_async, self.api_key, self.base_url)
+        with self._lock:
+            if pool_key not in self._clients:
+                client_cls = anthropic.AsyncAnthropic if is_async else anthropic.Anthropic
+                self._clients[pool_key] = client_cls(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+            return self._clients[pool_key]
+
+    def _request(self, prompt, schema, mime_type, image_parts, timeout):
+        content = []
+        for part in list(image_parts or []) + [prompt + _json_instruction(schema, mime_type)]:
+            media = _media(part)
+            if media[0] == 'text':
+                content.append({'type': 'text', 'text': media[1]})
+            else:
+                content.append({'type': 'image', 'source': {'type': 'base64', 'media_type': media[1], 'data': media[2]}})
+        return {
+            'model': self.model,
+            'max_tokens': self.max_tokens,
+            'messages': [{'role': 'user', 'content': content}],
+            'temperature': 0.2,
+            'timeout': timeout,
+        }
+
+    def _parse(self, message, schema):
+        usage = getattr(message, 'usage', None)
+        text = ''.join(block.text for block in message.content if getattr(block, 'type', None) == 'text')
+        return _response(text, schema, getattr(usage, 'input_tokens', None), getattr(usage, 'output_tokens', None))
+
+    def generate(self, prompt, schema=None, mime_type="application/json", image_parts=None, timeout=None):
+        message = self._client(False).messages.create(**self._request(prompt, schema, mime_type, image_parts, timeout))
+        return self._parse(message, schema)
+
+    async def agenerate(self, prompt, schema=None, mime_type="application/json", image_parts=None, timeout=None):
+        message = await self._client(True).messages.create(**self._request(prompt, schema, mime_type, image_parts, timeout))
+        return self._parse(message, schema)
+
+
+PROVIDERS = {cls.name: cls for cls in (GeminiProvider, OpenAIProvider, AnthropicProvider)}
+
+
+class ProviderHealth:
+    """Скользящее окно вызовов провайдера (на процесс): задержка успешных вызовов, доля ошибок, cooldown"""
+
+    def __init__(self, window: int):
+        self.calls = deque(maxlen=window)
+        self.latency = None
+        self.cooldown_until = 0.0
+
+
+class ProviderRouter:
+    """
+    Выбирает провайдера для этапа из ANALYSIS_PROVIDER_ROUTES.
+    Порядок: здоровые провайдеры по задержке (EWMA успешных вызовов) с поправкой на долю ошибок;
+    пока у запасного провайдера нет замеров, он идет после основного. Провайдер с 429
+    (квота) или с долей ошибок выше ANALYSIS_PROVIDER_MAX_ERROR_RATE уходит в cooldown,
+    его этапы переезжают на следующий по списку.
+    """
+
+    def __init__(self, routes: dict, window: int = 50, min_samples: int = 5,
+                 max_error_rate: float = 0.5, cooldown: int = 60):
+        self.routes = {}
+        for stage, entries in routes.items():
+            providers = []
+            for entry in entries:
+                name, model = parse_route(entry)
+                if name not in PROVIDERS:
+                    print(f"⚠️ ProviderRouter: неизвестный провайдер {entry!r} для этапа {stage}")
+                    continue
+                provider = PROVIDERS[name](model)
+                if provider.available():
+                    providers.append(provider)
+            if providers:
+                self.routes[stage] = providers
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def _state(self, label: str) -> ProviderHealth:
+        return self._health.setdefault(label, ProviderHealth(self.window))
+
+    def _error_rate(self, state: ProviderHealth) -> float:
+        if not state.calls:
+            return 0.0
+        return sum(1 for ok in state.calls if not ok) / len(state.calls)
+
+    def candidates(self, stage: str) -> list:
+        """Провайдеры этапа в порядке предпочтения; в cooldown — в конце, кто освободится раньше"""
+        providers = self.routes.get(stage) or self.routes.get('default') or []
+        now = time.monotonic()
+        ready, cooling = [], []
+        with self._lock:
+            for idx, provider in enumerate(providers):
+                state = self._state(provider.label)
+                if state.cooldown_until > now:
+                    cooling.append((state.cooldown_until, idx, provider))
+                    continue
+                measured = len(state.calls) >= self.min_samples and state.latency is not None
+                score = state.latency * (1 + 2 * self._error_rate(state)) if measured else 0.0
+                # Без замеров: основной провайдер первым, запасные — после измеренных
+                ready.append((not measured and idx > 0, score, idx, provider))
+        return [item[-1] for item in sorted(ready)] + [item[-1] for item in sorted(cooling)]
+
+    def pick(self, stage: str):
+        providers = self.candidates(stage)
+        return providers[0] if providers else None
+
+    def has_alternative(self, stage: str, provider) -> bool:
+        """Есть ли здоровый провайдер, кроме данного (иначе лучше переждать его квоту)"""
+        now = time.monotonic()
+        with self._lock:
+            return any(
+                other is not provider and self._state(other.label).cooldown_until <= now
+                for other in self.routes.get(stage) or self.routes.get('default') or []
+            )
+
+    def report_success(self, provider, seconds: float):
+        with self._lock:
+            state = self._state(provider.label)
+            state.calls.append(True)
+            state.latency = seconds if state.latency is None else 0.8 * state.latency + 0.2 * seconds
+
+    def report_error(self, provider, error=None, retry_after: float = None):
+        """Ошибка вызова. 429 / исчерпанная квота — сразу cooldown; прочие — по доле ошибок в окне"""
+        err_str = str(error).lower() if error is not None else ''
+        quota = retry_after is not None or "429" in err_str or "exhausted" in err_str or "quota" in err_str or "rate limit" in err_str
+        with self._lock:
+            state = self._state(provider.label)
+            state.calls.append(False)
+            degraded = len(state.calls) >= self.min_samples and self._error_rate(state) >= self.max_error_rate
+            if not (quota or degraded):
+                return
+            cooldown = retry_after or (parse_retry_after(error) if error is not None else None) or self.cooldown
+            state.cooldown_until = time.monotonic() + cooldown
+            # После cooldown провайдер начинает с чистого окна
+            state.calls.clear()
+        print(f"🧊 Провайдер {provider.label} в cooldown на {cooldown:.0f}s ({'квота' if quota else 'ошибки'})")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                label: {
+                    'calls': len(state.calls),
+                    'error_rate': round(self._error_rate(state), 3),
+                    'latency_s': round(state.latency, 2) if state.latency is not None else None,
+                    'cooldown_s': max(0, round(state.cooldown_until - now)),
+                }
+                for label, state in self._health.items()
+            }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_provider_router():
+    """
+    Роутер на процесс. None — маршрутов нет (или replay-бэкенд): все этапы идут в Gemini, как раньше.
+    """
+    global _router
+    routes = getattr(settings, 'ANALYSIS_PROVIDER_ROUTES', {})
+    if not routes or getattr(settings, 'ANALYSIS_LLM_BACKEND', 'live') == 'replay':
+        return None
+    with _router_lock:
+        if _router is None:
+            _router = ProviderRouter(
+                routes,
+                window=getattr(settings, 'ANALYSIS_PROVIDER_WINDOW', 50),
+                min_samples=getattr(settings, 'ANALYSIS_PROVIDER_MIN_SAMPLES', 5),
+                max_error_rate=getattr(settings, 'ANALYSIS_PROVIDER_MAX_ERROR_RATE', 0.5),
+                cooldown=getattr(settings, 'ANALYSIS_PROVIDER_COOLDOWN', 60),
+            )
+        return _router
@@ -0,0 +1,141 @@
+import re
+
+import numpy as np
+
+NUMBER = r'[-+]?\d+(?:[.,]\d+)?'
+
+_BETWEEN_RE = re.compile(rf'\b(?:от|from)\s*({NUMBER}).*?\b(?:до|to)\s*({NUMBER})', re.IGNORECASE)
+_DASH_RE = re.compile(rf'({NUMBER})\s*(?:-|–|—|\.\.\.?)\s*({NUMBER})')
+# "не менее 60" — нижняя граница, "не более 5" — верхняя: "менее" / "более" внутри них не считаем
+_UPPER_RE = re.compile(
+    rf'(?:<=|<|≤|\b(?:до|up to)|(?<!не )\b(?:менее|меньше|ниже)|\bне (?:более|больше|выше|превышает))\s*({NUMBER})',
+    re.IGNORECASE,
+)
+_LOWER_RE = re.compile(
+    rf'(?:>=|>|≥|\bот|(?<!не )\b(?:более|больше|выше|свыше)|\bне (?:менее|меньше|ниже))\s*({NUMBER})',
+    re.IGNORECASE,
+)
+
+
+def _to_float(text: str) -> float:
+    return float(text.replace(',', '.'))
+
+
+def parse_number(value):
+    """
+    Числовое значение показателя: "12,5" -> 12.5, "145*" -> 145.0, "1 250" -> 1250.0.
+    Для текстовых значений ("не обнаружено", "<0.5") возвращает None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(' ', '').replace(' ', '')
+    match = re.fullmatch(rf'({NUMBER})\*?', text)
+    return _to_float(match.group(1)) if match else None
+
+
+def parse_ref_range(text):
+    """
+    Разбирает референс в (low, high), любая граница может быть None:
+    "3.3-5.5" -> (3.3, 5.5), "<5" / "до 20" / "не более 20" -> (None, 5/20),
+    "> 60" / "более 60" / "не менее 60" -> (60, None).
+    Нераспознанный или неоднозначный референс (несколько диапазонов: "муж: 130-160, жен: 120-140",
+    "3-5, дети до 10") — None: какой из них относится к пациенту, по строке не понять.
+    """
+    if not text:
+        return None
+    rest = " ".join(str(text).split())
+
+    found = []
+    for regex in (_BETWEEN_RE, _DASH_RE):
+        found.extend((_to_float(low), _to_float(high)) for low, high in regex.findall(rest))
+        # "от 3 до 5" не должен еще раз найтись как "до 5"
+        rest = regex.sub(' ', rest)
+    found.extend((None, _to_float(high)) for high in _UPPER_RE.findall(rest))
+    found.extend((_to_float(low), None) for low in _LOWER_RE.findall(rest))
+
+    if len(found) != 1:
+        return None
+    low, high = found[0]
+    if low is not None and high is not None and low > high:
+        return high, low
+    return low, high
+
+
+def status_for(value, ref_range):
+    """'low' / 'normal' / 'high' по референсу, None — если посчитать нельзя"""
+    number = parse_number(value)
+    bounds = parse_ref_range(ref_range) if not isinstance(ref_range, tuple) else ref_range
+    if number is None or not bounds:
+        return None
+    low, high = bounds
+    if low is not None and number < low:
+        return 'low'
+    if high is not None and number > high:
+        return 'high'
+    return 'normal'
+
+
+# ==========================================
+# ПАКЕТНАЯ ОЦЕНКА (NumPy)
+# ==========================================
+# Статус — чистая арифметика после разбора референса: считаем его для всех строк анализа
+# (и для всей истории пациента) одним векторным сравнением, а не доверяем модели.
+
+# Коды статусов в массивах: 0 — посчитать нельзя
+STATUS_LABELS = (None, 'low', 'normal', 'high')
+
+
+def ref_bounds(ref_ranges):
+    """Референсы -> (low, high) массивы float, NaN — границы нет / референс не распознан"""
+    bounds = [parse_ref_range(text) or (None, None) for text in ref_ranges]
+    # dtype=float превращает None в NaN
+    return (
+        np.array([low for low, _ in bounds], dtype=float),
+        np.array([high for _, high in bounds], dtype=float),
+    )
+
+
+def evaluate_statuses(values, lows, highs):
+    """
+    Векторная оценка: values / lows / highs — массивы одной длины (NaN — нет числа / границы).
+    Возвращает массив кодов STATUS_LABELS. Сравнение с NaN дает False, так что
+    односторонние референсы ("<5", "> 60") работают без отдельных веток.
+    """
+    values = np.asarray(values, dtype=float)
+    lows = np.asarray(lows, dtype=float)
+    highs = np.asarray(highs, dtype=float)
+    codes = np.where(values < lows, 1, np.where(values > highs, 3, 2))
+    known = ~np.isnan(values) & ~(np.isnan(lows) & np.isnan(highs))
+    return np.where(known, codes, 0)
+
+
+def status_labels(codes) -> list:
+    return [STATUS_LABELS[code] for code in codes.tolist()]
+
+
+def compute_statuses(values, ref_ranges) -> list:
+    """Статусы для списков значений и референсов (None там, где посчитать нельзя)"""
+    if not len(values):
+        return []
+    numbers = np.array([parse_number(value) for value in values], dtype=float)
+    lows, highs = ref_bounds(ref_ranges)
+    return status_labels(evaluate_statuses(numbers, lows, highs))
+
+
+def apply_statuses(rows) -> list:
+    """
+    Проставляет локально посчитанный status строкам показателей (список dict) на месте —
+    только тем, где модель статус не дала. Статус модели / верификатора не перезаписываем:
+    расхождение с референсом разбирает локальная сверка (analysis.verification).
+    Возвращает [(название, было, стало)] для заполненных строк.
+    """
+    rows = [row for row in rows or [] if isinstance(row, dict)]
+    statuses = compute_statuses([row.get('value') for row in rows], [row.get('ref_range') for row in rows])
+    changed = []
+    for row, status in zip(rows, statuses):
+        if status and not row.get('status'):
+            changed.append((row.get('name'), row.get('status'), status))
+            row['status'] = status
+    return changed
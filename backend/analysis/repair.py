@@ -0,0 +1,237 @@
+import json
+import re
+import typing
+
+from pydantic import BaseModel, ValidationError
+
+# Ответ модели с обрывом или мусором вокруг JSON чиним локально, а не повторяем весь вызов.
+# Дозапрашивается только оборванный хвост (см. continuation_prompt / merge_continuation).
+
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$', re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+_CLOSERS = {'{': '}', '[': ']'}
+# Висячий ключ в конце оборванного объекта: , "name" или , "name":
+_DANGLING_KEY_RE = re.compile(r'[,\s]*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+# Сколько последних "безопасных" точек обрыва пробуем, прежде чем сдаться
+MAX_CUT_ATTEMPTS = 50
+
+
+def strip_code_fences(text: str) -> str:
+    return _FENCE_RE.sub('', text.strip())
+
+
+def _scan(text: str, start: int):
+    """
+    Проходит JSON от start с учетом строк и экранирования.
+    Возвращает (end, None, cuts, False): end — индекс за закрывающей скобкой верхнего уровня;
+    если JSON оборван — (None, стек открытых скобок, cuts, оборван ли внутри строки).
+    cuts — позиции запятых со снимком стека: по ним можно отрезать недописанный последний элемент.
+    """
+    stack, cuts = [], []
+    in_string = escaped = False
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(ch)
+        elif ch in '}]':
+            if stack:
+                stack.pop()
+            if not stack:
+                return pos + 1, None, cuts, False
+        elif ch == ',':
+            cuts.append((pos, tuple(stack)))
+    return None, stack, cuts, in_string
+
+
+def _close(fragment: str, stack) -> str:
+    return fragment.rstrip().rstrip(',') + ''.join(_CLOSERS[ch] for ch in reversed(stack))
+
+
+def _close_tails(fragment: str, stack, in_string: bool):
+    """
+    Варианты закрытия хвоста, оборванного до первой запятой (резать не по чему):
+    дописываем открытую строку, затем — без висячего ключа, если обрыв пришелся на него
+    """
+    if in_string:
+        # Недописанная escape-последовательность: одиночный \ в конце
+        if (len(fragment) - len(fragment.rstrip('\\'))) % 2:
+            fragment = fragment[:-1]
+        fragment += '"'
+    tail = fragment.rstrip()
+    yield _close(tail + ' null' if tail.endswith(':') else tail, stack)
+    if stack and stack[-1] == '{':
+        yield _close(_DANGLING_KEY_RE.sub('', tail), stack)
+
+
+def _loads(text: str):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        # Висячие запятые перед } / ] — частый дефект
+        return json.loads(_TRAILING_COMMA_RE.sub(r'\1', text))
+
+
+def repair_json(text):
+    """
+    Разбирает ответ модели в dict/list.
+    Возвращает (данные, truncated, fixes): truncated — JSON был оборван и недописанный
+    последний элемент отброшен; fixes — что пришлось починить (для логов).
+    ValueError — если JSON не найден вовсе.
+    """
+    if isinstance(text, (dict, list)):
+        return text, False, []
+    fixes = []
+    raw = str(text or '')
+    cleaned = strip_code_fences(raw)
+    if cleaned != raw.strip():
+        fixes.append('code fences')
+
+    start = min((pos for pos in (cleaned.find('{'), cleaned.find('[')) if pos >= 0), default=-1)
+    if start < 0:
+        raise ValueError("в ответе модели нет JSON")
+    if cleaned[:start].strip():
+        fixes.append('текст до JSON')
+
+    end, stack, cuts, in_string = _scan(cleaned, start)
+    if end is not None:
+        if cleaned[end:].strip():
+            fixes.append('текст после JSON')
+        try:
+            return _loads(cleaned[start:end]), False, fixes
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON не разбирается: {e}") from e
+
+    # Обрыв: отрезаем по последней запятой, где префикс + закрывающие скобки дают валидный JSON
+    fixes.append('оборванный JSON')
+    # Сначала режем между элементами массивов: недописанная строка отбрасывается целиком,
+    # а не остается объектом без половины полей
+    recent = list(reversed(cuts[-MAX_CUT_ATTEMPTS:]))
+    ordered = [cut for cut in recent if cut[1][-1] == '['] + [cut for cut in recent if cut[1][-1] != '[']
+    for pos, cut_stack in ordered:
+        try:
+            return _loads(_close(cleaned[start:pos], cut_stack)), True, fixes
+        except json.JSONDecodeError:
+            continue
+    # Резать не по чему (обрыв в первом поле) — закрываем строку и скобки как есть
+    error = None
+    for candidate in _close_tails(cleaned[start:], stack, in_string):
+        try:
+            return _loads(candidate), True, fixes
+        except json.JSONDecodeError as e:
+            error = e
+    raise ValueError(f"оборванный JSON не удалось восстановить: {error}") from error
+
+
+# ==========================================
+# ПРИВЕДЕНИЕ ТИПОВ И ВАЛИДАЦИЯ ПО СХЕМЕ
+# ==========================================
+
+def _unwrap(annotation):
+    """Optional[X] -> X"""
+    if typing.get_origin(annotation) is typing.Union:
+        args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def _coerce_value(value, annotation):
+    annotation = _unwrap(annotation)
+    origin = typing.get_origin(annotation)
+    if origin in (list, typing.List) and isinstance(value, list):
+        item_type = (typing.get_args(annotation) or (typing.Any,))[0]
+        return [_coerce_value(item, item_type) for item in value]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel) and isinstance(value, dict):
+        return coerce_types(value, annotation)
+    if annotation is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if annotation is bool and isinstance(value, str) and value.strip().lower() in ('true', 'false'):
+        return value.strip().lower() == 'true'
+    if annotation is int and isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return value
+
+
+def coerce_types(data: dict, schema) -> dict:
+    """Числа строками и наоборот, "true"/"false" строкой — приводим к типам полей схемы"""
+    if not isinstance(data, dict):
+        return data
+    result = dict(data)
+    for name, field in schema.model_fields.items():
+        if name in result:
+            result[name] = _coerce_value(result[name], field.annotation)
+    return result
+
+
+def validate_partial(data, schema):
+    """
+    Валидирует по схеме; элементы списков, которые не проходят валидацию, отбрасывает
+    (одна кривая строка не должна ронять весь ответ). Возвращает (объект схемы, отброшенное).
+    """
+    data = coerce_types(data, schema)
+    dropped = []
+    for _ in range(MAX_CUT_ATTEMPTS):
+        try:
+            return schema.model_validate(data), dropped
+        except ValidationError as e:
+            bad_items = {}
+            for error in e.errors():
+                loc = error.get('loc') or ()
+                if len(loc) >= 2 and isinstance(loc[1], int) and isinstance(data.get(loc[0]), list):
+                    bad_items.setdefault(loc[0], set()).add(loc[1])
+            if not bad_items:
+                raise
+            for key, indexes in bad_items.items():
+                dropped.extend(f"{key}[{idx}]" for idx in sorted(indexes))
+                data[key] = [item for idx, item in enumerate(data[key]) if idx not in indexes]
+    return schema.model_validate(data), dropped
+
+
+# ==========================================
+# ДОЗАПРОС ОБОРВАННОГО ХВОСТА
+# ==========================================
+
+def _item_key(item) -> str:
+    return json.dumps(item, ensure_ascii=False, sort_keys=True)
+
+
+def continuation_prompt(prompt: str, data, expected_keys) -> str:
+    """Промпт на дозапрос: что уже получено и какие части нужно вернуть"""
+    data = data if isinstance(data, dict) else {}
+    missing = [key for key in expected_keys if not data.get(key)]
+    received = []
+    for key, value in data.items():
+        if isinstance(value, list) and value:
+            last = value[-1]
+            label = last.get('name') or last.get('title') or last.get('row_id') if isinstance(last, dict) else last
+            received.append(f"{key}: {len(value)} шт., последний — {label!r}")
+    return (
+        f"{prompt}\n\nТВОЙ ПРЕДЫДУЩИЙ ОТВЕТ ОБОРВАЛСЯ. Уже получено: {'; '.join(received) or 'ничего'}.\n"
+        f"Верни JSON той же структуры, но ТОЛЬКО с недостающим: элементы списков после последнего "
+        f"полученного{' и разделы ' + ', '.join(missing) if missing else ''}. Уже полученное не повторяй."
+    )
+
+
+def merge_continuation(data, tail):
+    """Дописывает хвост к оборванному ответу: списки продолжаются без дублей, пустые разделы заполняются"""
+    if not isinstance(data, dict) or not isinstance(tail, dict):
+        return data
+    result = dict(data)
+    for key, value in tail.items():
+        current = result.get(key)
+        if isinstance(current, list) and isinstance(value, list):
+            seen = {_item_key(item) for item in current}
+            result[key] = current + [item for item in value if _item_key(item) not in seen]
+        elif not current:
+            result[key] = value
+    return result
@@ -1,14 +1,43 @@
 import os
-import json
 import time
-from google import genai
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from google.genai import types
 from pathlib import Path
-from pdf2image import convert_from_path
-import PIL.Image
+from django.conf import settings
 
-from core.schemas import AIResultSchema
-from .prompts import EXTRACTOR_SYSTEM_PROMPT, INTERPRETER_SYSTEM_PROMPT, VERIFIER_SYSTEM_PROMPT
+from core.schemas import (
+    AIResultSchema, InterpretationShardSchema, InterpretationSummarySchema, VerificationPatchSchema,
+)
+from .backends import get_llm_backend
+from .breaker import get_circuit_breaker
+from .clients import client_pool
+from .cache import file_digest, get_extraction_cache
+from .errors import (
+    BREAKER_CLASSES, RETRYABLE_CLASSES, CircuitOpenError, LLMCallError,
+    PipelineDeadlineExceeded, TransientLLMError, classify_error,
+)
+from .hedging import get_hedge_pool, latency_tracker
+from .compact import (
+    compact_extraction, compact_interpretation, estimate_tokens,
+    legacy_extraction, legacy_interpretation,
+)
+from .keys import get_key_pool, parse_retry_after
+from .metrics import PipelineMetrics
+from .providers import get_provider_router
+from .patches import apply_corrections
+from .ranges import apply_statuses
+from .repair import continuation_prompt, merge_continuation, repair_json, validate_partial
+from .sharding import apply_summary, merge_shards, shard_indicators, shard_raw_data, summary_table
+from .slugs import assign_slugs
+from .verification import record_verification, verify_locally
+from .imaging import compress_image, is_blank_page, iter_pdf_pages, load_photo, page_digest
+from .prompts import (
+    EXTRACTOR_BATCH_NOTE, EXTRACTOR_SYSTEM_PROMPT, EXTRACTOR_TEXT_LAYER_NOTE,
+    INTERPRETER_SHARD_NOTE, INTERPRETER_SUMMARY_PROMPT, INTERPRETER_SYSTEM_PROMPT, VERIFIER_SYSTEM_PROMPT,
+)
+from .textlayer import extract_text_layer, is_text_layer_usable, page_skip_reason
 
 class AnalysisPipeline:
     def __init__(self):
@@ -22,106 +51,949 @@ class AnalysisPipeline:
         if not self.api_keys:
             self.api_keys = ["DUMMY_KEY"]
             
-        self.current_key_idx = 0
+        # Ключи выдает общий для всех воркеров пул (Redis): каждый вызов берет самый "здоровый"
+        self.key_pool = get_key_pool(self.api_keys)
+        self.last_key_idx = None
+        # Страницы могут извлекаться параллельно, счетчики обновляем под локом
+        self._stats_lock = threading.Lock()
         self.model_name = "gemini-2.5-flash" 
+        self.base_url = getattr(settings, 'GEMINI_BASE_URL', None)
+        # live / record / replay (см. analysis.backends)
+        self.backend = get_llm_backend()
 
-    def _get_client(self):
-        """Создает клиента с ТЕКУЩИМ активным ключом и Cloudflare прокси"""
-        return genai.Client(
-            api_key=self.api_keys[self.current_key_idx],
-            http_options={'base_url': 'https://gemini-proxy.rodionvitenberg.workers.dev/'} 
-        )
+        # 'single' — все страницы одним запросом, 'per_page' — страницы параллельно
+        self.extract_mode = getattr(settings, 'ANALYSIS_EXTRACT_MODE', 'single')
+        self.extract_workers = getattr(settings, 'ANALYSIS_EXTRACT_WORKERS', 4)
 
-    def _switch_key(self):
-        """Переключается на следующий ключ, если текущий иссяк"""
-        if self.current_key_idx < len(self.api_keys) - 1:
-            self.current_key_idx += 1
-            print(f"🔄 ЛИМИТЫ ИСЧЕРПАНЫ. Переключаюсь на резервный API KEY #{self.current_key_idx + 1}")
-            return True
-        return False
+        # Растеризация PDF: DPI, ограничение длинной стороны, ч/б и бюджет памяти на пачку страниц
+        self.pdf_dpi = getattr(settings, 'ANALYSIS_PDF_DPI', 200)
+        self.image_max_side = getattr(settings, 'ANALYSIS_IMAGE_MAX_SIDE', 0) or None
+        self.image_grayscale = getattr(settings, 'ANALYSIS_IMAGE_GRAYSCALE', False)
+        self.pdf_memory_budget_mb = getattr(settings, 'ANALYSIS_PDF_MEMORY_BUDGET_MB', 128)
+        self.pdf_thread_count = getattr(settings, 'ANALYSIS_PDF_THREADS', 2)
+
+        # Сжатие картинок перед отправкой в модель (через прокси идут уже JPEG/WebP байты)
+        self.upload_compress = getattr(settings, 'ANALYSIS_UPLOAD_COMPRESS', True)
+        self.upload_max_side = getattr(settings, 'ANALYSIS_UPLOAD_MAX_SIDE', 0) or None
+        self.upload_format = getattr(settings, 'ANALYSIS_UPLOAD_FORMAT', 'JPEG')
+        self.upload_quality = getattr(settings, 'ANALYSIS_UPLOAD_QUALITY', 80)
+        self.upload_stats = {'images': 0, 'pixel_bytes': 0, 'sent_bytes': 0}
+
+        # Цифровые PDF: извлекаем из текстового слоя (pdftotext) без растеризации и картинок
+        self.text_layer = getattr(settings, 'ANALYSIS_TEXT_LAYER', True)
+        self.text_layer_min_chars = getattr(settings, 'ANALYSIS_TEXT_LAYER_MIN_CHARS', 200)
+        # Текст страниц из pdftotext (если был), нужен фильтру страниц
+        self.page_texts = None
+
+        # Пустые листы, согласия, реклама — не отправляем в модель
+        self.page_filter = getattr(settings, 'ANALYSIS_PAGE_FILTER', True)
+        self.page_min_ink = getattr(settings, 'ANALYSIS_PAGE_MIN_INK', 0.0001)
+
+        # Страницы, уже извлеченные в прошлых загрузках пользователя (см. analysis.fingerprints).
+        # page_hashes — SHA-256 отправленных в модель страниц, reused_pages — извлечения совпавших
+        self.page_dedup = getattr(settings, 'ANALYSIS_PAGE_DEDUP', False)
+        self.fingerprints = None
+        self.page_hashes = []
+        self.reused_pages = []
+
+        # 'single' — интерпретация одним вызовом, 'sharded' — панели от SHARD_MIN показателей
+        # делятся по категориям на части до SHARD_SIZE, части параллельно + короткий вызов summary
+        self.interpret_mode = getattr(settings, 'ANALYSIS_INTERPRET_MODE', 'single')
+        self.shard_min_indicators = getattr(settings, 'ANALYSIS_INTERPRET_SHARD_MIN', 40)
+        self.shard_size = getattr(settings, 'ANALYSIS_INTERPRET_SHARD_SIZE', 25)
+        self.interpret_workers = getattr(settings, 'ANALYSIS_INTERPRET_WORKERS', 4)
+
+        # status (low/normal/high), который модель не дала, считаем сами по value + ref_range
+        # (NumPy, analysis.ranges) — если референс разобрался однозначно
+        self.local_status = getattr(settings, 'ANALYSIS_LOCAL_STATUS', True)
+
+        # Локальная сверка перед Stage 3: LLM-верификатор зовем только при расхождениях
+        self.local_verify = getattr(settings, 'ANALYSIS_LOCAL_VERIFY', True)
+        # Между этапами передаем таблицу показателей вместо полного JSON (без raw_text / reasoning)
+        self.compact_ir = getattr(settings, 'ANALYSIS_COMPACT_IR', True)
+
+        # Паузы между попытками (cooldown ключей, 5xx) не спим в воркере, а отдаем Celery:
+        # TransientLLMError -> ретрай задачи с countdown. Работает только с чекпоинтами,
+        # иначе ретрай начнет пайплайн сначала (см. run_pipeline)
+        self.defer_waits = getattr(settings, 'ANALYSIS_DEFER_RETRIES', True)
+        self._defer_active = False
+
+        # Дедлайны: таймаут HTTP-запроса на этап и общий бюджет прогона (deadline ставит run_pipeline).
+        # Hedging: если вызов дольше перцентиля недавних вызовов этапа — дубль на другом ключе
+        self.stage_timeouts = getattr(settings, 'ANALYSIS_STAGE_TIMEOUTS', {})
+        self.pipeline_budget = getattr(settings, 'ANALYSIS_PIPELINE_BUDGET', 0)
+        self.deadline = None
+        self.hedging = getattr(settings, 'ANALYSIS_HEDGE', False)
+        self.hedge_percentile = getattr(settings, 'ANALYSIS_HEDGE_PERCENTILE', 95)
+        self.hedge_min_samples = getattr(settings, 'ANALYSIS_HEDGE_MIN_SAMPLES', 20)
+
+        # Маршруты этапов по провайдерам (ANALYSIS_PROVIDER_ROUTES). None — все этапы в Gemini
+        self.router = get_provider_router()
+        # Ошибки вызова классифицируются (analysis.errors.classify_error): 400 / auth не повторяем,
+        # временные — не больше лимита своего класса. Breaker прокси общий для всех воркеров
+        self.call_retry_limits = getattr(settings, 'ANALYSIS_CALL_RETRY_LIMITS', {})
+        self.breaker = get_circuit_breaker(self.base_url)
+
+        # Время этапов, токены, ретраи — сохраняются в PipelineRun после прогона
+        self.metrics = PipelineMetrics()
+
+    def _get_client(self, key_idx):
+        """Берет из пула клиента с выбранным ключом и Cloudflare прокси"""
+        return client_pool.get(self.api_keys[key_idx], self.base_url)
+
+    def _acquire_key(self):
+        """Возвращает (idx ключа, пауза). Пауза > 0 — все ключи в cooldown или без бюджета"""
+        key_idx, wait = self.key_pool.acquire()
+        with self._stats_lock:
+            if self.last_key_idx is not None and key_idx != self.last_key_idx:
+                self.metrics.add('key_switches')
+                print(f"🔄 Переключаюсь на API KEY #{key_idx + 1}")
+            self.last_key_idx = key_idx
+        if wait:
+            print(f"❌ Все ключи исчерпаны, ближайший освободится через {wait:.0f}s")
+        return key_idx, wait
+
+    def _acquire_hedge_key(self, key_idx):
+        """
+        Ключ для дубля запроса — любой здоровый, кроме ключа основного запроса.
+        None — свободного другого ключа нет. Переключением ключа (key_switches) не считается
+        """
+        hedge_idx, wait = self.key_pool.acquire(exclude={key_idx})
+        return None if hedge_idx is None or wait else hedge_idx
+
+    def _report_success(self, key_idx, response):
+        usage = getattr(response, 'usage_metadata', None)
+        self.key_pool.report_success(key_idx, getattr(usage, 'total_token_count', None) or 0)
 
-    def _call_gemini_with_fallback(self, prompt, schema=None, mime_type="application/json", image_parts=None, max_retries=5):
-        """Обертка для вызова ИИ с автоматическим переключением ключей при 429 ошибке"""
+    def _build_request(self, prompt, schema=None, mime_type="application/json", image_parts=None, timeout=None):
+        """Собирает contents и config для generate_content (общие для sync и async пайплайна)"""
+        contents = []
+        if image_parts: contents.extend(image_parts)
+        contents.append(prompt)
+
+        config_kwargs = {"temperature": 0.2}
+        if mime_type: config_kwargs["response_mime_type"] = mime_type
+        if schema: config_kwargs["response_schema"] = schema
+        # Без таймаута зависший запрос через прокси держит анализ (и всю очередь пользователя) минутами
+        if timeout: config_kwargs["http_options"] = types.HttpOptions(timeout=int(timeout * 1000))
+        return contents, types.GenerateContentConfig(**config_kwargs)
+
+    def _call_timeout(self, stage):
+        """Таймаут очередной попытки: дедлайн этапа, но не дальше общего бюджета прогона"""
+        timeout = self.stage_timeouts.get(stage) or self.stage_timeouts.get('default')
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise PipelineDeadlineExceeded(f"{stage}: бюджет прогона {self.pipeline_budget}s исчерпан")
+            timeout = min(timeout, remaining) if timeout else remaining
+        return timeout
+
+    def _hedge_after(self, stage):
+        if not self.hedging:
+            return None
+        return latency_tracker.hedge_delay(stage, self.hedge_percentile, self.hedge_min_samples)
+
+    def _generate(self, key_idx, contents, config, stage, model=None):
+        """
+        Один вызов модели. Если включен hedging и ответа нет дольше перцентиля этапа —
+        отправляем дубль на другом ключе и берем первый успешный ответ.
+        Возвращает (response, idx ключа, который ответил).
+        """
+        model = model or self.model_name
+        started = time.monotonic()
+        hedge_after = self._hedge_after(stage)
+        if hedge_after is None:
+            response = self.backend.generate(self._get_client(key_idx), model, contents, config, stage)
+        else:
+            response, key_idx = self._generate_hedged(key_idx, contents, config, stage, hedge_after, model)
+        latency_tracker.record(stage, time.monotonic() - started)
+        return response, key_idx
+
+    def _generate_hedged(self, key_idx, contents, config, stage, hedge_after, model):
+        pool = get_hedge_pool()
+
+        def submit(idx):
+            return pool.submit(self.backend.generate, self._get_client(idx), model, contents, config, stage)
+
+        primary = submit(key_idx)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result(), key_idx
+
+        hedge_idx = self._acquire_hedge_key(key_idx)
+        if hedge_idx is None:
+            # Свободного другого ключа нет — дубль только усугубит 429
+            return primary.result(), key_idx
+        self.metrics.add('hedges')
+        print(f"🏇 {stage}: нет ответа {hedge_after:.1f}s (p{self.hedge_percentile}), дубль на API KEY #{hedge_idx + 1}")
+        futures = {primary: key_idx, submit(hedge_idx): hedge_idx}
+        pending, error = set(futures), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                # Проигравший запрос дорабатывает в фоне (ограничен таймаутом), его ответ не нужен
+                if future is not primary:
+                    self.metrics.add('hedge_wins')
+                return response, futures[future]
+        raise error
+
+    def _retry_delay(self, error, attempt, key_idx, error_class=None):
+        """Шаги плана: разбирает ошибку вызова и возвращает паузу перед следующей попыткой (0 — сразу)"""
+        error_class = error_class or classify_error(error)
+        print(f"⚠️ Gemini API Error [{error_class}] (Попытка {attempt + 1}): {error}")
+
+        # Если уперлись в лимиты (429 Resource Exhausted) — ключ в cooldown, сразу берем другой
+        if error_class == 'rate_limit':
+            yield ('blocking', self.key_pool.report_rate_limited, key_idx, parse_retry_after(error))
+            return 0
+        return 2 # При 500-х ошибках сервера просто ждем 2 сек
+
+    # ==========================================
+    # ПЛАН ВЫЗОВА МОДЕЛИ
+    # ==========================================
+    # Ретраи, переключение ключей и провайдеров, breaker и классы ошибок описаны один раз —
+    # генераторами шагов без ввода-вывода. Шаг — кортеж:
+    #   ('blocking', fn, *args) — синхронный вызов Redis (пул ключей, breaker);
+    #   ('sleep', секунды) — пауза между попытками;
+    #   ('generate', key_idx, contents, config, stage, model, timeout) — запрос к Gemini;
+    #   ('provider', provider, prompt, schema, mime_type, image_parts, timeout) — запрос к OpenAI / Anthropic.
+    # Результат шага (или его исключение) возвращается в генератор. Исполняет план _run,
+    # а AsyncAnalysisPipeline — своим _arun (await, asyncio.sleep, Redis в потоке).
+
+    def _call_gemini_with_fallback(self, prompt, schema=None, mime_type="application/json", image_parts=None, max_retries=5, stage=None, raw=False):
+        """
+        Обертка для вызова ИИ с автоматическим переключением ключей при 429 ошибке.
+        raw=True — вернуть текст ответа даже со схемой (разбором займется _call_structured)
+        """
+        return self._run(self._call_plan(prompt, schema, mime_type, image_parts, max_retries, stage, raw))
+
+    def _call_plan(self, prompt, schema=None, mime_type="application/json", image_parts=None, max_retries=5, stage=None, raw=False):
+        # Ошибки попыток этого вызова: [(класс, исключение)]
+        previous, failures = None, []
         for attempt in range(max_retries):
+            timeout = self._call_timeout(stage)
+            provider = self._route(stage, previous)
+            previous = provider
+            if provider is not None and provider.name != 'gemini':
+                started = time.monotonic()
+                try:
+                    response = yield ('provider', provider, prompt, schema, mime_type, image_parts, timeout)
+                except Exception as e:
+                    # Ошибка учтена роутером, следующая попытка выберет провайдера заново
+                    self._provider_failed(provider, stage, attempt, e, failures)
+                    continue
+                self._provider_succeeded(provider, stage, response, time.monotonic() - started)
+                return self._response_value(response, schema, raw)
+
+            breaker_wait, probe = yield from self._breaker_allow()
+            if self._proxy_open(provider, stage, breaker_wait):
+                continue
+            contents, config = self._build_request(prompt, schema, mime_type, image_parts, timeout)
+            key_idx, key_wait = yield ('blocking', self._acquire_key)
+            if key_wait:
+                # Пока ждем ключ, пробу half-open не держим — после паузы спросим breaker заново
+                if probe is not None:
+                    yield ('blocking', self.breaker.release_probe, probe)
+                if self._gemini_exhausted(provider, stage, key_wait):
+                    continue
+                # В воркере, как и раньше, ждем не больше 5 секунд, а дальше пробуем наименее загруженный ключ.
+                # Ретраю задачи отдаем полный cooldown — иначе он вернется к тем же исчерпанным ключам
+                yield from self._pause(key_wait, stage, max_sleep=5)
+                breaker_wait, probe = yield from self._breaker_allow()
+                if self._proxy_open(provider, stage, breaker_wait):
+                    continue
+            started = time.monotonic()
             try:
-                client = self._get_client()
-                
-                contents = []
-                if image_parts: contents.extend(image_parts)
-                contents.append(prompt)
-
-                config_kwargs = {"temperature": 0.2}
-                if mime_type: config_kwargs["response_mime_type"] = mime_type
-                if schema: config_kwargs["response_schema"] = schema
-
-                response = client.models.generate_content(
-                    model=self.model_name,
-                    contents=contents,
-                    config=types.GenerateContentConfig(**config_kwargs)
-                )
-                return response.parsed if schema else response.text
+                response, key_idx = yield ('generate', key_idx, contents, config, stage, self._gemini_model(provider), timeout)
+            except Exception as e:
+                if provider is not None:
+                    # 429 одного ключа — забота KeyPool, роутеру отдаем только сам факт ошибки
+                    self.router.report_error(provider)
+                delay = yield from self._call_failed(e, stage, attempt, key_idx, failures, probe)
+                if delay and not (provider is not None and self.router.has_alternative(stage, provider)):
+                    yield from self._pause(delay, stage, cause=e)
+                continue
+
+            yield ('blocking', self._gemini_succeeded, key_idx, response, probe)
+            if provider is not None:
+                self.router.report_success(provider, time.monotonic() - started)
+            self.metrics.record_call(stage, response, self._provider_label(provider))
+            return self._response_value(response, schema, raw)
+
+        raise self._calls_exhausted(stage, failures)
+
+    def _response_value(self, response, schema, raw):
+        return response.parsed if schema and not raw else response.text
 
+    def _gemini_succeeded(self, key_idx, response, probe=None):
+        self._report_success(key_idx, response)
+        if self.breaker is not None:
+            self.breaker.record_success(probe)
+
+    def _breaker_allow(self):
+        """Шаги плана: (пауза breaker, токен пробы half-open или None)"""
+        if self.breaker is None:
+            return 0, None
+        return (yield ('blocking', self.breaker.allow))
+
+    def _run(self, plan):
+        """Исполняет план вызова в текущем потоке: паузы — time.sleep"""
+        outcome, error = None, None
+        while True:
+            try:
+                step = plan.throw(error) if error is not None else plan.send(outcome)
+            except StopIteration as stop:
+                return stop.value
+            outcome, error = None, None
+            try:
+                outcome = self._execute(step)
             except Exception as e:
-                err_str = str(e).lower()
-                print(f"⚠️ Gemini API Error (Попытка {attempt + 1}): {e}")
-                
-                # Если уперлись в лимиты (429 Resource Exhausted)
-                if "429" in err_str or "exhausted" in err_str or "quota" in err_str:
-                    if self._switch_key():
-                        continue # Сразу пробуем новый ключ
-                    else:
-                        print("❌ Все резервные ключи исчерпаны!")
-                        time.sleep(5) # Ждем, вдруг лимиты сбросятся
-                else:
-                    time.sleep(2) # При 500-х ошибках сервера просто ждем 2 сек
-
-        raise Exception("Failed to call Gemini after multiple retries and key switches")
+                error = e
 
-    def _get_image_content(self, file_path: str):
-        path_obj = Path(file_path)
-        parts = []
-        if path_obj.suffix.lower() == '.pdf':
-            images = convert_from_path(file_path, dpi=200)
-            parts.extend(images)
+    def _execute(self, step):
+        kind, *args = step
+        if kind == 'sleep':
+            time.sleep(args[0])
+            return None
+        if kind == 'blocking':
+            fn, *fn_args = args
+            return fn(*fn_args)
+        if kind == 'generate':
+            key_idx, contents, config, stage, model, _ = args
+            return self._generate(key_idx, contents, config, stage, model)
+        if kind == 'provider':
+            provider, prompt, schema, mime_type, image_parts, timeout = args
+            return provider.generate(prompt, schema, mime_type, image_parts, timeout)
+        raise ValueError(f"Неизвестный шаг плана вызова: {kind}")
+
+    def _count_failure(self, error, stage, failures):
+        """Учитывает ошибку по классу; неретраибельная или сверх лимита класса — LLMCallError"""
+        error_class = classify_error(error)
+        self.metrics.record_retry(stage, error_class)
+        failures.append((error_class, error))
+        count = sum(1 for failed_class, _ in failures if failed_class == error_class)
+        if error_class not in RETRYABLE_CLASSES or count >= self.call_retry_limits.get(error_class, 5):
+            raise LLMCallError(stage, error_class, error) from error
+        return error_class
+
+    def _call_failed(self, error, stage, attempt, key_idx, failures, probe=None):
+        """Шаги плана: ошибка вызова Gemini — класс, breaker прокси и пауза перед следующей попыткой"""
+        error_class = classify_error(error)
+        if self.breaker is not None and error_class in BREAKER_CLASSES:
+            yield ('blocking', self.breaker.record_failure, probe)
+        elif probe is not None:
+            # 429 / 400 пробного вызова в half-open — не повод держать пробу до probe_timeout
+            yield ('blocking', self.breaker.release_probe, probe)
+        self._count_failure(error, stage, failures)
+        return (yield from self._retry_delay(error, attempt, key_idx, error_class))
+
+    def _calls_exhausted(self, stage, failures):
+        """Попытки кончились (ключи в cooldown, провайдеры недоступны): класс — по последней ошибке"""
+        error_class, error = failures[-1] if failures else ('other', None)
+        return LLMCallError(stage, error_class, error)
+
+    def _proxy_open(self, provider, stage, wait):
+        """
+        Breaker прокси Gemini открыт (wait — ответ breaker.allow): уходим к другому провайдеру
+        этапа, если он есть, иначе CircuitOpenError — задача паркуется, а не долбит лежащий прокси
+        """
+        if not wait:
+            return False
+        if provider is not None and self.router.has_alternative(stage, provider):
+            self.router.report_error(provider, retry_after=wait)
+            return True
+        raise CircuitOpenError(stage, wait)
+
+    def _route(self, stage, previous=None):
+        """Провайдер для очередной попытки (None — роутинга нет, идем в Gemini)"""
+        if self.router is None:
+            return None
+        provider = self.router.pick(stage)
+        if previous is not None and provider is not None and provider is not previous:
+            self.metrics.add('provider_failovers')
+            print(f"🔀 {stage}: переключаюсь с {previous.label} на {provider.label}")
+        return provider
+
+    def _gemini_model(self, provider):
+        return provider.model if provider is not None else self.model_name
+
+    def _provider_label(self, provider):
+        return provider.label if provider is not None else f"gemini:{self.model_name}"
+
+    def _gemini_exhausted(self, provider, stage, key_wait):
+        """Все ключи Gemini в cooldown: если у этапа есть другой провайдер — уходим к нему, а не ждем"""
+        if provider is None or not self.router.has_alternative(stage, provider):
+            return False
+        self.router.report_error(provider, retry_after=key_wait)
+        return True
+
+    def _provider_failed(self, provider, stage, attempt, error, failures):
+        """Ошибка OpenAI / Anthropic: учитываем в роутере и в лимитах класса"""
+        print(f"⚠️ {provider.label} Error (Попытка {attempt + 1}): {error}")
+        self.router.report_error(provider, error)
+        self._count_failure(error, stage, failures)
+
+    def _provider_succeeded(self, provider, stage, response, seconds):
+        self.router.report_success(provider, seconds)
+        self.metrics.record_call(stage, response, provider.label)
+        return response
+
+    def _pause(self, delay, stage, cause=None, max_sleep=None):
+        """
+        Шаги плана: пауза между попытками. В Celery-задаче с чекпоинтами — ретрай задачи
+        с полной паузой, иначе sleep (не дольше max_sleep, если задан)
+        """
+        if self._defer_active:
+            raise TransientLLMError(stage, delay, cause)
+        yield ('sleep', min(delay, max_sleep) if max_sleep is not None else delay)
+
+    def _repair_output(self, text, stage):
+        """Разбирает JSON-ответ с локальной починкой. Возвращает (данные, оборван ли ответ)"""
+        data, truncated, fixes = repair_json(text)
+        if fixes:
+            self.metrics.add('output_repairs')
+            print(f"🔧 {stage}: ответ модели починен локально ({', '.join(fixes)})")
+        return data, truncated
+
+    def _expected_keys(self, schema):
+        return tuple(schema.model_fields) if schema else ('patient_info', 'indicators')
+
+    def _finish_structured(self, data, schema, stage):
+        """Приводит типы и валидирует по схеме; кривые элементы списков отбрасываются"""
+        if schema is None:
+            return data
+        result, dropped = validate_partial(data, schema)
+        if dropped:
+            print(f"🔧 {stage}: отброшены невалидные элементы {dropped}")
+        return result
+
+    def _call_structured(self, prompt, schema=None, image_parts=None, stage=None, expected_keys=None):
+        """
+        Вызов с JSON-ответом. Мусор вокруг JSON, ```-обертки, висячие запятые и типы полей
+        чиним локально; если ответ оборван — дозапрашиваем только недостающий хвост,
+        а не повторяем весь вызов (и весь пайплайн через ретрай Celery).
+        """
+        return self._run(self._structured_plan(prompt, schema, image_parts, stage, expected_keys))
+
+    def _structured_plan(self, prompt, schema=None, image_parts=None, stage=None, expected_keys=None):
+        text = yield from self._call_plan(prompt=prompt, schema=schema, image_parts=image_parts, stage=stage, raw=True)
+        data, truncated = self._repair_output(text, stage)
+        if truncated:
+            tail_prompt = continuation_prompt(prompt, data, expected_keys or self._expected_keys(schema))
+            tail_text = yield from self._call_plan(prompt=tail_prompt, schema=schema, image_parts=image_parts, stage=stage, raw=True)
+            try:
+                tail, _ = self._repair_output(tail_text, stage)
+                data = merge_continuation(data, tail)
+            except ValueError as e:
+                print(f"⚠️ {stage}: дозапрос хвоста не разобрался ({e}), оставляем то, что есть")
+        return self._finish_structured(data, schema, stage)
+
+    def _iter_image_content(self, file_path: str):
+        """Отдает страницы по одной, не растеризуя весь PDF в память разом"""
+        if Path(file_path).suffix.lower() == '.pdf':
+            yield from iter_pdf_pages(
+                file_path,
+                dpi=self.pdf_dpi,
+                max_side=self.image_max_side,
+                grayscale=self.image_grayscale,
+                memory_budget_mb=self.pdf_memory_budget_mb,
+                thread_count=self.pdf_thread_count,
+            )
         else:
-            parts.append(PIL.Image.open(file_path))
-        return parts
+            yield load_photo(file_path, max_side=self.image_max_side, grayscale=self.image_grayscale)
 
-    def run_pipeline(self, file_path: str, patient_context: str = None) -> dict:
+    def _prepare_part(self, image):
+        """Stage 0.5: сжимаем страницу в JPEG/WebP и считаем сэкономленные байты"""
+        if not self.upload_compress:
+            return image
+        data, mime_type, pixel_bytes = compress_image(
+            image,
+            max_side=self.upload_max_side,
+            grayscale=self.image_grayscale,
+            fmt=self.upload_format,
+            quality=self.upload_quality,
+        )
+        with self._stats_lock:
+            self.upload_stats['images'] += 1
+            self.upload_stats['pixel_bytes'] += pixel_bytes
+            self.upload_stats['sent_bytes'] += len(data)
+        return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+    def _page_skip_reason(self, page_idx: int, image):
+        """Почему страницу не стоит отправлять в модель (None — отправляем)"""
+        if not self.page_filter:
+            return None
+        if self.page_texts and page_idx < len(self.page_texts):
+            reason = page_skip_reason(self.page_texts[page_idx])
+            if reason:
+                return reason
+        if is_blank_page(image, min_ink=self.page_min_ink):
+            return 'пустая страница'
+        return None
+
+    @property
+    def _dedup_pages(self) -> bool:
+        return self.page_dedup and self.fingerprints is not None and self.fingerprints.enabled
+
+    def _reuse_known_page(self, image) -> bool:
+        """
+        Сверяет страницу с отпечатками прошлых загрузок пользователя.
+        Совпала — кладем готовое извлечение в reused_pages, в модель страницу не шлем.
+        """
+        if not self._dedup_pages:
+            return False
+        digest = page_digest(image)
+        known = self.fingerprints.find(digest)
+        if known is None:
+            self.page_hashes.append(digest)
+            return False
+        self.reused_pages.append(known)
+        self.metrics.add('pages_reused')
+        print(f"♻️ Страница {digest[:12]} уже извлекалась в прошлой загрузке, берем готовое извлечение")
+        return True
+
+    def _remember_pages(self, new_pages):
+        """
+        Сохраняет отпечатки страниц, отправленных в модель, если извлечение привязано к каждой:
+        в 'per_page' всегда, в 'single' — когда новая страница одна. Извлечение одним запросом
+        нескольких страниц по ним не разложить — такие страницы не запоминаем.
+        Если страниц и извлечений не поровну (фильтр отдал отброшенную страницу) — не сохраняем.
+        """
+        if self.fingerprints is None or not self.page_hashes:
+            return
+        if len(new_pages) != len(self.page_hashes):
+            return
+        try:
+            self.fingerprints.save(list(zip(self.page_hashes, new_pages)))
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить отпечатки страниц: {e}")
+
+    def _combine_pages(self, new_pages):
+        """Новые извлечения + взятые из прошлых загрузок -> один RAW JSON"""
+        pages = self.reused_pages + [page for page in new_pages if page is not None]
+        if not pages:
+            return None
+        if len(pages) == 1:
+            return pages[0]
+        return merge_extractions(pages)
+
+    def _iter_upload_parts(self, file_path: str):
+        """Растеризованные и сжатые страницы; время на это пишем в этап 'rasterize'"""
+        images = self._iter_image_content(file_path)
+        sent, first_dropped = 0, None
+        for page_idx in itertools.count():
+            started = time.monotonic()
+            image = next(images, None)
+            if image is None:
+                break
+            reason = self._page_skip_reason(page_idx, image)
+            if not reason and self._reuse_known_page(image):
+                self.metrics.add_time('rasterize', time.monotonic() - started)
+                continue
+            if reason:
+                self.metrics.add('pages_dropped')
+                print(f"🗑️ Страница {page_idx + 1} пропущена: {reason}")
+                if first_dropped is None:
+                    first_dropped = image
+                self.metrics.add_time('rasterize', time.monotonic() - started)
+                continue
+            part = self._prepare_part(image)
+            self.metrics.add_time('rasterize', time.monotonic() - started)
+            sent += 1
+            yield part
+
+        # Фильтр ошибся на всех страницах — лучше отправить одну, чем ни одной
+        if not sent and first_dropped is not None and not self.reused_pages:
+            self.metrics.add('pages_dropped', -1)
+            print("⚠️ Фильтр отбросил все страницы, отправляем первую")
+            yield self._prepare_part(first_dropped)
+
+    def _get_image_content(self, file_path: str):
+        return list(self._iter_upload_parts(file_path))
+
+    def _report_upload_stats(self):
+        stats = self.upload_stats
+        if not stats['images'] or not self.upload_compress:
+            return
+        saved = stats['pixel_bytes'] - stats['sent_bytes']
+        ratio = saved / stats['pixel_bytes'] * 100 if stats['pixel_bytes'] else 0
+        print(f"🗜️ Upload: {stats['images']} изобр., отправлено {stats['sent_bytes'] // 1024} KB "
+              f"(несжатые пиксели {stats['pixel_bytes'] // 1024} KB, экономия {saved // 1024} KB / {ratio:.0f}%)")
+
+    def run_pipeline(self, file_path: str, patient_context: str = None, checkpoints=None, fingerprints=None) -> dict:
+        """
+        checkpoints — хранилище результатов этапов (см. analysis.checkpoints).
+        С ним пайплайн продолжает с последнего завершенного этапа, а ошибки пробрасывает
+        наружу, чтобы ретрай Celery повторил только упавший этап.
+        fingerprints — отпечатки страниц пользователя (см. analysis.fingerprints).
+        """
+        self.fingerprints = fingerprints
+        self._defer_active = self.defer_waits and checkpoints is not None
+        self.deadline = time.monotonic() + self.pipeline_budget if self.pipeline_budget else None
+        succeeded = False
         try:
-            print(f"--- Stage 1: Extraction ({self.model_name}) ---")
-            raw_data = self._step_extract(file_path)
+            raw_data = checkpoints.load('extract') if checkpoints else None
+            if raw_data is None:
+                print(f"--- Stage 1: Extraction ({self.model_name}) ---")
+                with self.metrics.stage('extract'):
+                    raw_data = self._step_extract(file_path)
+                if checkpoints:
+                    checkpoints.save('extract', raw_data)
+            else:
+                print("--- Stage 1: Extraction — восстановлено из чекпоинта ---")
             
-            print(f"--- Stage 2: Interpretation ({self.model_name}) ---")
-            interpreted_data = self._step_interpret(raw_data, patient_context)
+            interpreted_data = checkpoints.load('interpret') if checkpoints else None
+            if interpreted_data is None:
+                print(f"--- Stage 2: Interpretation ({self.model_name}) ---")
+                with self.metrics.stage('interpret'):
+                    interpreted_data = self._local_statuses(self._step_interpret(raw_data, patient_context))
+                if checkpoints:
+                    checkpoints.save('interpret', interpreted_data)
+            else:
+                print("--- Stage 2: Interpretation — восстановлено из чекпоинта ---")
             
             print(f"--- Stage 3: Verification ({self.model_name}) ---")
-            final_data = self._step_verify(raw_data, interpreted_data)
+            with self.metrics.stage('verify'):
+                final_data = self._step_verify(raw_data, interpreted_data)
             
-            return final_data.model_dump() if hasattr(final_data, 'model_dump') else final_data
+            succeeded = True
+            return self._finalize_result(final_data)
         except Exception as e:
             print(f"Pipeline failed: {e}")
+            if checkpoints:
+                raise
+            return None
+        finally:
+            self._finish_metrics(succeeded)
+            print(f"🔌 Gemini client pool: {client_pool.stats()}")
+
+    def _finalize_result(self, final_data) -> dict:
+        """Slug ставим сами по справочнику; status по референсу — только там, где его нет"""
+        result = final_data.model_dump() if hasattr(final_data, 'model_dump') else final_data
+        if isinstance(result, dict):
+            assign_slugs(result.get('indicators'))
+            if self.local_status:
+                apply_statuses(result.get('indicators'))
+        return result
+
+    def _local_statuses(self, interpreted_data):
+        """
+        Заполняет пустые status по референсу после интерпретации, до локальной сверки.
+        Статусы модели не трогаем: расхождение с референсом сверка отдаст LLM-верификатору
+        """
+        if not self.local_status or interpreted_data is None:
+            return interpreted_data
+        result = interpreted_data.model_dump() if hasattr(interpreted_data, 'model_dump') else interpreted_data
+        changed = apply_statuses(result.get('indicators'))
+        if not changed:
+            return interpreted_data
+        print(f"🧮 Статус по референсу проставлен у {len(changed)} показателей: {changed}")
+        return AIResultSchema.model_validate(result)
+
+    def _finish_metrics(self, succeeded: bool):
+        self.metrics.add('page_count', self.upload_stats['images'])
+        self.metrics.add('bytes_uploaded', self.upload_stats['sent_bytes'])
+        self.metrics.finish(succeeded)
+        print(f"⏱️ Pipeline metrics: {self.metrics.summary()}")
+
+    def _lookup_extraction_cache(self, file_path: str):
+        """Повторная загрузка того же файла — берем OCR из кэша по SHA-256. Возвращает (digest, данные или None)"""
+        extraction_cache = get_extraction_cache()
+        if not extraction_cache.enabled:
+            return None, None
+        digest = file_digest(file_path)
+        cached = extraction_cache.get(digest)
+        if cached is not None:
+            self.metrics.flags['extraction_cache_hit'] = True
+            print(f"♻️ Extraction cache HIT ({digest[:12]}), OCR пропущен. {extraction_cache.stats()}")
+        return digest, cached
+
+    def _store_extraction(self, digest, raw_data):
+        if isinstance(raw_data, dict):
+            assign_slugs(raw_data.get('indicators'))
+        if digest and isinstance(raw_data, dict):
+            get_extraction_cache().set(digest, raw_data)
+
+    def _read_text_layer(self, file_path: str):
+        """Текстовый слой PDF, если его достаточно для извлечения без картинок, иначе None"""
+        self.page_texts = None
+        if not self.text_layer or Path(file_path).suffix.lower() != '.pdf':
             return None
+        with self.metrics.stage('text_layer'):
+            pages = extract_text_layer(file_path)
+        self.page_texts = pages
+        if not is_text_layer_usable(pages, min_chars=self.text_layer_min_chars):
+            print("🖼️ Текстового слоя нет или он негодный — извлекаем по картинкам")
+            return None
+        self.metrics.flags['text_layer_used'] = True
+        self.metrics.add('page_count', len(pages))
+        print(f"📝 Текстовый слой PDF: {len(pages)} стр., растеризация пропущена")
+        return "\n".join(f"=== СТРАНИЦА {idx + 1} ===\n{page}" for idx, page in enumerate(pages))
+
+    def _build_text_extract_prompt(self, text: str) -> str:
+        return f"{EXTRACTOR_SYSTEM_PROMPT}\n{EXTRACTOR_TEXT_LAYER_NOTE}\n{text}"
+
+    def _extract_text(self, text: str):
+        return self._call_structured(prompt=self._build_text_extract_prompt(text), stage='extract')
 
     def _step_extract(self, file_path: str):
-        image_parts = self._get_image_content(file_path)
-        # Для извлечения сырых данных схема не всегда нужна, ИИ хорошо отдает JSON сам по промпту, 
-        # но мы используем резервный метод, если что.
-        result = self._call_gemini_with_fallback(
-            prompt=EXTRACTOR_SYSTEM_PROMPT, 
-            image_parts=image_parts,
-            mime_type="application/json"
+        digest, cached = self._lookup_extraction_cache(file_path)
+        if cached is not None:
+            return cached
+
+        text = self._read_text_layer(file_path)
+        if text is not None:
+            raw_data = self._extract_text(text)
+            self._store_extraction(digest, raw_data)
+            return raw_data
+
+        self.page_hashes, self.reused_pages = [], []
+        # Дедупликация режим не меняет: известные страницы отсеет _iter_upload_parts в любом режиме
+        if self.extract_mode == 'per_page':
+            # Страницы уходят в модель по мере растеризации, в памяти не больше workers страниц
+            new_pages = self._extract_pages_parallel(self._iter_upload_parts(file_path))
+        else:
+            image_parts = self._get_image_content(file_path)
+            # Все страницы уже извлекались раньше — модель не нужна
+            new_pages = [self._extract_images(image_parts)] if image_parts else []
+        self._report_upload_stats()
+        self._remember_pages(new_pages)
+        raw_data = self._combine_pages(new_pages)
+
+        self._store_extraction(digest, raw_data)
+        return raw_data
+
+    def _extract_images(self, image_parts):
+        # Для извлечения сырых данных схема не всегда нужна, ИИ хорошо отдает JSON сам по промпту,
+        # а дефекты ответа чинит _call_structured
+        return self._call_structured(prompt=EXTRACTOR_SYSTEM_PROMPT, image_parts=image_parts, stage='extract')
+
+    def extract_batch(self, file_paths):
+        """
+        Несколько фото разных анализов — одним запросом с разделителями "=== ДОКУМЕНТ N ===".
+        Возвращает список извлечений в порядке file_paths или None, если ответ не удалось
+        однозначно разделить по документам (тогда каждый анализ извлекается отдельно).
+        """
+        parts = []
+        for idx, file_path in enumerate(file_paths):
+            started = time.monotonic()
+            image = load_photo(file_path, max_side=self.image_max_side, grayscale=self.image_grayscale)
+            parts.extend([f"=== ДОКУМЕНТ {idx + 1} ===", self._prepare_part(image)])
+            self.metrics.add_time('rasterize', time.monotonic() - started)
+        self._report_upload_stats()
+
+        try:
+            result = self._call_structured(
+                prompt=EXTRACTOR_SYSTEM_PROMPT + EXTRACTOR_BATCH_NOTE.format(count=len(file_paths)),
+                image_parts=parts,
+                stage='extract',
+                expected_keys=('documents',),
+            )
+            documents = split_batch_extraction(result, len(file_paths))
+        except ValueError as e:
+            print(f"⚠️ Пакетное извлечение: не удалось разделить ответ ({e}), извлекаем по одному")
+            return None
+
+        cache_enabled = get_extraction_cache().enabled
+        for file_path, raw_data in zip(file_paths, documents):
+            self._store_extraction(file_digest(file_path) if cache_enabled else None, raw_data)
+        print(f"📦 Пакетное извлечение: {len(file_paths)} документов одним запросом")
+        return documents
+
+    def _extract_pages_parallel(self, image_parts):
+        """
+        Каждая страница — отдельный запрос. Время ~ самой медленной странице, а не сумме.
+        image_parts может быть генератором: новые страницы берем, только когда освободился поток.
+        """
+        workers = max(1, self.extract_workers)
+        results = {}
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for idx, part in enumerate(image_parts):
+                if len(in_flight) >= workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[in_flight.pop(future)] = future.result()
+                in_flight[pool.submit(self._extract_images, [part])] = idx
+                del part
+            for future in in_flight:
+                results[in_flight[future]] = future.result()
+
+        print(f"📄 Постраничное извлечение: {len(results)} стр., потоков: {workers}")
+        return [results[idx] for idx in sorted(results)]
+
+    def _stage_payload(self, stage: str, legacy: tuple, compact: tuple) -> tuple:
+        """Выбирает формат данных для промпта и пишет в метрики оценку размера обоих вариантов"""
+        legacy_tokens = estimate_tokens("\n".join(legacy))
+        compact_tokens = estimate_tokens("\n".join(compact))
+        self.metrics.record_prompt_size(stage, legacy_tokens, compact_tokens)
+        print(f"📉 {stage}: данные ~{legacy_tokens} tok (JSON) -> ~{compact_tokens} tok (таблица)"
+              f"{'' if self.compact_ir else ', compact выключен'}")
+        return compact if self.compact_ir else legacy
+
+    def _build_interpret_prompt(self, raw_data: dict, patient_context: str = None, note: str = ""):
+        context_str = self._context_line(patient_context)
+        raw_str, = self._stage_payload('interpret', (legacy_extraction(raw_data),), (compact_extraction(raw_data),))
+        title = "ВОТ ИСХОДНЫЕ ДАННЫЕ (таблица, id — номер строки)" if self.compact_ir else "ВОТ ИСХОДНЫЕ ДАННЫЕ (RAW JSON)"
+        return f"{INTERPRETER_SYSTEM_PROMPT}{note}\n{context_str}\n{title}:\n{raw_str}"
+
+    def _context_line(self, patient_context: str = None):
+        return f"КОНТЕКСТ ПАЦИЕНТА: {patient_context}" if patient_context else "КОНТЕКСТ ПАЦИЕНТА: Неизвестен (анализируй по общим нормам)."
+
+    def _interpret_shards(self, raw_data: dict):
+        """Части большой панели для sharded-режима или None — интерпретируем одним вызовом"""
+        rows = (raw_data or {}).get('indicators') or []
+        if self.interpret_mode != 'sharded' or len(rows) < self.shard_min_indicators:
+            return None
+        shards = shard_indicators(rows, max_size=self.shard_size)
+        if len(shards) < 2:
+            return None
+        self.metrics.add('interpret_shards', len(shards))
+        print(f"🧩 Интерпретация по частям: {len(rows)} показателей -> {[len(shard_rows) for _, shard_rows in shards]}")
+        return shards
+
+    def _build_shard_prompt(self, raw_data: dict, patient_context, categories, rows):
+        note = INTERPRETER_SHARD_NOTE.format(categories=', '.join(categories), count=len(rows))
+        return self._build_interpret_prompt(shard_raw_data(raw_data, rows), patient_context, note)
+
+    def _build_summary_prompt(self, merged: dict, patient_context: str = None):
+        return f"{INTERPRETER_SUMMARY_PROMPT}\n{self._context_line(patient_context)}\nПОКАЗАТЕЛИ:\n{summary_table(merged['indicators'])}"
+
+    def _merge_interpretation(self, merged: dict, summary):
+        return AIResultSchema.model_validate(apply_summary(merged, summary))
+
+    def _interpret_sharded(self, raw_data: dict, patient_context, shards):
+        """Части параллельно (время ~ самой большой части), затем короткий вызов summary по всей таблице"""
+        def interpret_shard(shard):
+            categories, rows = shard
+            prompt = self._build_shard_prompt(raw_data, patient_context, categories, rows)
+            return self._call_structured(prompt=prompt, schema=InterpretationShardSchema, stage='interpret')
+
+        with ThreadPoolExecutor(max_workers=max(1, self.interpret_workers)) as pool:
+            merged = merge_shards(pool.map(interpret_shard, shards))
+        prompt = self._build_summary_prompt(merged, patient_context)
+        summary = self._call_structured(prompt=prompt, schema=InterpretationSummarySchema, stage='interpret')
+        return self._merge_interpretation(merged, summary)
+
+    def _build_verify_prompt(self, raw_data: dict, interpreted_data, issues=None):
+        raw_str, interpreted_str = self._stage_payload(
+            'verify',
+            (legacy_extraction(raw_data), legacy_interpretation(interpreted_data)),
+            (compact_extraction(raw_data), compact_interpretation(raw_data, interpreted_data)),
         )
-        return json.loads(result) if isinstance(result, str) else result
+        prompt = f"{VERIFIER_SYSTEM_PROMPT}\nИСХОДНЫЕ ДАННЫЕ:\n{raw_str}\nЗАКЛЮЧЕНИЕ ИНТЕРПРЕТАТОРА:\n{interpreted_str}"
+        if issues:
+            prompt += "\nАВТОМАТИЧЕСКАЯ СВЕРКА НАШЛА РАСХОЖДЕНИЯ (проверь их в первую очередь):\n" + "\n".join(f"- {issue}" for issue in issues)
+        return prompt
+
+    def _local_verification(self, raw_data: dict, interpreted_data):
+        """
+        Сверяет заключение с исходником без LLM.
+        Возвращает список расхождений или None, если Stage 3 можно пропустить.
+        """
+        if not self.local_verify:
+            return []
+        issues = verify_locally(raw_data, interpreted_data)
+        skipped = not issues
+        self.metrics.flags['verification_skipped'] = skipped
+        stats = record_verification(skipped=skipped)
+        if skipped:
+            print(f"✅ Локальная сверка чистая, LLM-верификация пропущена. {stats}")
+            return None
+        print(f"🔎 Локальная сверка: {len(issues)} расхождений, зовем LLM-верификатор. {stats}")
+        return issues
 
     def _step_interpret(self, raw_data: dict, patient_context: str = None):
-        context_str = f"КОНТЕКСТ ПАЦИЕНТА: {patient_context}" if patient_context else "КОНТЕКСТ ПАЦИЕНТА: Неизвестен (анализируй по общим нормам)."
-        prompt = f"{INTERPRETER_SYSTEM_PROMPT}\n{context_str}\nВОТ ИСХОДНЫЕ ДАННЫЕ (RAW JSON):\n{json.dumps(raw_data, ensure_ascii=False)}"
-        
-        return self._call_gemini_with_fallback(prompt=prompt, schema=AIResultSchema)
+        shards = self._interpret_shards(raw_data)
+        if shards:
+            return self._interpret_sharded(raw_data, patient_context, shards)
+        prompt = self._build_interpret_prompt(raw_data, patient_context)
+        return self._call_structured(prompt=prompt, schema=AIResultSchema, stage='interpret')
 
     def _step_verify(self, raw_data: dict, interpreted_data):
-        interpreted_json = interpreted_data.model_dump_json() if hasattr(interpreted_data, 'model_dump_json') else json.dumps(interpreted_data, ensure_ascii=False)
-        prompt = f"{VERIFIER_SYSTEM_PROMPT}\nИСХОДНЫЕ ДАННЫЕ:\n{json.dumps(raw_data, ensure_ascii=False)}\nЗАКЛЮЧЕНИЕ ИНТЕРПРЕТАТОРА:\n{interpreted_json}"
-        
-        return self._call_gemini_with_fallback(prompt=prompt, schema=AIResultSchema)
\ No newline at end of file
+        issues = self._local_verification(raw_data, interpreted_data)
+        if issues is None:
+            return interpreted_data
+        prompt = self._build_verify_prompt(raw_data, interpreted_data, issues)
+        patch = self._call_structured(prompt=prompt, schema=VerificationPatchSchema, stage='verify')
+        return self._apply_verification(raw_data, interpreted_data, patch)
+
+    def _apply_verification(self, raw_data: dict, interpreted_data, patch):
+        """Верификатор возвращает только правки — накладываем их на заключение локально"""
+        if patch is None:
+            return None
+        corrections = getattr(patch, 'corrections', None) or []
+        if getattr(patch, 'ok', True) and not corrections:
+            print("✅ Верификатор: правок нет")
+            return interpreted_data
+        result, applied, rejected = apply_corrections(raw_data, interpreted_data, corrections)
+        print(f"🩹 Верификатор: применено {len(applied)} правок {applied}")
+        if rejected:
+            print(f"⚠️ Верификатор: отклонено {len(rejected)} правок {rejected}")
+        try:
+            return AIResultSchema.model_validate(result)
+        except ValueError as e:
+            # Правки проверяются построчно, сюда не должны дойти; но и тогда заключение без них лучше FAILED
+            print(f"⚠️ Верификатор: правки ломают заключение ({e}), оставляем его без правок")
+            return interpreted_data
+
+def _norm(value) -> str:
+    return " ".join(str(value).lower().split()) if value is not None else ""
+
+
+def split_batch_extraction(result, count: int) -> list:
+    """
+    Разбирает ответ пакетного извлечения {"documents": [{"document": N, ...}]} на count извлечений.
+    ValueError — если документов не столько, сколько отправили, или номера не сходятся.
+    """
+    documents = (result or {}).get("documents") if isinstance(result, dict) else None
+    if not isinstance(documents, list) or len(documents) != count:
+        raise ValueError(f"ожидали {count} документов, получили {len(documents) if isinstance(documents, list) else 0}")
+    by_number = {}
+    for position, document in enumerate(documents):
+        if not isinstance(document, dict) or not isinstance(document.get("indicators", []), list):
+            raise ValueError(f"документ #{position + 1} не в формате извлечения")
+        number = document.get("document", position + 1)
+        if not isinstance(number, int) or not 1 <= number <= count or number in by_number:
+            raise ValueError(f"некорректный номер документа {number!r}")
+        by_number[number] = {
+            "patient_info": document.get("patient_info") or {},
+            "indicators": document.get("indicators") or [],
+        }
+    return [by_number[number] for number in range(1, count + 1)]
+
+
+def merge_extractions(pages: list) -> dict:
+    """
+    Склеивает постраничные ответы экстрактора в один RAW JSON той же формы.
+    patient_info / lab_metadata — первое непустое значение по каждому полю,
+    indicators — по порядку страниц, без дублей (имя + значение + единица).
+    """
+    merged = {"patient_info": {}, "indicators": []}
+    raw_texts = []
+    seen = set()
+
+    for page in pages:
+        if not isinstance(page, dict):
+            continue
+        for section in ("patient_info", "lab_metadata"):
+            for field, val in (page.get(section) or {}).items():
+                if val and not merged.setdefault(section, {}).get(field):
+                    merged[section][field] = val
+        if page.get("raw_text"):
+            raw_texts.append(page["raw_text"])
+        for item in page.get("indicators") or []:
+            key = (_norm(item.get("name")), _norm(item.get("value")), _norm(item.get("unit")))
+            if key in seen:
+                continue
+            seen.add(key)
+            merged["indicators"].append(item)
+
+    if raw_texts:
+        merged["raw_text"] = "\n\n".join(raw_texts)
+    return merged
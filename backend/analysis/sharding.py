@@ -0,0 +1,85 @@
+from .compact import indicator_table
+from .slugs import category_for, resolve_slug
+from .verification import _as_dict
+
+# Большие панели (чекапы на 80-150 показателей) интерпретируем частями: показатели делятся
+# по категориям справочника (analysis.slugs), части идут в модель параллельно, а summary /
+# причины / рекомендации собирает отдельный короткий вызов по готовой таблице.
+
+OTHER_CATEGORY = 'Прочие показатели'
+# Что видит шаг summary: без reasoning и без исходных строк
+SUMMARY_COLUMNS = ('name', 'value', 'unit', 'ref_range', 'status', 'category', 'comment')
+
+
+def indicator_category(row: dict) -> str:
+    return category_for(resolve_slug(row.get('name'), row.get('unit'))) or OTHER_CATEGORY
+
+
+def shard_indicators(rows, max_size: int = 25) -> list:
+    """
+    Делит строки извлечения на части не больше max_size: сначала по категориям,
+    мелкие категории склеиваются в общую часть, крупные режутся.
+    Возвращает [(названия категорий, строки)]; порядок строк внутри части — как в документе.
+    """
+    groups = {}
+    for idx, row in enumerate(rows or []):
+        groups.setdefault(indicator_category(row), []).append((idx, row))
+
+    pieces = []
+    for category, items in groups.items():
+        for start in range(0, len(items), max_size):
+            pieces.append(([category], items[start:start + max_size]))
+
+    # First-fit по убыванию: меньше частей — меньше вызовов, а время определяет самая большая
+    shards = []
+    for categories, items in sorted(pieces, key=lambda piece: -len(piece[1])):
+        for shard in shards:
+            if len(shard[1]) + len(items) <= max_size:
+                shard[0].extend(c for c in categories if c not in shard[0])
+                shard[1].extend(items)
+                break
+        else:
+            shards.append((list(categories), list(items)))
+
+    return [
+        (categories, [row for _, row in sorted(items, key=lambda item: item[0])])
+        for categories, items in sorted(shards, key=lambda shard: min(idx for idx, _ in shard[1]))
+    ]
+
+
+def shard_raw_data(raw_data: dict, rows) -> dict:
+    """Извлечение с частью показателей: метаданные документа остаются целиком"""
+    shard = {key: value for key, value in (raw_data or {}).items() if key != 'indicators'}
+    shard['indicators'] = rows
+    return shard
+
+
+def merge_shards(results) -> dict:
+    """Склеивает ответы частей: показатели подряд, patient_info — первый непустой"""
+    merged = {'reasoning': '', 'patient_info': None, 'indicators': []}
+    reasoning = []
+    for result in results:
+        data = _as_dict(result)
+        merged['indicators'].extend(data.get('indicators') or [])
+        if merged['patient_info'] is None and data.get('patient_info'):
+            merged['patient_info'] = data['patient_info']
+        if data.get('reasoning'):
+            reasoning.append(data['reasoning'])
+    merged['reasoning'] = '\n'.join(reasoning)
+    return merged
+
+
+def summary_table(indicators) -> str:
+    return indicator_table(indicators, SUMMARY_COLUMNS, 'i')
+
+
+def apply_summary(merged: dict, summary) -> dict:
+    """Добавляет к склеенным показателям summary, причины и рекомендации"""
+    data = _as_dict(summary)
+    result = dict(merged)
+    if data.get('reasoning'):
+        result['reasoning'] = '\n'.join(part for part in (merged.get('reasoning'), data['reasoning']) if part)
+    result['summary'] = data.get('summary')
+    result['causes'] = data.get('causes') or []
+    result['recommendations'] = data.get('recommendations') or []
+    return result
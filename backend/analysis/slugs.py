@@ -0,0 +1,161 @@
+import re
+
+# ==========================================
+# СПРАВОЧНИК SLUG
+# ==========================================
+# slug -> (категория, алиасы). Алиасы нормализуются так же, как входные названия,
+# поэтому регистр, ё/е и латиница/кириллица в аббревиатурах не важны.
+
+INDICATORS = {
+    # --- ОБЩИЙ АНАЛИЗ КРОВИ (CBC) ---
+    'hemoglobin': ('Общий анализ крови', ['гемоглобин', 'hgb', 'hb', 'hemoglobin', 'haemoglobin']),
+    'rbc': ('Общий анализ крови', ['эритроциты', 'rbc', 'red blood cells', 'erythrocytes']),
+    'wbc': ('Общий анализ крови', ['лейкоциты', 'wbc', 'white blood cells', 'leukocytes']),
+    'plt': ('Общий анализ крови', ['тромбоциты', 'plt', 'platelets', 'thrombocytes']),
+    'hct': ('Общий анализ крови', ['гематокрит', 'hct', 'hematocrit', 'haematocrit']),
+    'mcv': ('Общий анализ крови', ['средний объем эритроцита', 'средний объем эритроцитов', 'mcv']),
+    'mch': ('Общий анализ крови', ['среднее содержание гемоглобина', 'среднее содерж гемоглобина',
+                                   'среднее содержание гемоглобина в эритроците', 'mch']),
+    'mchc': ('Общий анализ крови', ['средняя концентрация гемоглобина', 'средняя конц гемоглобина',
+                                    'средняя концентрация гемоглобина в эритроците', 'mchc']),
+    'esr': ('Общий анализ крови', ['соэ', 'esr', 'скорость оседания', 'скорость оседания эритроцитов']),
+
+    # --- БИОХИМИЯ ---
+    'ferritin': ('Железо и кроветворение', ['ферритин', 'ferritin']),
+    'iron_serum': ('Железо и кроветворение', ['железо сывороточное', 'железо', 'железо в сыворотке', 'fe', 'serum iron', 'iron']),
+    'glucose': ('Углеводный обмен', ['глюкоза', 'сахар', 'глюкоза в крови', 'glucose', 'glu']),
+    'protein_total': ('Биохимия', ['общий белок', 'белок общий', 'total protein', 'tp']),
+    'bilirubin_total': ('Печень', ['билирубин общий', 'общий билирубин', 'билирубин', 'total bilirubin', 'tbil']),
+    'alt': ('Печень', ['алт', 'alt', 'алат', 'аланинаминотрансфераза', 'аланинаминотрансфераза алт', 'alat', 'gpt']),
+    'ast': ('Печень', ['аст', 'ast', 'асат', 'аспартатаминотрансфераза', 'asat', 'got']),
+    'cholesterol_total': ('Липидный профиль', ['холестерин общий', 'общий холестерин', 'холестерин', 'total cholesterol', 'chol']),
+    'creatinine': ('Почки', ['креатинин', 'creatinine', 'crea']),
+    'urea': ('Почки', ['мочевина', 'urea', 'bun']),
+
+    # --- ЩИТОВИДНАЯ ЖЕЛЕЗА ---
+    'tsh': ('Щитовидная железа', ['ттг', 'tsh', 'тиреотропный гормон']),
+    'ft4': ('Щитовидная железа', ['т4 свободный', 'свободный т4', 'ft4', 'free t4', 'тироксин свободный']),
+    'ft3': ('Щитовидная железа', ['т3 свободный', 'свободный т3', 'ft3', 'free t3', 'трийодтиронин свободный']),
+    'anti_tpo': ('Щитовидная железа', ['ат-тпо', 'ат к тпо', 'антитела к тпо', 'anti-tpo', 'anti tpo',
+                                       'антитела к тиреопероксидазе']),
+}
+
+# Показатели, у которых бывает и %, и абсолютное значение: алиасы -> (slug %, slug абс.)
+SPLIT_INDICATORS = {
+    ('lym_percent', 'lym_abs'): ('Общий анализ крови', ['лимфоциты', 'lym', 'lymph', 'lymphocytes']),
+    ('neut_percent', 'neut_abs'): ('Общий анализ крови', ['нейтрофилы', 'neut', 'neu', 'neutrophils']),
+    ('mono_percent', 'mono_abs'): ('Общий анализ крови', ['моноциты', 'mono', 'mon', 'monocytes']),
+}
+
+# Слова, которые могут стоять рядом с названием и не меняют показатель
+# ("Гемоглобин общий", "Глюкоза натощак", "СОЭ по Вестергрену", "Лимфоциты, абс.")
+QUALIFIERS = {
+    'общий', 'общая', 'общее', 'натощак', 'в', 'крови', 'сыворотке', 'сыворотки', 'плазме', 'плазмы',
+    'венозной', 'капиллярной', 'по', 'вестергрену', 'панченкову', 'уровень', 'содержание',
+    'абс', 'абсолютное', 'относительное', 'количество', 'кол', 'во', 'число',
+    '%', '#', 'total', 'serum', 'blood', 'abs', 'count',
+}
+
+# Кириллица, которая в аббревиатурах выглядит как латиница (НGВ, НСТ, РLТ)
+_HOMOGLYPHS = str.maketrans('авекмнорстух', 'abekmhopctyx')
+_CYRILLIC_HOMOGLYPHS = set('авекмнорстух')
+_LATIN_ONLY = re.compile(r'^[a-z0-9]+$')
+
+
+def _fold_token(token: str) -> str:
+    """Токен из латиницы вперемешку с похожей кириллицей переводим в латиницу"""
+    if any(ch in _CYRILLIC_HOMOGLYPHS for ch in token):
+        folded = token.translate(_HOMOGLYPHS)
+        if _LATIN_ONLY.match(folded) and any('a' <= ch <= 'z' for ch in token):
+            return folded
+    return token
+
+
+def normalize_name(text) -> str:
+    text = str(text or '').lower().replace('ё', 'е')
+    text = re.sub(r'[^\w%#]+', ' ', text)
+    text = re.sub(r'([%#])', r' \1 ', text)
+    return ' '.join(_fold_token(token) for token in text.split())
+
+
+def _name_variants(name: str):
+    """'Гемоглобин (HGB, Hb)' -> полное имя, имя без скобок и каждая аббревиатура из скобок"""
+    variants = [normalize_name(name)]
+    outside = re.sub(r'\([^)]*\)', ' ', str(name))
+    variants.append(normalize_name(outside))
+    for inside in re.findall(r'\(([^)]*)\)', str(name)):
+        for chunk in re.split(r'[,;/]', inside):
+            variants.append(normalize_name(chunk))
+    return [v for v in dict.fromkeys(variants) if v]
+
+
+def _compile_index():
+    index = {}
+    for slug, (category, aliases) in INDICATORS.items():
+        for alias in aliases:
+            index[normalize_name(alias)] = (slug, category)
+    for slugs, (category, aliases) in SPLIT_INDICATORS.items():
+        for alias in aliases:
+            index[normalize_name(alias)] = (slugs, category)
+    return index
+
+
+ALIAS_INDEX = _compile_index()
+# Длинные алиасы проверяем раньше: "билирубин общий" важнее, чем "билирубин"
+_ALIASES_BY_LENGTH = sorted(ALIAS_INDEX, key=len, reverse=True)
+
+CATEGORY_BY_SLUG = {slug: category for slug, (category, _) in INDICATORS.items()}
+for _slugs, (_category, _) in SPLIT_INDICATORS.items():
+    for _slug in _slugs:
+        CATEGORY_BY_SLUG[_slug] = _category
+
+
+def _pick_split(slugs, name: str, unit) -> str:
+    """lym_percent / lym_abs: решаем по единице, а если ее нет — по названию"""
+    percent_slug, abs_slug = slugs
+    unit_norm = normalize_name(unit)
+    name_norm = normalize_name(name)
+    if '%' in unit_norm or '%' in name_norm:
+        return percent_slug
+    if unit_norm or 'абс' in name_norm or '#' in name_norm:
+        return abs_slug
+    return None
+
+
+def _lookup(name: str):
+    variants = _name_variants(name)
+    for variant in variants:
+        if variant in ALIAS_INDEX:
+            return ALIAS_INDEX[variant]
+    # Алиас целыми словами внутри названия, если остальные слова — только уточнения
+    # ("Гемоглобин общий" -> hemoglobin, но "Билирубин прямой" -> None)
+    for variant in variants:
+        padded = f' {variant} '
+        for alias in _ALIASES_BY_LENGTH:
+            if f' {alias} ' in padded:
+                rest = padded.replace(f' {alias} ', ' ', 1).split()
+                if all(token in QUALIFIERS for token in rest):
+                    return ALIAS_INDEX[alias]
+    return None
+
+
+def resolve_slug(name, unit=None):
+    """Детерминированный slug по названию показателя и единице. None — показателя нет в справочнике"""
+    found = _lookup(name)
+    if not found:
+        return None
+    slug, _ = found
+    if isinstance(slug, tuple):
+        return _pick_split(slug, name, unit)
+    return slug
+
+
+def category_for(slug):
+    return CATEGORY_BY_SLUG.get(slug)
+
+
+def assign_slugs(indicators):
+    """Проставляет slug каждой строке (список dict) на месте и возвращает его же"""
+    for item in indicators or []:
+        item['slug'] = resolve_slug(item.get('name'), item.get('unit'))
+    return indicators
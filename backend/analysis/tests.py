@@ -1,3 +1,546 @@
-from django.test import TestCase
+import random
+import time
+import typing
+from unittest import mock
 
-# Create your tests here.
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFont
+from django.test import SimpleTestCase, override_settings
+from pydantic import BaseModel, ValidationError
+
+from .breaker import CircuitBreaker
+from .cache import ExtractionCache
+from .errors import (
+    CircuitOpenError, LLMCallError, TransientLLMError, counted_retries, task_park, task_retry,
+)
+from .imaging import is_blank_page
+from .keys import KeyPool
+from .patches import apply_corrections
+from .ranges import apply_statuses, parse_ref_range, status_for
+from .repair import repair_json, validate_partial
+from .textlayer import page_skip_reason
+
+class FakeRedis:
+    """
+    Redis в памяти для KeyPool / CircuitBreaker / кэша: строки, счетчики, TTL, pipeline.
+    eval понимает только скрипты вида "удалить ключ, если в нем наш токен"
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def get(self, key):
+        return self.data[key] if self._alive(key) else None
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and self._alive(key):
+            return None
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        self.expires.pop(key, None)
+        if ex:
+            self.expire(key, ex)
+        return True
+
+    def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            removed += self._alive(key)
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return removed
+
+    def exists(self, key):
+        return int(self._alive(key))
+
+    def incrby(self, key, amount):
+        value = int(self.get(key) or 0) + amount
+        self.data[key] = str(value).encode()
+        return value
+
+    def incr(self, key):
+        return self.incrby(key, 1)
+
+    def expire(self, key, seconds):
+        if self._alive(key):
+            self.expires[key] = time.time() + seconds
+
+    def pttl(self, key):
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int((self.expires[key] - time.time()) * 1000)
+
+    def eval(self, script, numkeys, key, token):
+        if self.get(key) == str(token).encode():
+            return self.delete(key)
+        return 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+
+# Страница A4 при 200 DPI, как ее отдает iter_pdf_pages
+A4_200DPI = (1654, 2339)
+
+
+class RefRangeParsingTests(SimpleTestCase):
+    def test_two_sided_ranges(self):
+        self.assertEqual(parse_ref_range('3.3-5.5'), (3.3, 5.5))
+        self.assertEqual(parse_ref_range('3,3 – 5,5 ммоль/л'), (3.3, 5.5))
+        self.assertEqual(parse_ref_range('от 3,5 до 5,0'), (3.5, 5.0))
+        self.assertEqual(parse_ref_range('5.5-3.3'), (3.3, 5.5))
+
+    def test_upper_bounds(self):
+        self.assertEqual(parse_ref_range('<5'), (None, 5.0))
+        self.assertEqual(parse_ref_range('≤ 5.2'), (None, 5.2))
+        self.assertEqual(parse_ref_range('до 20'), (None, 20.0))
+        self.assertEqual(parse_ref_range('менее 0,5'), (None, 0.5))
+        self.assertEqual(parse_ref_range('не более 20'), (None, 20.0))
+
+    def test_lower_bounds(self):
+        self.assertEqual(parse_ref_range('> 60'), (60.0, None))
+        self.assertEqual(parse_ref_range('более 60'), (60.0, None))
+        # "менее" внутри "не менее" — это нижняя граница, а не верхняя
+        self.assertEqual(parse_ref_range('не менее 60'), (60.0, None))
+        self.assertEqual(parse_ref_range('Не менее 1,0 ммоль/л'), (1.0, None))
+
+    def test_ambiguous_or_unknown_refs(self):
+        self.assertIsNone(parse_ref_range('муж: 130-160, жен: 120-140'))
+        self.assertIsNone(parse_ref_range('М 130-160 Ж 120-140'))
+        self.assertIsNone(parse_ref_range('3-5, дети до 10'))
+        self.assertIsNone(parse_ref_range('отрицательно'))
+        self.assertIsNone(parse_ref_range(''))
+        self.assertIsNone(parse_ref_range(None))
+
+    def test_status_for(self):
+        self.assertEqual(status_for('70', 'не менее 60'), 'normal')
+        self.assertEqual(status_for('50', 'не менее 60'), 'low')
+        self.assertEqual(status_for('25', 'не более 20'), 'high')
+        self.assertEqual(status_for('4,1', '3.3-5.5'), 'normal')
+        self.assertEqual(status_for('145*', '130-160'), 'normal')
+        self.assertIsNone(status_for('140', 'муж: 130-160, жен: 120-140'))
+        self.assertIsNone(status_for('не обнаружено', '<5'))
+
+    def test_apply_statuses_fills_only_missing(self):
+        rows = [
+            {'name': 'Глюкоза', 'value': '6.1', 'ref_range': '3.3-5.5', 'status': None},
+            {'name': 'Гемоглобин', 'value': '125', 'ref_range': '130-160', 'status': 'normal'},
+            {'name': 'Ферритин', 'value': '10', 'ref_range': 'муж: 20-250, жен: 10-120', 'status': ''},
+        ]
+        self.assertEqual(apply_statuses(rows), [('Глюкоза', None, 'high')])
+        self.assertEqual([row['status'] for row in rows], ['high', 'normal', ''])
+
+
+class BlankPageTests(SimpleTestCase):
+    def _page(self, rows=0, background=255):
+        image = PIL.Image.new('L', A4_200DPI, background)
+        draw = PIL.ImageDraw.Draw(image)
+        font = PIL.ImageFont.load_default(size=28)  # ~10pt при 200 DPI
+        for row in range(rows):
+            draw.text((150, 300 + row * 50), f"Hemoglobin {120 + row} g/L    130-160", fill=0, font=font)
+        return image
+
+    def test_result_pages_are_kept(self):
+        for rows in (1, 3, 8, 15, 30):
+            with self.subTest(rows=rows):
+                self.assertFalse(is_blank_page(self._page(rows)))
+
+    def test_result_page_from_scan_is_kept(self):
+        scan = self._page(rows=1, background=235).convert('RGB')
+        self.assertFalse(is_blank_page(scan))
+
+    def test_blank_pages_are_dropped(self):
+        self.assertTrue(is_blank_page(self._page()))
+
+        # Оборот скана: серый фон, шум, проступающий текст и темные края листа
+        scan = self._page(background=240)
+        draw = PIL.ImageDraw.Draw(scan)
+        rng = random.Random(0)
+        for _ in range(3000):
+            x, y = rng.randrange(A4_200DPI[0]), rng.randrange(A4_200DPI[1])
+            draw.point((x, y), fill=rng.randrange(215, 250))
+        draw.text((150, 300), "Hemoglobin 145 g/L    130-160", fill=215, font=PIL.ImageFont.load_default(size=28))
+        draw.rectangle((0, 0, A4_200DPI[0], 30), fill=40)
+        draw.rectangle((0, 0, 25, A4_200DPI[1]), fill=40)
+        self.assertTrue(is_blank_page(scan))
+
+
+class PageSkipTests(SimpleTestCase):
+    def test_result_pages_with_reaction_are_kept(self):
+        # "Реакция" содержит "акция": маркер рекламы должен совпадать только целым словом
+        urinalysis = (
+            "ОБЩИЙ АНАЛИЗ МОЧИ\n"
+            "Цвет                 соломенно-желтый\n"
+            "Прозрачность         прозрачная\n"
+            "Реакция (pH)         кислая\n"
+            "Удельный вес         1.020      1.010-1.025\n"
+            "Белок                не обнаружено\n"
+        )
+        wassermann = (
+            "Серологические исследования\n"
+            "Реакция Вассермана (RW)     отрицательно     отрицательно\n"
+        )
+        self.assertIsNone(page_skip_reason(urinalysis))
+        self.assertIsNone(page_skip_reason(wassermann))
+
+    def test_result_page_with_privacy_footer_is_kept(self):
+        page = (
+            "Глюкоза   5,1 ммоль/л   3,3-5,5\n"
+            "Обработка персональных данных осуществляется в соответствии с 152-ФЗ\n"
+        )
+        self.assertIsNone(page_skip_reason(page))
+
+    def test_consent_page_is_skipped(self):
+        page = "ИНФОРМИРОВАННОЕ ДОБРОВОЛЬНОЕ СОГЛАСИЕ на медицинское вмешательство.\n" * 10
+        page += "Подпись пациента ________ Дата ________\n"
+        self.assertEqual(page_skip_reason(page), 'служебная страница')
+
+
+class VerifierPatchTests(SimpleTestCase):
+    def _result(self):
+        return {
+            'summary': {'is_critical': False, 'general_comment': 'Показатели в норме.'},
+            'indicators': [
+                {'name': 'Гемоглобин', 'value': '145', 'unit': 'g/L', 'ref_range': '130-160', 'status': 'normal'},
+            ],
+            'causes': [{'title': 'Недосып', 'description': 'Мало сна накануне.', 'severity': 'green'}],
+        }
+
+    def test_valid_corrections_are_applied(self):
+        result, applied, rejected = apply_corrections({}, self._result(), [
+            {'row_id': 'i1', 'field': 'value', 'value': '150'},
+            {'row_id': 'c1', 'field': 'severity', 'value': 'yellow'},
+            {'row_id': 'summary', 'field': 'is_critical', 'value': 'true'},
+        ])
+        self.assertEqual(len(applied), 3)
+        self.assertEqual(rejected, [])
+        self.assertEqual(result['indicators'][0]['value'], '150')
+        self.assertEqual(result['causes'][0]['severity'], 'yellow')
+        self.assertIs(result['summary']['is_critical'], True)
+
+    def test_null_in_required_fields_is_rejected(self):
+        result, applied, rejected = apply_corrections({}, self._result(), [
+            {'row_id': 'i1', 'field': 'value', 'value': None},
+            {'row_id': 'i1', 'field': 'name', 'value': None},
+            {'row_id': 'c1', 'field': 'description', 'value': None},
+            {'row_id': 'summary', 'field': 'general_comment', 'value': None},
+            {'row_id': 'i1', 'field': 'comment', 'value': None},
+        ])
+        self.assertEqual(len(rejected), 4)
+        self.assertEqual(applied, ['i1.comment=None'])
+        self.assertEqual(result['indicators'][0]['value'], '145')
+        self.assertEqual(result['summary']['general_comment'], 'Показатели в норме.')
+
+    def test_row_added_from_source_is_validated(self):
+        raw = {'indicators': [
+            {'name': 'Глюкоза', 'value': 6.1, 'unit': 'mmol/L', 'ref_range': '3.3-5.5'},
+            {'name': None, 'value': None},
+        ]}
+        result, applied, rejected = apply_corrections(raw, self._result(), [
+            {'row_id': 'r1', 'field': 'add', 'value': None},
+            {'row_id': 'r2', 'field': 'add', 'value': None},
+        ])
+        self.assertEqual(applied, ['r1.add=None'])
+        self.assertEqual(len(rejected), 1)
+        self.assertEqual(result['indicators'][-1]['value'], '6.1')
+        self.assertEqual(result['indicators'][-1]['status'], 'high')
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('https://proxy.test/', 'redis://localhost:6379/0', threshold=3)
+        self.breaker.redis = FakeRedis()
+
+    def _half_open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        # Пауза open прошла
+        self.breaker.redis.delete(self.breaker._key('open'))
+
+    def test_trips_after_threshold(self):
+        self.assertEqual(self.breaker.allow(), (0, None))
+        for _ in range(3):
+            self.breaker.record_failure()
+        wait, probe = self.breaker.allow()
+        self.assertGreater(wait, 0)
+        self.assertIsNone(probe)
+
+    def test_successes_do_not_reset_failures(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+            self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertGreater(self.breaker.allow()[0], 0)
+
+    def test_single_probe_in_half_open(self):
+        self._half_open()
+        wait, probe = self.breaker.allow()
+        self.assertEqual(wait, 0)
+        self.assertIsNotNone(probe)
+        self.assertEqual(self.breaker.allow(), (CircuitBreaker.PROBE_WAIT, None))
+
+    def test_only_probe_success_closes(self):
+        self._half_open()
+        _, probe = self.breaker.allow()
+        # Успех вызова, начатого до открытия, breaker не закрывает
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.stats()['half_open'])
+        self.breaker.record_success(probe)
+        self.assertFalse(self.breaker.stats()['half_open'])
+        self.assertEqual(self.breaker.allow(), (0, None))
+
+    def test_probe_failure_reopens(self):
+        self._half_open()
+        _, probe = self.breaker.allow()
+        self.breaker.record_failure(probe)
+        self.assertGreater(self.breaker.allow()[0], 0)
+
+    def test_release_probe_checks_owner(self):
+        self._half_open()
+        _, probe = self.breaker.allow()
+        self.breaker.release_probe('чужой токен')
+        self.assertEqual(self.breaker.allow(), (CircuitBreaker.PROBE_WAIT, None))
+        self.breaker.release_probe(probe)
+        wait, next_probe = self.breaker.allow()
+        self.assertEqual(wait, 0)
+        self.assertIsNotNone(next_probe)
+
+
+class RepairJsonTests(SimpleTestCase):
+    def test_clean_json(self):
+        self.assertEqual(repair_json('{"a": 1}'), ({'a': 1}, False, []))
+
+    def test_code_fences_and_trailing_commas(self):
+        data, truncated, fixes = repair_json('```json\n{"items": [1, 2,],}\n```')
+        self.assertEqual(data, {'items': [1, 2]})
+        self.assertFalse(truncated)
+        self.assertIn('code fences', fixes)
+
+    def test_text_around_json(self):
+        data, _, fixes = repair_json('Вот результат: {"a": 1} Надеюсь, помог')
+        self.assertEqual(data, {'a': 1})
+        self.assertIn('текст до JSON', fixes)
+        self.assertIn('текст после JSON', fixes)
+
+    def test_truncated_list_drops_unfinished_item(self):
+        data, truncated, _ = repair_json('{"indicators": [{"name": "A", "value": "1"}, {"name": "B", "val')
+        self.assertTrue(truncated)
+        self.assertEqual(data, {'indicators': [{'name': 'A', 'value': '1'}]})
+
+    def test_truncated_inside_first_string(self):
+        data, truncated, _ = repair_json('{"reasoning": "abc, def')
+        self.assertTrue(truncated)
+        self.assertEqual(data, {'reasoning': 'abc, def'})
+
+    def test_truncated_on_key(self):
+        self.assertEqual(repair_json('{"reasoning": "abc", "indic')[0], {'reasoning': 'abc'})
+        self.assertEqual(repair_json('{"reasoning":')[0], {'reasoning': None})
+
+    def test_truncated_after_escape(self):
+        self.assertEqual(repair_json('{"reasoning": "a\\')[0], {'reasoning': 'a'})
+
+    def test_no_json(self):
+        with self.assertRaises(ValueError):
+            repair_json('модель ответила текстом')
+
+
+class _Row(BaseModel):
+    name: str
+    value: str
+
+
+class _Rows(BaseModel):
+    indicators: typing.List[_Row]
+    reasoning: str = ''
+
+
+class ValidatePartialTests(SimpleTestCase):
+    def test_bad_items_are_dropped(self):
+        data = {'indicators': [{'name': 'A', 'value': '1'}, {'name': 'B'}, {'name': 'C', 'value': '3'}]}
+        result, dropped = validate_partial(data, _Rows)
+        self.assertEqual([row.name for row in result.indicators], ['A', 'C'])
+        self.assertEqual(dropped, ['indicators[1]'])
+
+    def test_types_are_coerced(self):
+        result, dropped = validate_partial({'indicators': [{'name': 'A', 'value': 5.2}]}, _Rows)
+        self.assertEqual(result.indicators[0].value, '5.2')
+        self.assertEqual(dropped, [])
+
+    def test_top_level_error_is_raised(self):
+        with self.assertRaises(ValidationError):
+            validate_partial({'reasoning': 'нет списка'}, _Rows)
+
+
+class KeyPoolTests(SimpleTestCase):
+    def _pool(self, keys=3, **kwargs):
+        pool = KeyPool([f'key-{idx}' for idx in range(keys)], 'redis://localhost:6379/0', **kwargs)
+        pool.redis = FakeRedis()
+        return pool
+
+    def _requests(self, pool, idx):
+        minute = int(time.time() // 60)
+        return int(pool.redis.get(pool._key(idx, 'req', minute)) or 0)
+
+    def test_least_loaded_key_is_reserved(self):
+        pool = self._pool()
+        for idx in (0, 1, 1):
+            pool.redis.incr(pool._key(idx, 'req', int(time.time() // 60)))
+        self.assertEqual(pool.acquire(), (2, 0))
+        self.assertEqual(self._requests(pool, 2), 1)
+
+    def test_cooldown_key_is_skipped(self):
+        pool = self._pool(keys=2)
+        pool.report_rate_limited(0, retry_after=30)
+        self.assertEqual(pool.acquire(), (1, 0))
+
+    def test_all_in_cooldown_returns_soonest(self):
+        pool = self._pool(keys=2)
+        pool.report_rate_limited(0, retry_after=60)
+        pool.report_rate_limited(1, retry_after=10)
+        idx, wait = pool.acquire()
+        self.assertEqual(idx, 1)
+        self.assertTrue(0 < wait <= 10)
+
+    def test_rpm_budget(self):
+        pool = self._pool(keys=2, rpm=1)
+        self.assertEqual({pool.acquire()[0], pool.acquire()[0]}, {0, 1})
+        self.assertGreater(pool.acquire()[1], 0)
+
+    def test_zero_rpm_is_unlimited(self):
+        pool = self._pool(keys=1, rpm=0, tpm=0)
+        for _ in range(50):
+            self.assertEqual(pool.acquire(), (0, 0))
+
+    def test_exclude(self):
+        pool = self._pool(keys=2)
+        self.assertEqual(pool.acquire(exclude=(0,)), (1, 0))
+        self.assertEqual(pool.acquire(exclude=(0, 1)), (None, None))
+        # Без здорового ключа hedge-запрос бюджет не резервирует
+        pool.report_rate_limited(1, retry_after=30)
+        idx, wait = pool.acquire(exclude=(0,))
+        self.assertEqual(idx, 1)
+        self.assertGreater(wait, 0)
+        self.assertEqual(self._requests(pool, 1), 1)
+
+
+class ExtractionCacheTests(SimpleTestCase):
+    def _cache(self, shared=None, **kwargs):
+        cache = ExtractionCache(redis_url='redis://localhost:6379/0' if shared else None, **kwargs)
+        if shared:
+            cache.redis = shared
+        return cache
+
+    def test_local_hit_returns_copy(self):
+        cache = self._cache()
+        cache.set('abc', {'indicators': [{'name': 'A'}]})
+        cached = cache.get('abc')
+        cached['indicators'].append({'name': 'B'})
+        self.assertEqual(cache.get('abc'), {'indicators': [{'name': 'A'}]})
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_lru_eviction(self):
+        cache = self._cache(max_entries=2)
+        cache.set('a', {'v': 1})
+        cache.set('b', {'v': 2})
+        cache.get('a')
+        cache.set('c', {'v': 3})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), {'v': 1})
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = self._cache(ttl=60)
+        with mock.patch('analysis.cache.time.monotonic', return_value=1000):
+            cache.set('a', {'v': 1})
+        with mock.patch('analysis.cache.time.monotonic', return_value=1059):
+            self.assertEqual(cache.get('a'), {'v': 1})
+        with mock.patch('analysis.cache.time.monotonic', return_value=1061):
+            self.assertIsNone(cache.get('a'))
+
+    def test_disabled(self):
+        cache = self._cache(max_entries=0)
+        cache.set('a', {'v': 1})
+        self.assertIsNone(cache.get('a'))
+
+    def test_shared_hit_from_other_process(self):
+        shared = FakeRedis()
+        self._cache(shared).set('abc', {'indicators': [{'name': 'Гемоглобин'}]})
+        self.assertIn(ExtractionCache.KEY_PREFIX + 'abc', shared.data)
+        other = self._cache(shared)
+        self.assertEqual(other.get('abc'), {'indicators': [{'name': 'Гемоглобин'}]})
+        # Из L2 запись попадает в L1
+        other.get('abc')
+        stats = other.stats()
+        self.assertEqual((stats['shared_hits'], stats['hits'], stats['misses']), (1, 1, 0))
+
+    def test_shared_miss(self):
+        cache = self._cache(FakeRedis())
+        self.assertIsNone(cache.get('abc'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+@override_settings(
+    ANALYSIS_TASK_RETRY_LIMITS={'server': 2, 'timeout': 1, 'key_wait': 3},
+    ANALYSIS_RETRY_BASE_DELAY={}, ANALYSIS_RETRY_MAX_DELAY=300, ANALYSIS_MAX_PARKS=2,
+)
+class TaskRetryTests(SimpleTestCase):
+    def test_limit_per_class(self):
+        error = LLMCallError('extract', 'server')
+        counts = {}
+        for _ in range(2):
+            error_class, counts, countdown = task_retry(error, counts, 0)
+            self.assertEqual(error_class, 'server')
+            self.assertIsNotNone(countdown)
+        self.assertIsNone(task_retry(error, counts, 0)[2])
+
+    def test_classes_are_counted_separately(self):
+        _, counts, countdown = task_retry(LLMCallError('extract', 'timeout'), {'server': 2}, 2)
+        self.assertEqual(counts, {'server': 2, 'timeout': 1})
+        self.assertIsNotNone(countdown)
+
+    def test_non_retryable(self):
+        for error_class in ('bad_request', 'auth', 'not_found'):
+            self.assertIsNone(task_retry(LLMCallError('extract', error_class), {}, 0)[2])
+
+    def test_transient_countdown_respects_delay(self):
+        _, _, countdown = task_retry(TransientLLMError('extract', 120, TimeoutError('timed out')), {}, 0)
+        self.assertGreaterEqual(countdown, 120)
+
+    def test_key_wait_is_not_a_failure(self):
+        error_class, counts, countdown = task_retry(TransientLLMError('extract', 30), {}, 0)
+        self.assertEqual(error_class, 'key_wait')
+        self.assertGreaterEqual(countdown, 30)
+        self.assertEqual(counted_retries({'key_wait': 3, 'circuit_open': 4, 'server': 1}), 1)
+
+    def test_park_limit(self):
+        error = CircuitOpenError('extract', 60)
+        counts, countdown = task_park(error, {'server': 1})
+        self.assertEqual(counts, {'server': 1, 'circuit_open': 1})
+        self.assertGreaterEqual(countdown, 60)
+        counts, _ = task_park(error, counts)
+        self.assertIsNone(task_park(error, counts)[1])
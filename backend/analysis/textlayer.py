@@ -0,0 +1,101 @@
+import re
+import subprocess
+
+# Признаки того, что в PDF есть нормальный текст, а не скан с мусорным OCR-слоем
+_LETTER_RE = re.compile(r'[A-Za-zА-Яа-яЁё]')
+_DIGIT_RE = re.compile(r'\d')
+_NUMBER_LINE_RE = re.compile(r'\d+(?:[.,]\d+)?')
+
+
+def extract_text_layer(file_path: str, timeout: int = 20):
+    """
+    Текстовый слой PDF через pdftotext (poppler, ставится вместе с pdf2image).
+    Возвращает список строк по страницам или None, если утилиты нет / PDF не читается.
+    """
+    try:
+        completed = subprocess.run(
+            ['pdftotext', '-layout', '-enc', 'UTF-8', file_path, '-'],
+            capture_output=True,
+            timeout=timeout,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"⚠️ pdftotext: текстовый слой не получен ({e})")
+        return None
+    text = completed.stdout.decode('utf-8', errors='replace')
+    # Страницы разделены form feed; последний пустой кусок после финального \f отбрасываем
+    pages = text.split('\f')
+    if pages and not pages[-1].strip():
+        pages.pop()
+    return pages
+
+
+def text_layer_quality(pages) -> dict:
+    """Простые метрики текста: сколько символов, доля букв/цифр, битые символы, строки с числами"""
+    text = '\n'.join(pages or [])
+    visible = [ch for ch in text if not ch.isspace()]
+    total = len(visible) or 1
+    lines = [line for line in text.splitlines() if line.strip()]
+    return {
+        'chars': len(visible),
+        'letters': len(_LETTER_RE.findall(text)) / total,
+        'digits': len(_DIGIT_RE.findall(text)) / total,
+        'garbage': text.count('�') / total,
+        'number_lines': sum(1 for line in lines if _NUMBER_LINE_RE.search(line) and _LETTER_RE.search(line)),
+        'empty_pages': sum(1 for page in pages or [] if not page.strip()),
+    }
+
+
+def is_text_layer_usable(pages, min_chars: int = 200, min_number_lines: int = 3) -> bool:
+    """
+    Текстового слоя хватает для извлечения без картинок, если:
+    достаточно текста, он читаемый (буквы, без битой кодировки), есть строки "название + число"
+    и нет пустых страниц (пустая страница в PDF с текстом — обычно вклеенный скан).
+    """
+    if not pages:
+        return False
+    quality = text_layer_quality(pages)
+    return (
+        quality['chars'] >= min_chars
+        and quality['letters'] >= 0.3
+        and quality['garbage'] < 0.01
+        and quality['number_lines'] >= min_number_lines
+        and quality['empty_pages'] == 0
+    )
+
+
+# Страницы без результатов: согласия, памятки, реклама. Только целые слова:
+# "акция" не должна находиться в "реакция" (общий анализ мочи, реакция Вассермана).
+# "Персональных данных" нет — это обычный колонтитул бланков лабораторий
+_NON_LAB_RE = re.compile(
+    r'\b(?:согласие на обработку|информированное добровольное согласие|скидк[аиеуой]\w*|акци[яиюей]'
+    r'|промокод\w*|подпись пациента|памятк[аиеу]|подготовка к исследованию)\b',
+    re.IGNORECASE,
+)
+# Строки с результатом: число с единицей, референс-диапазон / граница или качественный ответ
+_RESULT_LINE_RE = re.compile(
+    r'\d\s*(?:%|[a-zа-яµμ]+/[a-zа-яµμ]+|\*?\s*10\^?\d+)'
+    r'|\d\s*(?:-|–|—)\s*\d|(?:<|>|≤|≥)\s*\d'
+    r'|\b(?:отрицательн|положительн|не обнаружен|обнаружен)\w*',
+    re.IGNORECASE,
+)
+
+
+def page_skip_reason(text, min_chars: int = 300, max_number_lines: int = 1):
+    """
+    Причина не отправлять страницу в модель по ее текстовому слою, или None.
+    Решаем только по страницам, где текста много: у сканов слоя нет, их судит is_blank_page.
+    Служебной считаем страницу с маркером согласия / рекламы и без единой строки с результатом.
+    """
+    if not text or not text.strip():
+        return None
+    quality = text_layer_quality([text])
+    if quality['number_lines'] > 2 * max_number_lines + 1:
+        return None
+    if _RESULT_LINE_RE.search(text):
+        return None
+    if _NON_LAB_RE.search(text):
+        return 'служебная страница'
+    if quality['chars'] >= min_chars and quality['number_lines'] <= max_number_lines:
+        return 'нет строк с результатами'
+    return None
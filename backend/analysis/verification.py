@@ -0,0 +1,122 @@
+import threading
+from collections import Counter
+
+from .ranges import parse_number, parse_ref_range, status_for
+
+ALLOWED_STATUSES = {'low', 'normal', 'high'}
+ALLOWED_SEVERITIES = {'green', 'yellow', 'red'}
+
+# Кириллические единицы -> латиница, длинные токены раньше коротких
+_UNIT_TOKENS = [
+    ('мкмоль', 'umol'), ('ммоль', 'mmol'), ('нмоль', 'nmol'), ('пмоль', 'pmol'),
+    ('мкме', 'uiu'), ('мме', 'miu'), ('мед', 'mu'), ('ме', 'iu'),
+    ('мкг', 'ug'), ('мг', 'mg'), ('нг', 'ng'), ('пг', 'pg'),
+    ('мкл', 'ul'), ('мл', 'ml'), ('фл', 'fl'), ('дл', 'dl'),
+    ('мм/ч', 'mm/h'), ('ед', 'u'), ('г', 'g'), ('л', 'l'),
+    ('µ', 'u'), ('μ', 'u'), ('×', ''), ('*', '^'),
+]
+
+# Счетчики на процесс: сколько раз LLM-верификацию пропустили / вызвали
+VERIFICATION_STATS = Counter()
+_stats_lock = threading.Lock()
+
+
+def record_verification(skipped: bool):
+    with _stats_lock:
+        VERIFICATION_STATS['skipped' if skipped else 'escalated'] += 1
+        total = VERIFICATION_STATS['skipped'] + VERIFICATION_STATS['escalated']
+        return {**VERIFICATION_STATS, 'skip_rate': round(VERIFICATION_STATS['skipped'] / total, 3)}
+
+
+def _norm_text(value) -> str:
+    return " ".join(str(value).lower().replace('ё', 'е').split()) if value is not None else ""
+
+
+def normalize_unit(unit) -> str:
+    text = _norm_text(unit).replace(' ', '').replace('.', '')
+    for src, dst in _UNIT_TOKENS:
+        text = text.replace(src, dst)
+    return text
+
+
+def _same_value(a, b) -> bool:
+    num_a, num_b = parse_number(a), parse_number(b)
+    if num_a is not None and num_b is not None:
+        return abs(num_a - num_b) < 1e-9
+    return _norm_text(a).replace(',', '.') == _norm_text(b).replace(',', '.')
+
+
+def _same_ref(a, b) -> bool:
+    bounds_a, bounds_b = parse_ref_range(a), parse_ref_range(b)
+    if bounds_a and bounds_b:
+        return bounds_a == bounds_b
+    return _norm_text(a).replace(' ', '') == _norm_text(b).replace(' ', '')
+
+
+def _as_dict(data) -> dict:
+    if hasattr(data, 'model_dump'):
+        return data.model_dump()
+    return data or {}
+
+
+def _match_rows(raw_rows, rows):
+    """
+    Сопоставляет строки экстрактора и интерпретатора: сначала имя + значение,
+    потом только имя. Возвращает (пары, несопоставленные raw, несопоставленные interp).
+    """
+    free = list(range(len(rows)))
+    pairs, missing = [], []
+    for raw in raw_rows:
+        name = _norm_text(raw.get('name'))
+        candidates = [i for i in free if _norm_text(rows[i].get('name')) == name]
+        exact = [i for i in candidates if _same_value(rows[i].get('value'), raw.get('value'))]
+        chosen = (exact or candidates or [None])[0]
+        if chosen is None:
+            missing.append(raw)
+        else:
+            free.remove(chosen)
+            pairs.append((raw, rows[chosen]))
+    return pairs, missing, [rows[i] for i in free]
+
+
+def verify_locally(raw_data: dict, interpreted_data) -> list:
+    """
+    Детерминированная сверка RAW-извлечения с заключением интерпретатора.
+    Возвращает список расхождений (пустой — можно не звать LLM-верификатор).
+    """
+    issues = []
+    raw_rows = (raw_data or {}).get('indicators') or []
+    result = _as_dict(interpreted_data)
+    rows = result.get('indicators') or []
+
+    pairs, missing, extra = _match_rows(raw_rows, rows)
+    for raw in missing:
+        issues.append(f"Показатель '{raw.get('name')}' есть в исходнике, но пропал из заключения")
+    for row in extra:
+        issues.append(f"Показателя '{row.get('name')}' нет в исходнике")
+
+    for raw, row in pairs:
+        name = raw.get('name')
+        if not _same_value(raw.get('value'), row.get('value')):
+            issues.append(f"'{name}': значение {row.get('value')!r}, в исходнике {raw.get('value')!r}")
+        if normalize_unit(raw.get('unit')) != normalize_unit(row.get('unit')):
+            issues.append(f"'{name}': единица {row.get('unit')!r}, в исходнике {raw.get('unit')!r}")
+        if not _same_ref(raw.get('ref_range'), row.get('ref_range')):
+            issues.append(f"'{name}': референс {row.get('ref_range')!r}, в исходнике {raw.get('ref_range')!r}")
+
+        status = row.get('status')
+        if status not in ALLOWED_STATUSES:
+            issues.append(f"'{name}': недопустимый статус {status!r}")
+        else:
+            expected = status_for(raw.get('value'), raw.get('ref_range'))
+            if expected and expected != status:
+                issues.append(f"'{name}': статус {status!r}, по референсу выходит {expected!r}")
+        if not row.get('category'):
+            issues.append(f"'{name}': не указана категория")
+
+    for cause in result.get('causes') or []:
+        if cause.get('severity') not in ALLOWED_SEVERITIES:
+            issues.append(f"Причина '{cause.get('title')}': недопустимый severity {cause.get('severity')!r}")
+    if not result.get('summary'):
+        issues.append("Нет summary")
+    return issues
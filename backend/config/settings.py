@@ -150,6 +150,152 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 
+# ANALYSIS PIPELINE SETTINGS
+# Gemini ходит через Cloudflare-прокси; клиенты переиспользуются в рамках процесса воркера
+GEMINI_BASE_URL = os.getenv('GEMINI_BASE_URL', 'https://gemini-proxy.rodionvitenberg.workers.dev/')
+# Общий пул API-ключей в Redis: бюджет ключа в минуту (запросы/токены) и cooldown после 429 по умолчанию.
+# 0 — без своего бюджета: ограничивают только 429 прокси. Задавайте по квоте своего тарифа
+GEMINI_KEY_POOL_URL = os.getenv('GEMINI_KEY_POOL_URL', CELERY_BROKER_URL)
+GEMINI_KEY_RPM = int(os.getenv('GEMINI_KEY_RPM', 0))
+GEMINI_KEY_TPM = int(os.getenv('GEMINI_KEY_TPM', 0))
+GEMINI_KEY_COOLDOWN = int(os.getenv('GEMINI_KEY_COOLDOWN', 60))
+# Другие провайдеры (см. analysis.providers): без ключа провайдер в маршрутах пропускается
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', '')
+ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY', '')
+ANTHROPIC_BASE_URL = os.getenv('ANTHROPIC_BASE_URL', '')
+ANALYSIS_ANTHROPIC_MAX_TOKENS = int(os.getenv('ANALYSIS_ANTHROPIC_MAX_TOKENS', 16000))
+# Маршруты этапов: "провайдер[:модель]" через запятую, первый — основной, остальные — запасные.
+# Например ANALYSIS_PROVIDERS_INTERPRET="gemini,anthropic:claude-sonnet-4-5". Пусто — все этапы в Gemini, как раньше.
+# Провайдер с 429 или долей ошибок >= MAX_ERROR_RATE (из последних WINDOW вызовов) уходит в cooldown
+ANALYSIS_PROVIDER_ROUTES = {
+    stage: [entry.strip() for entry in os.getenv(f'ANALYSIS_PROVIDERS_{stage.upper()}', '').split(',') if entry.strip()]
+    for stage in ('extract', 'interpret', 'verify', 'default')
+    if os.getenv(f'ANALYSIS_PROVIDERS_{stage.upper()}', '').strip()
+}
+ANALYSIS_PROVIDER_WINDOW = int(os.getenv('ANALYSIS_PROVIDER_WINDOW', 50))
+ANALYSIS_PROVIDER_MIN_SAMPLES = int(os.getenv('ANALYSIS_PROVIDER_MIN_SAMPLES', 5))
+ANALYSIS_PROVIDER_MAX_ERROR_RATE = float(os.getenv('ANALYSIS_PROVIDER_MAX_ERROR_RATE', 0.5))
+ANALYSIS_PROVIDER_COOLDOWN = int(os.getenv('ANALYSIS_PROVIDER_COOLDOWN', 60))
+# Кэш результатов OCR по SHA-256 файла: размер LRU (0 — выключен) и TTL в секундах (0 — бессрочно)
+ANALYSIS_EXTRACT_CACHE_SIZE = int(os.getenv('ANALYSIS_EXTRACT_CACHE_SIZE', 256))
+ANALYSIS_EXTRACT_CACHE_TTL = int(os.getenv('ANALYSIS_EXTRACT_CACHE_TTL', 7 * 24 * 3600))
+# Дублировать кэш в Redis (общий для всех воркеров; по умолчанию тот же Redis, что у пула ключей)
+ANALYSIS_EXTRACT_CACHE_SHARED = os.getenv('ANALYSIS_EXTRACT_CACHE_SHARED', 'True') == 'True'
+ANALYSIS_EXTRACT_CACHE_URL = os.getenv('ANALYSIS_EXTRACT_CACHE_URL', GEMINI_KEY_POOL_URL)
+# Режим OCR для многостраничных PDF: 'single' (одним запросом) или 'per_page' (страницы параллельно)
+ANALYSIS_EXTRACT_MODE = os.getenv('ANALYSIS_EXTRACT_MODE', 'single')
+ANALYSIS_EXTRACT_WORKERS = int(os.getenv('ANALYSIS_EXTRACT_WORKERS', 4))
+# Растеризация: DPI, предел длинной стороны в px (0 — без ограничения), ч/б,
+# бюджет памяти на пачку страниц (МБ) и потоки poppler
+ANALYSIS_PDF_DPI = int(os.getenv('ANALYSIS_PDF_DPI', 200))
+ANALYSIS_IMAGE_MAX_SIDE = int(os.getenv('ANALYSIS_IMAGE_MAX_SIDE', 0))
+ANALYSIS_IMAGE_GRAYSCALE = os.getenv('ANALYSIS_IMAGE_GRAYSCALE') == 'True'
+ANALYSIS_PDF_MEMORY_BUDGET_MB = int(os.getenv('ANALYSIS_PDF_MEMORY_BUDGET_MB', 128))
+ANALYSIS_PDF_THREADS = int(os.getenv('ANALYSIS_PDF_THREADS', 2))
+# Сжатие картинок перед отправкой в модель: предел длинной стороны (0 — без ограничения),
+# формат (JPEG / WEBP) и качество. Ч/б берется из ANALYSIS_IMAGE_GRAYSCALE
+ANALYSIS_UPLOAD_COMPRESS = os.getenv('ANALYSIS_UPLOAD_COMPRESS', 'True') == 'True'
+ANALYSIS_UPLOAD_MAX_SIDE = int(os.getenv('ANALYSIS_UPLOAD_MAX_SIDE', 0))
+ANALYSIS_UPLOAD_FORMAT = os.getenv('ANALYSIS_UPLOAD_FORMAT', 'JPEG')
+ANALYSIS_UPLOAD_QUALITY = int(os.getenv('ANALYSIS_UPLOAD_QUALITY', 80))
+# Цифровые PDF с текстовым слоем (pdftotext) извлекаются из текста, без растеризации и картинок.
+# MIN_CHARS — минимум видимых символов, чтобы считать слой пригодным
+ANALYSIS_TEXT_LAYER = os.getenv('ANALYSIS_TEXT_LAYER', 'True') == 'True'
+ANALYSIS_TEXT_LAYER_MIN_CHARS = int(os.getenv('ANALYSIS_TEXT_LAYER_MIN_CHARS', 200))
+# Фильтр страниц перед извлечением: пустые листы (доля "чернил" ниже MIN_INK), согласия и реклама
+ANALYSIS_PAGE_FILTER = os.getenv('ANALYSIS_PAGE_FILTER', 'True') == 'True'
+ANALYSIS_PAGE_MIN_INK = float(os.getenv('ANALYSIS_PAGE_MIN_INK', 0.0001))
+# Дедупликация страниц между загрузками пользователя: только побайтно те же страницы (SHA-256 пикселей).
+# Режим извлечения не меняет: уже известные страницы в модель не шлем ни в каком режиме, но запомнить
+# страницу можно, только если ее извлечение отдельное — в 'single' это загрузка с одной новой страницей,
+# в 'per_page' любая (ценой N запросов вместо одного). DAYS — сколько дней помним страницы
+ANALYSIS_PAGE_DEDUP = os.getenv('ANALYSIS_PAGE_DEDUP', 'False') == 'True'
+ANALYSIS_PAGE_DEDUP_DAYS = int(os.getenv('ANALYSIS_PAGE_DEDUP_DAYS', 30))
+# Пакетное извлечение: несколько ожидающих фото одного пользователя одним запросом
+# (не больше MAX_DOCS документов, каждое фото не больше MAX_FILE_MB). Результат раскладывается
+# по чекпоинтам 'extract' анализов; при неудаче каждый анализ извлекается отдельно
+ANALYSIS_BATCH_EXTRACT = os.getenv('ANALYSIS_BATCH_EXTRACT', 'False') == 'True'
+ANALYSIS_BATCH_MAX_DOCS = int(os.getenv('ANALYSIS_BATCH_MAX_DOCS', 5))
+ANALYSIS_BATCH_MAX_FILE_MB = int(os.getenv('ANALYSIS_BATCH_MAX_FILE_MB', 3))
+# Локальная сверка заключения с исходником: LLM-верификатор вызывается только при расхождениях
+ANALYSIS_LOCAL_VERIFY = os.getenv('ANALYSIS_LOCAL_VERIFY', 'True') == 'True'
+# Пустой status показателей (low/normal/high) считается локально по value + ref_range; статус модели не перезаписывается
+ANALYSIS_LOCAL_STATUS = os.getenv('ANALYSIS_LOCAL_STATUS', 'True') == 'True'
+# Интерпретация: 'single' — одним вызовом, 'sharded' — панели от SHARD_MIN показателей делятся
+# по категориям справочника на части до SHARD_SIZE (до WORKERS параллельно) + отдельный вызов summary
+ANALYSIS_INTERPRET_MODE = os.getenv('ANALYSIS_INTERPRET_MODE', 'single')
+ANALYSIS_INTERPRET_SHARD_MIN = int(os.getenv('ANALYSIS_INTERPRET_SHARD_MIN', 40))
+ANALYSIS_INTERPRET_SHARD_SIZE = int(os.getenv('ANALYSIS_INTERPRET_SHARD_SIZE', 25))
+ANALYSIS_INTERPRET_WORKERS = int(os.getenv('ANALYSIS_INTERPRET_WORKERS', 4))
+# Временные сбои модели (все ключи в cooldown, 5xx) не ждем в воркере через time.sleep,
+# а перепланируем задачу Celery: countdown = BASE_DELAY этапа * 2^попытка (не больше MAX_DELAY) + jitter
+ANALYSIS_DEFER_RETRIES = os.getenv('ANALYSIS_DEFER_RETRIES', 'True') == 'True'
+ANALYSIS_TRANSIENT_MAX_RETRIES = int(os.getenv('ANALYSIS_TRANSIENT_MAX_RETRIES', 8))
+ANALYSIS_RETRY_MAX_DELAY = int(os.getenv('ANALYSIS_RETRY_MAX_DELAY', 300))
+ANALYSIS_RETRY_BASE_DELAY = {
+    'extract': int(os.getenv('ANALYSIS_RETRY_BASE_DELAY_EXTRACT', 10)),
+    'interpret': int(os.getenv('ANALYSIS_RETRY_BASE_DELAY_INTERPRET', 5)),
+    'verify': int(os.getenv('ANALYSIS_RETRY_BASE_DELAY_VERIFY', 5)),
+}
+# Ошибки вызова модели по классам (analysis.errors.classify_error): bad_request / auth / not_found
+# не повторяются совсем. Лимиты попыток класса внутри одного вызова и ретраев Celery-задачи
+ANALYSIS_CALL_RETRY_LIMITS = {
+    'rate_limit': int(os.getenv('ANALYSIS_CALL_RETRIES_RATE_LIMIT', 5)),
+    'server': int(os.getenv('ANALYSIS_CALL_RETRIES_SERVER', 3)),
+    'timeout': int(os.getenv('ANALYSIS_CALL_RETRIES_TIMEOUT', 2)),
+    'network': int(os.getenv('ANALYSIS_CALL_RETRIES_NETWORK', 3)),
+    'other': int(os.getenv('ANALYSIS_CALL_RETRIES_OTHER', 2)),
+}
+ANALYSIS_TASK_RETRY_LIMITS = {
+    'rate_limit': int(os.getenv('ANALYSIS_TASK_RETRIES_RATE_LIMIT', 3)),
+    'server': int(os.getenv('ANALYSIS_TASK_RETRIES_SERVER', 3)),
+    'timeout': int(os.getenv('ANALYSIS_TASK_RETRIES_TIMEOUT', 2)),
+    'network': int(os.getenv('ANALYSIS_TASK_RETRIES_NETWORK', 3)),
+    'deadline': int(os.getenv('ANALYSIS_TASK_RETRIES_DEADLINE', 2)),
+    'other': int(os.getenv('ANALYSIS_TASK_RETRIES_OTHER', 2)),
+    # Ожидание свободного ключа пула — не сбой, в ANALYSIS_TRANSIENT_MAX_RETRIES не считается
+    'key_wait': int(os.getenv('ANALYSIS_TASK_RETRIES_KEY_WAIT', 20)),
+}
+# Circuit breaker прокси (состояние в Redis пула ключей): THRESHOLD ошибок 5xx / таймаутов / сети
+# за WINDOW секунд открывают его на OPEN_SECONDS — задачи паркуются в PENDING, а не ретраятся
+ANALYSIS_BREAKER = os.getenv('ANALYSIS_BREAKER', 'True') == 'True'
+ANALYSIS_BREAKER_THRESHOLD = int(os.getenv('ANALYSIS_BREAKER_THRESHOLD', 5))
+ANALYSIS_BREAKER_WINDOW = int(os.getenv('ANALYSIS_BREAKER_WINDOW', 60))
+ANALYSIS_BREAKER_OPEN_SECONDS = int(os.getenv('ANALYSIS_BREAKER_OPEN_SECONDS', 60))
+# Сколько раз анализ можно парковать при открытом breaker, прежде чем он уйдет в FAILED
+ANALYSIS_MAX_PARKS = int(os.getenv('ANALYSIS_MAX_PARKS', 30))
+# Дедлайны вызовов модели (сек): HTTP-таймаут попытки по этапам и общий бюджет одного прогона.
+# Hedging: если ответа нет дольше PERCENTILE-го перцентиля недавних вызовов этапа
+# (нужно не меньше MIN_SAMPLES замеров) — дубль на другом ключе, берем первый ответ
+ANALYSIS_STAGE_TIMEOUTS = {
+    'extract': int(os.getenv('ANALYSIS_TIMEOUT_EXTRACT', 120)),
+    'interpret': int(os.getenv('ANALYSIS_TIMEOUT_INTERPRET', 90)),
+    'verify': int(os.getenv('ANALYSIS_TIMEOUT_VERIFY', 60)),
+    'default': int(os.getenv('ANALYSIS_TIMEOUT_DEFAULT', 90)),
+}
+ANALYSIS_PIPELINE_BUDGET = int(os.getenv('ANALYSIS_PIPELINE_BUDGET', 600))
+ANALYSIS_HEDGE = os.getenv('ANALYSIS_HEDGE', 'False') == 'True'
+ANALYSIS_HEDGE_PERCENTILE = int(os.getenv('ANALYSIS_HEDGE_PERCENTILE', 95))
+ANALYSIS_HEDGE_MIN_SAMPLES = int(os.getenv('ANALYSIS_HEDGE_MIN_SAMPLES', 20))
+ANALYSIS_HEDGE_THREADS = int(os.getenv('ANALYSIS_HEDGE_THREADS', 16))
+# Компактный формат между этапами: таблица показателей с ID строк вместо полного JSON
+# (без raw_text экстрактора и reasoning интерпретатора). False — старый формат, для сравнения токенов
+ANALYSIS_COMPACT_IR = os.getenv('ANALYSIS_COMPACT_IR', 'True') == 'True'
+# Бэкенд модели: live (Gemini), record (live + запись ответов), replay (ответы из записей, без сети).
+# Для replay можно добавить задержку (сек) и долю искусственных 429 / 5xx
+ANALYSIS_LLM_BACKEND = os.getenv('ANALYSIS_LLM_BACKEND', 'live')
+ANALYSIS_LLM_RECORDINGS_DIR = os.getenv('ANALYSIS_LLM_RECORDINGS_DIR', str(BASE_DIR / 'llm_recordings'))
+ANALYSIS_REPLAY_LATENCY = float(os.getenv('ANALYSIS_REPLAY_LATENCY', 0))
+ANALYSIS_REPLAY_JITTER = float(os.getenv('ANALYSIS_REPLAY_JITTER', 0))
+ANALYSIS_REPLAY_429_RATE = float(os.getenv('ANALYSIS_REPLAY_429_RATE', 0))
+ANALYSIS_REPLAY_5XX_RATE = float(os.getenv('ANALYSIS_REPLAY_5XX_RATE', 0))
+# asyncio-воркер (manage.py run_async_worker) вместо Celery prefork: анализы идут в Redis-очередь
+ANALYSIS_ASYNC_WORKER = os.getenv('ANALYSIS_ASYNC_WORKER') == 'True'
+ANALYSIS_ASYNC_CONCURRENCY = int(os.getenv('ANALYSIS_ASYNC_CONCURRENCY', 32))
+ANALYSIS_ASYNC_QUEUE = os.getenv('ANALYSIS_ASYNC_QUEUE', 'analysis:async:queue')
+ANALYSIS_ASYNC_QUEUE_URL = os.getenv('ANALYSIS_ASYNC_QUEUE_URL', CELERY_BROKER_URL)
+
 # CORS CONFIGURATION
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
@@ -40,7 +40,8 @@ from .schemas import (
     ClaimRequestOTPSchema,
     ClaimVerifyOTPSchema,
 )
-from .tasks import process_analysis_task
+from .services import indicator_statuses
+from .tasks import enqueue_analysis
 
 # --- Схемы для Авторизации ---
 
@@ -255,7 +256,7 @@ def claim_verify(request, payload: ClaimVerifyOTPSchema):
     # ИЗМЕНЕНИЕ: Ищем только ПЕРВЫЙ анализ, который висит в PENDING, и пинаем его.
     first_pending = analyses.filter(status=MedicalAnalysis.Status.PENDING).first()
     if first_pending:
-        process_analysis_task.delay(first_pending.uid)
+        enqueue_analysis(first_pending.uid)
 
     refresh = RefreshToken.for_user(user)
     return {
@@ -364,7 +365,7 @@ def upload_analysis(request, file: UploadedFile = File(...), is_first: bool = Fo
     # ИЗМЕНЕНИЕ: Независимо от авторизации, мы отправляем в Celery ТОЛЬКО первый файл.
     # Остальные файлы лягут в БД со статусом PENDING и будут запущены по цепочке!
     if is_first:
-        transaction.on_commit(lambda: process_analysis_task.delay(analysis.uid))
+        transaction.on_commit(lambda: enqueue_analysis(analysis.uid))
         
     return analysis
 
@@ -425,13 +426,19 @@ def delete_profile(request, profile_id: int):
 def get_patient_history(request, patient_id: int, slugs: str = None):
     profile = get_object_or_404(PatientProfile, id=patient_id, user=request.user)
     
-    indicators_qs = AnalysisIndicator.objects.filter(patient=profile).order_by('date')
+    indicators_qs = AnalysisIndicator.objects.filter(patient=profile).select_related('analysis').order_by('date')
     if slugs:
         slug_list = [s.strip() for s in slugs.split(',')]
         indicators_qs = indicators_qs.filter(slug__in=slug_list)
+
+    records = list(indicators_qs)
+    # Статус точки — сохраненный (модель / верификатор приоритетнее референса, см. save_atomic_indicators);
+    # для старых записей без статуса — по референсу, одним проходом NumPy по всей истории
+    computed = iter(indicator_statuses([record for record in records if not record.status]))
+    statuses = [record.status or next(computed) for record in records]
     
     grouped_data = {} 
-    for record in indicators_qs:
+    for record, status in zip(records, statuses):
         if record.slug not in grouped_data:
             grouped_data[record.slug] = {"name": record.name, "points": []}
         if record.value is not None:
@@ -439,6 +446,9 @@ def get_patient_history(request, patient_id: int, slugs: str = None):
                 "date": record.date,
                 "value": record.value,
                 "unit": record.unit,
+                "status": status,
+                "ref_low": record.ref_low,
+                "ref_high": record.ref_high,
                 "analysis_uid": record.analysis.uid
             })
             
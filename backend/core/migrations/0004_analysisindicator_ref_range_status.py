@@ -0,0 +1,101 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:00
+
+import re
+
+from django.db import migrations, models
+
+# Копия разбора референсов из analysis.ranges на момент миграции: миграция не должна
+# зависеть от кода приложения (он будет меняться) и от NumPy
+NUMBER = r'[-+]?\d+(?:[.,]\d+)?'
+BETWEEN_RE = re.compile(rf'\b(?:от|from)\s*({NUMBER}).*?\b(?:до|to)\s*({NUMBER})', re.IGNORECASE)
+DASH_RE = re.compile(rf'({NUMBER})\s*(?:-|–|—|\.\.\.?)\s*({NUMBER})')
+UPPER_RE = re.compile(
+    rf'(?:<=|<|≤|\b(?:до|up to)|(?<!не )\b(?:менее|меньше|ниже)|\bне (?:более|больше|выше|превышает))\s*({NUMBER})',
+    re.IGNORECASE,
+)
+LOWER_RE = re.compile(
+    rf'(?:>=|>|≥|\bот|(?<!не )\b(?:более|больше|выше|свыше)|\bне (?:менее|меньше|ниже))\s*({NUMBER})',
+    re.IGNORECASE,
+)
+STATUSES = ('low', 'normal', 'high')
+
+
+def to_float(text):
+    return float(text.replace(',', '.'))
+
+
+def parse_ref_range(text):
+    """(low, high) или None, если референс не распознан или неоднозначен (несколько диапазонов)"""
+    if not text:
+        return None
+    rest = " ".join(str(text).split())
+    found = []
+    for regex in (BETWEEN_RE, DASH_RE):
+        found.extend((to_float(low), to_float(high)) for low, high in regex.findall(rest))
+        rest = regex.sub(' ', rest)
+    found.extend((None, to_float(high)) for high in UPPER_RE.findall(rest))
+    found.extend((to_float(low), None) for low in LOWER_RE.findall(rest))
+    if len(found) != 1:
+        return None
+    low, high = found[0]
+    if low is not None and high is not None and low > high:
+        return high, low
+    return low, high
+
+
+def status_for(value, low, high):
+    if value is None or (low is None and high is None):
+        return ''
+    if low is not None and value < low:
+        return 'low'
+    if high is not None and value > high:
+        return 'high'
+    return 'normal'
+
+
+def backfill_ref_ranges(apps, schema_editor):
+    """Референсы уже сохраненных показателей берем из ai_result один раз — дальше история обходится без него"""
+    AnalysisIndicator = apps.get_model('core', 'AnalysisIndicator')
+    MedicalAnalysis = apps.get_model('core', 'MedicalAnalysis')
+
+    analyses = MedicalAnalysis.objects.filter(atomic_indicators__isnull=False).distinct()
+    for analysis in analyses.iterator():
+        items_by_slug = {
+            item.get('slug'): item
+            for item in (analysis.ai_result or {}).get('indicators') or []
+            if isinstance(item, dict) and item.get('slug')
+        }
+        records = list(AnalysisIndicator.objects.filter(analysis=analysis))
+        for record in records:
+            item = items_by_slug.get(record.slug) or {}
+            record.ref_low, record.ref_high = parse_ref_range(item.get('ref_range')) or (None, None)
+            # Статус из заключения приоритетнее посчитанного по референсу
+            status = item.get('status')
+            record.status = status if status in STATUSES else status_for(record.value, record.ref_low, record.ref_high)
+        AnalysisIndicator.objects.bulk_update(records, ['ref_low', 'ref_high', 'status'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_analysisindicator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisindicator',
+            name='ref_low',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysisindicator',
+            name='ref_high',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysisindicator',
+            name='status',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+        migrations.RunPython(backfill_ref_ranges, migrations.RunPython.noop),
+    ]
@@ -105,6 +105,12 @@ class AnalysisIndicator(models.Model):
     string_value = models.CharField(max_length=50)
     
     unit = models.CharField(max_length=50, null=True, blank=True)
+
+    # Референс, разобранный в числа (любая граница может отсутствовать), и статус по нему.
+    # Позволяют отмечать выходы за норму в истории без чтения ai_result
+    ref_low = models.FloatField(null=True, blank=True)
+    ref_high = models.FloatField(null=True, blank=True)
+    status = models.CharField(max_length=10, blank=True, default='')
     
     # Дата взятия анализа (берем из анализа или OCR)
     date = models.DateField(default=datetime.date.today)
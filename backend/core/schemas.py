@@ -43,6 +43,30 @@ class AIResultSchema(Schema):
     causes: List[CauseSchema] = []
     recommendations: List[RecommendationSchema] = []
 
+class InterpretationShardSchema(Schema):
+    # Часть большой панели: только показатели, summary / причины собирает отдельный вызов
+    reasoning: Optional[str] = ""
+    patient_info: Optional[PatientMetadataSchema] = None
+    indicators: List[IndicatorSchema] = []
+
+class InterpretationSummarySchema(Schema):
+    reasoning: Optional[str] = ""
+    summary: Optional[SummarySchema] = None
+    causes: List[CauseSchema] = []
+    recommendations: List[RecommendationSchema] = []
+
+class CorrectionSchema(Schema):
+    # ID строки из таблицы верификатора: i1.. (показатель), r1.. (строка исходника), c1.. (причина), summary
+    row_id: str
+    # Поле показателя / причины / summary, либо "remove" (удалить строку iN) / "add" (добавить строку rN)
+    field: str
+    value: Optional[str] = None
+
+class VerificationPatchSchema(Schema):
+    # true — заключение верное, corrections пустой
+    ok: bool = True
+    corrections: List[CorrectionSchema] = []
+
 class PatientProfileSchema(Schema):
     id: int
     full_name: str
@@ -90,6 +114,10 @@ class IndicatorHistoryPoint(Schema):
     date: date  # <--- ИСПРАВЛЕНО: было datetime.date, стало просто date
     value: float
     unit: Optional[str] = None
+    # low / normal / high по референсу этого анализа, None — референса нет
+    status: Optional[str] = None
+    ref_low: Optional[float] = None
+    ref_high: Optional[float] = None
     analysis_uid: uuid.UUID
 
 class ChartResponseSchema(Schema):
@@ -1,8 +1,83 @@
 from django.db import transaction
+from django.utils import timezone
 from .models import MedicalAnalysis, AnalysisIndicator, PatientProfile
+from analysis.ranges import evaluate_statuses, parse_ref_range, status_labels
 import datetime
 import re
 
+# Статусы показателя, которые понимает история (графики, отметки выхода за норму)
+INDICATOR_STATUSES = ('low', 'normal', 'high')
+
+
+def build_patient_context(analysis: MedicalAnalysis) -> str:
+    """
+    Текстовый контекст для интерпретатора: пол, дата рождения
+    и последние значения показателей пациента за полгода.
+    """
+    patient_context = ""
+    if analysis.patient:
+        age_str = f", Дата рождения: {analysis.patient.birth_date}" if analysis.patient.birth_date else ""
+        gender_str = f"Пол: {analysis.patient.get_gender_display()}" if analysis.patient.gender else "Пол: Не указан"
+        patient_context = f"{gender_str}{age_str}"
+        
+        six_months_ago = timezone.now().date() - datetime.timedelta(days=180)
+        
+        past_indicators = AnalysisIndicator.objects.filter(
+            patient=analysis.patient, 
+            date__gte=six_months_ago,
+            value__isnull=False
+        ).exclude(analysis=analysis).order_by('-date')
+        
+        if past_indicators.exists():
+            hist_dict = {}
+            for ind in past_indicators:
+                if ind.name not in hist_dict:
+                    hist_dict[ind.name] = f"{ind.value} {ind.unit or ''} (от {ind.date.strftime('%d.%m.%Y')})"
+            
+            if hist_dict:
+                history_str = "\n\nИСТОРИЯ ПРЕДЫДУЩИХ АНАЛИЗОВ ПАЦИЕНТА:\n"
+                for name, val in hist_dict.items():
+                    history_str += f"- {name}: {val}\n"
+                patient_context += history_str
+    return patient_context
+
+
+def apply_pipeline_result(analysis: MedicalAnalysis, result) -> bool:
+    """
+    Сохраняет результат пайплайна в анализ (COMPLETED) или помечает его FAILED,
+    если пайплайн ничего не вернул. Возвращает True, если анализ готов.
+    """
+    analysis.refresh_from_db()
+    if not result:
+        analysis.status = MedicalAnalysis.Status.FAILED
+        analysis.save(update_fields=['status'])
+        return False
+
+    analysis.ai_result = result
+    analysis.status = MedicalAnalysis.Status.COMPLETED
+    
+    if analysis.user:
+        ext_name = None
+        if isinstance(result, dict) and 'patient_info' in result and result['patient_info']:
+            ext_name = result['patient_info'].get('extracted_name')
+        elif hasattr(result, 'patient_info') and result.patient_info:
+            ext_name = getattr(result.patient_info, 'extracted_name', None)
+        
+        if ext_name and str(ext_name).strip() and str(ext_name).lower() != 'null':
+            name_str = str(ext_name).strip()
+            profile = PatientProfile.objects.filter(user=analysis.user, full_name__iexact=name_str).first()
+            if not profile:
+                profile = PatientProfile.objects.create(user=analysis.user, full_name=name_str)
+            analysis.patient = profile
+            
+    analysis.save(update_fields=['ai_result', 'status', 'patient'])
+    
+    try:
+        save_atomic_indicators(analysis, result)
+    except Exception as db_err:
+        print(f"⚠️ Error saving atomic indicators: {db_err}")
+    return True
+
 def save_atomic_indicators(analysis: MedicalAnalysis, ai_result: dict):
     """
     Парсит JSON-результат, АВТОМАТИЧЕСКИ СОЗДАЕТ ПАЦИЕНТА по имени из отчета
@@ -63,6 +138,8 @@ def save_atomic_indicators(analysis: MedicalAnalysis, ai_result: dict):
             pass # Если формат кривой, оставляем дату загрузки файла
     
     new_records = []
+    # Статусы из заключения (модель / верификатор), по одному на запись
+    result_statuses = []
     
     for item in indicators_data:
         slug = item.get('slug')
@@ -81,6 +158,8 @@ def save_atomic_indicators(analysis: MedicalAnalysis, ai_result: dict):
         except ValueError:
             pass 
 
+        ref_low, ref_high = parse_ref_range(item.get('ref_range')) or (None, None)
+
         record = AnalysisIndicator(
             analysis=analysis,
             patient=analysis.patient, # Используем нашего ПРАВИЛЬНОГО пациента
@@ -89,13 +168,36 @@ def save_atomic_indicators(analysis: MedicalAnalysis, ai_result: dict):
             value=num_value,
             string_value=str(raw_value)[:50],
             unit=item.get('unit'),
+            ref_low=ref_low,
+            ref_high=ref_high,
             date=analysis_date
         )
         new_records.append(record)
+        result_statuses.append(item.get('status'))
+
+    # Статус — как в заключении; где его нет — одним векторным сравнением с референсами
+    for record, result_status, status in zip(new_records, result_statuses, indicator_statuses(new_records)):
+        record.status = result_status if result_status in INDICATOR_STATUSES else (status or '')
 
     # Массово пишем в БД
     if new_records:
         with transaction.atomic():
             AnalysisIndicator.objects.filter(analysis=analysis).delete()
             AnalysisIndicator.objects.bulk_create(new_records)
-        print(f"✅ Сохранено {len(new_records)} показателей для профиля: {analysis.patient.full_name}")
\ No newline at end of file
+        print(f"✅ Сохранено {len(new_records)} показателей для профиля: {analysis.patient.full_name}")
+
+
+def indicator_statuses(records) -> list:
+    """
+    Статусы (low / normal / high, None — не посчитать) для списка AnalysisIndicator:
+    value и границы референса сравниваются массивами NumPy, без чтения ai_result.
+    Годится и для всей истории пациента разом.
+    """
+    if not records:
+        return []
+    codes = evaluate_statuses(
+        [record.value for record in records],
+        [record.ref_low for record in records],
+        [record.ref_high for record in records],
+    )
+    return status_labels(codes)
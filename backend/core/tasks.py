@@ -1,10 +1,29 @@
 from celery import shared_task
-from .models import MedicalAnalysis, AnalysisIndicator, PatientProfile
+from django.conf import settings
+from .models import MedicalAnalysis
 from analysis.services import AnalysisPipeline 
-from core.services import save_atomic_indicators
-from django.utils import timezone
-from datetime import timedelta
-import time
+from analysis.batching import prefetch_batch_extraction
+from analysis.checkpoints import AnalysisCheckpoints
+from analysis.claims import get_analysis_claim
+from analysis.errors import (
+    CircuitOpenError, TransientLLMError, counted_retries, retry_countdown, task_park, task_retry,
+)
+from analysis.fingerprints import PageFingerprints
+from analysis.metrics import save_pipeline_metrics
+from core.services import apply_pipeline_result, build_patient_context
+
+def enqueue_analysis(analysis_uid):
+    """
+    Ставит анализ в очередь обработки.
+    По умолчанию — Celery-задача; при ANALYSIS_ASYNC_WORKER=True — очередь в Redis,
+    которую разбирает asyncio-воркер (manage.py run_async_worker).
+    """
+    if getattr(settings, 'ANALYSIS_ASYNC_WORKER', False):
+        from analysis.async_pipeline import push_to_async_queue
+        push_to_async_queue(analysis_uid)
+    else:
+        process_analysis_task.delay(analysis_uid)
+
 
 def trigger_next_analysis(analysis):
     """
@@ -19,104 +38,157 @@ def trigger_next_analysis(analysis):
         
         if next_pending:
             print(f"🔗 Цепная реакция: Запускаем следующий анализ ({next_pending.uid})")
-            process_analysis_task.delay(next_pending.uid)
+            enqueue_analysis(next_pending.uid)
 
 
-@shared_task(bind=True, max_retries=5)
-def process_analysis_task(self, analysis_id):
+# Лимит ретраев задачи — по классам ошибок (ANALYSIS_TASK_RETRY_LIMITS), счетчики едут в retry_counts.
+# Общего max_retries у Celery нет: иначе парковка и разные классы тратили бы один бюджет
+@shared_task(bind=True, max_retries=None)
+def process_analysis_task(self, analysis_id, retry_counts=None, park_token=None):
     print(f"🔄 Pipeline started for Analysis ID: {analysis_id}")
-    
+
+    # Один прогон на анализ: дубли из trigger_next_analysis / загрузки при парковке не стартуют
+    claim = get_analysis_claim(analysis_id)
+    if not claim.acquire(park_token):
+        print(f"⏭️ Анализ {analysis_id} уже в работе или ждет своей отложенной задачи, пропускаем")
+        return False
+    try:
+        return _process_analysis(self, analysis_id, retry_counts, claim)
+    finally:
+        claim.release()
+
+
+def _process_analysis(task, analysis_id, retry_counts, claim):
+    # Если анализ не загрузился, обработчикам ошибок нечего парковать / проваливать
+    analysis = None
     try:
         analysis = MedicalAnalysis.objects.select_related('patient', 'user').get(uid=analysis_id)
-        
+
+        if analysis.status in (MedicalAnalysis.Status.COMPLETED, MedicalAnalysis.Status.FAILED):
+            # Устаревшая задача: анализ уже довела другая
+            print(f"⏭️ Анализ {analysis_id} уже {analysis.status}, пропускаем")
+            return False
         if analysis.status != MedicalAnalysis.Status.PROCESSING:
             analysis.status = MedicalAnalysis.Status.PROCESSING
             analysis.save(update_fields=['status'])
         
-        patient_context = ""
-        if analysis.patient:
-            age_str = f", Дата рождения: {analysis.patient.birth_date}" if analysis.patient.birth_date else ""
-            gender_str = f"Пол: {analysis.patient.get_gender_display()}" if analysis.patient.gender else "Пол: Не указан"
-            patient_context = f"{gender_str}{age_str}"
-            
-            six_months_ago = timezone.now().date() - timedelta(days=180)
-            
-            past_indicators = AnalysisIndicator.objects.filter(
-                patient=analysis.patient, 
-                date__gte=six_months_ago,
-                value__isnull=False
-            ).exclude(analysis=analysis).order_by('-date')
-            
-            if past_indicators.exists():
-                hist_dict = {}
-                for ind in past_indicators:
-                    if ind.name not in hist_dict:
-                        hist_dict[ind.name] = f"{ind.value} {ind.unit or ''} (от {ind.date.strftime('%d.%m.%Y')})"
-                
-                if hist_dict:
-                    history_str = "\n\nИСТОРИЯ ПРЕДЫДУЩИХ АНАЛИЗОВ ПАЦИЕНТА:\n"
-                    for name, val in hist_dict.items():
-                        history_str += f"- {name}: {val}\n"
-                    patient_context += history_str
+        patient_context = build_patient_context(analysis)
 
+        # Этапы сохраняются в чекпоинты: ретрай продолжит с упавшего этапа
+        checkpoints = AnalysisCheckpoints(analysis)
         pipeline = AnalysisPipeline()
-        result = pipeline.run_pipeline(analysis.file.path, patient_context)
-        
-        if result:
-            analysis.refresh_from_db()
-            analysis.ai_result = result
-            analysis.status = MedicalAnalysis.Status.COMPLETED
-            
-            if analysis.user:
-                ext_name = None
-                if isinstance(result, dict) and 'patient_info' in result and result['patient_info']:
-                    ext_name = result['patient_info'].get('extracted_name')
-                elif hasattr(result, 'patient_info') and result.patient_info:
-                    ext_name = getattr(result.patient_info, 'extracted_name', None)
-                
-                if ext_name and str(ext_name).strip() and str(ext_name).lower() != 'null':
-                    name_str = str(ext_name).strip()
-                    profile = PatientProfile.objects.filter(user=analysis.user, full_name__iexact=name_str).first()
-                    if not profile:
-                        profile = PatientProfile.objects.create(user=analysis.user, full_name=name_str)
-                    analysis.patient = profile
-                    
-            analysis.save(update_fields=['ai_result', 'status', 'patient'])
-            
+        try:
+            # Маленькие фото из очереди пользователя — одним запросом на извлечение.
+            # Паузы пакетного запроса тоже уходят в ретрай задачи, как в run_pipeline
+            pipeline._defer_active = pipeline.defer_waits
             try:
-                save_atomic_indicators(analysis, result)
-            except Exception as db_err:
-                print(f"⚠️ Error saving atomic indicators: {db_err}")
-            
+                prefetch_batch_extraction(pipeline, analysis, checkpoints)
+            except TransientLLMError:
+                raise
+            except Exception as batch_err:
+                print(f"⚠️ Пакетное извлечение не удалось, извлекаем отдельно: {batch_err}")
+            result = pipeline.run_pipeline(
+                analysis.file.path, patient_context,
+                checkpoints=checkpoints, fingerprints=PageFingerprints(analysis),
+            )
+        except TransientLLMError as exc:
+            # Пауза уходит в countdown ретрая — воркер свободен для других анализов
+            exc.countdown = retry_countdown(exc.stage, exc.delay, counted_retries(retry_counts))
+            pipeline.metrics.defer(exc.stage, exc.countdown)
+            raise
+        finally:
+            try:
+                save_pipeline_metrics(analysis, pipeline.metrics)
+            except Exception as metrics_err:
+                print(f"⚠️ Error saving pipeline metrics: {metrics_err}")
+        
+        if apply_pipeline_result(analysis, result):
+            checkpoints.clear()
             print(f"✅ Pipeline finished for {analysis_id}")
             
             # ЗАПУСКАЕМ СЛЕДУЮЩИЙ
             trigger_next_analysis(analysis)
             return True
         else:
-            analysis.refresh_from_db()
-            analysis.status = MedicalAnalysis.Status.FAILED
-            analysis.save(update_fields=['status'])
-            
             # ДАЖЕ ЕСЛИ ОШИБКА, ЗАПУСКАЕМ СЛЕДУЮЩИЙ
             trigger_next_analysis(analysis)
             return False
 
+    except CircuitOpenError as exc:
+        # Прокси лежит: анализ ждет в PENDING, попытки классов не тратятся, чекпоинты сохраняются.
+        # Число парковок ограничено (ANALYSIS_MAX_PARKS)
+        counts, countdown = task_park(exc, retry_counts)
+        if countdown is None:
+            print(f"❌ {exc}. Анализ {analysis_id} припаркован {counts[exc.error_class] - 1} раз, сдаемся")
+            _mark_failed(analysis)
+            return False
+        park_analysis(analysis)
+        if task.request.is_eager:
+            # Локальный прогон (.apply(), бенчмарк): через брокер ничего не планируем
+            print(f"🅿️ {exc}. Анализ {analysis_id} остается в PENDING (локальный прогон, без брокера)")
+            return False
+        print(f"🅿️ {exc}. Анализ {analysis_id} ждет {countdown}s в очереди")
+        # Пока анализ припаркован, его запускает только эта задача (см. AnalysisClaim)
+        park_token = claim.park(countdown)
+        process_analysis_task.apply_async(
+            (analysis_id,), {'retry_counts': counts, 'park_token': park_token}, countdown=countdown,
+        )
+        return False
+
+    except TransientLLMError as exc:
+        # Два лимита: лимит класса ошибки (ANALYSIS_TASK_RETRY_LIMITS) и общий на временные сбои —
+        # ожидание ключа пула в общий не идет (см. WAIT_CLASSES).
+        # Проверяем сами: с exc= Celery при исчерпании бросил бы саму exc, а не MaxRetriesExceededError
+        max_retries = getattr(settings, 'ANALYSIS_TRANSIENT_MAX_RETRIES', 8)
+        attempt = counted_retries(retry_counts)
+        error_class, counts, countdown = task_retry(exc, retry_counts, attempt)
+        if countdown is None or (error_class != 'key_wait' and attempt >= max_retries):
+            print(f"❌ {error_class}: ретраи задачи исчерпаны")
+            _mark_failed(analysis)
+            return False
+        if exc.countdown is None:
+            exc.countdown = countdown
+        print(f"⏳ {exc}. Ретрай задачи через {exc.countdown}s ({error_class} {counts[error_class]}, "
+              f"сбоев {counted_retries(counts)}/{max_retries})")
+        # Ретрай — та же задача: отпускаем захват до постановки (eager-ретрай выполнится прямо здесь)
+        claim.release()
+        raise task.retry(exc=exc, countdown=exc.countdown, kwargs={'retry_counts': counts})
+
     except Exception as exc:
-        print(f"❌ Error in Task: {exc}")
-        countdown = 5 * (2 ** self.request.retries)
-        try:
-            print(f"⚠️ Retrying in {countdown}s... (Attempt {self.request.retries + 1}/5)")
-            raise self.retry(exc=exc, countdown=countdown)
-        except self.MaxRetriesExceededError:
-            print("❌ Max retries exceeded.")
-            try:
-                analysis.refresh_from_db()
-                analysis.status = MedicalAnalysis.Status.FAILED
-                analysis.save(update_fields=['status'])
-                
-                # ВСЕ ПОПЫТКИ ИСЧЕРПАНЫ - ИДЕМ ДАЛЬШЕ
-                trigger_next_analysis(analysis)
-            except Exception:
-                pass
-            return False
\ No newline at end of file
+        # 400 / auth повторами не лечатся; временные — не больше лимита своего класса
+        error_class, counts, countdown = task_retry(exc, retry_counts, counted_retries(retry_counts))
+        print(f"❌ Error in Task [{error_class}]: {exc}")
+        if countdown is None:
+            print(f"❌ {error_class}: ретраи задачи исчерпаны")
+            _mark_failed(analysis)
+            return False
+        print(f"⚠️ Retrying in {countdown}s... ({error_class} {counts[error_class]})")
+        claim.release()
+        raise task.retry(exc=exc, countdown=countdown, kwargs={'retry_counts': counts})
+
+
+def park_analysis(analysis):
+    """Анализ обратно в PENDING: для пользователя он просто ждет в очереди"""
+    if analysis is None:
+        return
+    try:
+        analysis.status = MedicalAnalysis.Status.PENDING
+        analysis.save(update_fields=['status'])
+    except Exception as e:
+        print(f"⚠️ Не удалось вернуть анализ в PENDING: {e}")
+
+
+def _mark_failed(analysis):
+    """Все попытки исчерпаны: анализ в FAILED, чекпоинты чистим, очередь пользователя идет дальше"""
+    if analysis is None:
+        return
+    try:
+        analysis.refresh_from_db()
+        analysis.status = MedicalAnalysis.Status.FAILED
+        analysis.save(update_fields=['status'])
+        AnalysisCheckpoints(analysis).clear()
+        
+        # ВСЕ ПОПЫТКИ ИСЧЕРПАНЫ - ИДЕМ ДАЛЬШЕ
+        trigger_next_analysis(analysis)
+    except Exception:
+        pass